@@ -0,0 +1,264 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import concurrent.futures
+import copy
+import csv
+import glob
+import json
+import os
+import traceback
+import cache
+import tracecol
+
+
+MANIFEST_NAME = 'batch_manifest.json'
+SUMMARY_NAME = 'batch_summary.csv'
+
+
+def is_batch(path):
+    """
+    Whether a path names several workbooks, i.e. is a directory or a glob pattern
+
+    :param path: path given on the command line
+    :return: T/F
+    """
+
+    return os.path.isdir(path) or glob.has_magic(path)
+
+
+def find_workbooks(path):
+    """
+    Workbooks in a directory (not recursive) or matching a glob pattern, skipping Excel lock files
+
+    :param path: directory or glob pattern
+    :return: sorted list of paths
+    """
+
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.xlsx')
+
+    return sorted(p for p in glob.glob(path)
+                  if os.path.isfile(p) and not os.path.basename(p).startswith('~$'))
+
+
+def workbook_labels(paths):
+    """
+    Name of every workbook of the batch: its path relative to the directory common to all of them, without the
+    extension. Workbooks of the same name in different directories, e.g. from 'data/*/slide.xlsx', keep apart.
+
+    :param paths: list of workbook paths
+    :return: dict of label keyed by path
+    """
+
+    if not paths:
+        return {}
+
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+    return dict((p, os.path.splitext(os.path.relpath(os.path.abspath(p), root))[0].replace(os.sep, '/'))
+                for p in paths)
+
+
+def workbook_out(out, label):
+    """
+    Output directory of one workbook within the batch output directory
+
+    :param out: batch output directory
+    :param label: label of the workbook from workbook_labels
+    :return: path
+    """
+
+    return os.path.join(out, *label.split('/'))
+
+
+def load_manifest(out):
+    """
+    Read the manifest of an earlier, possibly interrupted, run
+
+    :param out: batch output directory
+    :return: dict with 'workbooks' keyed by absolute workbook path
+    """
+
+    manifest_path = os.path.join(out, MANIFEST_NAME)
+
+    if not os.path.isfile(manifest_path):
+        return {'workbooks': {}}
+
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def save_manifest(out, manifest):
+    """
+    Write the manifest, replacing the old one only once the new one is complete
+
+    :param out: batch output directory
+    :param manifest: dict
+    :return: True
+    """
+
+    manifest_path = os.path.join(out, MANIFEST_NAME)
+    tmp_path = manifest_path + '.tmp'
+
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    os.replace(tmp_path, manifest_path)
+
+    return True
+
+
+def parse_workbook(task):
+    """
+    Analyze one workbook of the batch into its own output directory. Runs in a worker process, so the
+    columns of the workbook are analyzed and drawn serially.
+
+    :param task: tuple of (workbook path, workbook label, args)
+    :return: tuple of (workbook path, list of sheet summaries or None, error message or None)
+    """
+
+    import main
+
+    path, label, args = task
+
+    wb_args = copy.copy(args)
+    wb_args.path = path
+    wb_args.out = workbook_out(args.out, label)
+    wb_args.jobs = 1
+    wb_args.render_jobs = 1
+
+    try:
+        return path, main.parsefile(wb_args), None
+
+    except Exception:
+        return path, None, traceback.format_exc()
+
+
+def write_summary(out, manifest, paths):
+    """
+    Write one row per sheet of every completed workbook of the batch, in workbook order, followed by a row of
+    all sheets of each workbook and a row of the whole batch. The totals merge the running statistics of the
+    sheets, without going back to their values.
+
+    :param out: batch output directory
+    :param manifest: dict
+    :param paths: list of absolute workbook paths in the batch
+    :return: path to the summary
+    """
+
+    labels = workbook_labels(paths)
+    rows = []
+    total = tracecol.TraceCollection(keep=False)
+    total_columns = 0
+
+    for path in sorted(paths):
+        entry = manifest['workbooks'].get(path)
+        if entry is not None and entry['status'] == 'done':
+            workbook = tracecol.TraceCollection(keep=False)
+            columns = 0
+
+            for summary in entry['sheets']:
+                row = {'workbook': labels[path]}
+                row.update((k, v) for (k, v) in summary.items() if k != 'stats')
+                rows.append(row)
+
+                columns += summary['columns']
+                if 'stats' in summary:
+                    workbook.restore(summary['stats'])
+
+            row = {'workbook': labels[path], 'sheet': 'ALL', 'columns': columns}
+            row.update(workbook.summary())
+            rows.append(row)
+
+            total.extend(workbook)
+            total_columns += columns
+
+    if rows:
+        row = {'workbook': 'ALL', 'sheet': 'ALL', 'columns': total_columns}
+        row.update(total.summary())
+        rows.append(row)
+
+    summary_path = os.path.join(out, SUMMARY_NAME)
+
+    with open(summary_path, 'w', newline='') as f:
+        if rows:
+            writer = csv.DictWriter(f, fieldnames=list(rows[-1].keys()), extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return summary_path
+
+
+def run_batch(args):
+    """
+    Analyze every workbook in a directory or matching a glob pattern, --jobs workbooks at a time.
+    Each workbook goes to its own subdirectory of the output directory, named by its path relative to the
+    directory common to all workbooks. Completed workbooks are recorded in
+    a manifest as they finish, so that a rerun skips those whose content has not changed since.
+    A summary of every sheet of every workbook is written at the end.
+
+    Usage: python main.py 'data/2017-06-27/' -o day_out -j 4
+    Usage: python main.py 'data/*/*slide.xlsx' -o slides_out
+
+    :param args: parsed arguments of main.py
+    :return: path to the summary
+    """
+
+    os.makedirs(args.out, exist_ok=True)
+
+    manifest = load_manifest(args.out)
+
+    # Queue every workbook not yet done, or changed since it was done
+    queue = []
+    hashes = {}
+    for path in find_workbooks(args.path):
+        key = os.path.abspath(path)
+        hashes[key] = cache.file_hash(path)
+        entry = manifest['workbooks'].get(key)
+
+        if entry is not None and entry['status'] == 'done' and entry['hash'] == hashes[key]:
+            if args.verbose:
+                print('verbosity 1: skipping completed workbook ' + path)
+            continue
+
+        queue.append(key)
+
+    labels = workbook_labels(list(hashes.keys()))
+
+    print('Analyzing ' + str(len(queue)) + ' workbooks, ' + str(len(hashes) - len(queue)) + ' already done.')
+
+    if args.jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+        results = concurrent.futures.as_completed([executor.submit(parse_workbook, (path, labels[path], args))
+                                                   for path in queue])
+        results = (future.result() for future in results)
+    else:
+        executor = None
+        results = map(parse_workbook, [(path, labels[path], args) for path in queue])
+
+    try:
+        for (path, summaries, error) in results:
+            entry = {'hash': hashes[path], 'out': workbook_out(args.out, labels[path])}
+
+            if error is None:
+                entry.update(status='done', sheets=summaries)
+                print('Completed workbook ' + path)
+            else:
+                entry.update(status='failed', error=error)
+                print('Failed workbook ' + path + '\n' + error)
+
+            manifest['workbooks'][path] = entry
+            save_manifest(args.out, manifest)
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return write_summary(args.out, manifest, list(hashes.keys()))
@@ -0,0 +1,302 @@
+"""
+AutoCal
+Stage-level benchmarks of the calcium and sarcomere pipelines on synthetic workbooks
+
+Usage: python benchmarks/bench.py --frames 1000 5000 20000 -o bench.json
+Usage: python benchmarks/bench.py --compare bench_before.json -o bench_after.json
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import os, sys, argparse
+import json
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+
+# The pipeline modules live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import caltrace, tracelet, ingest, events, sg
+import synth
+
+
+STAGES = ('ingest', 'ratio', 'orient', 'smooth', 'detect', 'decay', 'fit_single', 'fit_batch', 'render',
+          'sarc_ingest', 'sarc_detect')
+
+
+def measure(fn, setup=None, repeat=3):
+    """
+    Time a function several times, each on fresh input
+
+    :param fn: function to time, called with the return value of setup
+    :param setup: function returning a tuple of arguments for fn, run outside the timing, or None
+    :param repeat: int, number of timed calls
+    :return: list of float seconds
+    """
+
+    times = []
+    for _ in range(repeat):
+        fn_args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        fn(*fn_args)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def make_traces(sim):
+    """
+    Build one CalciumTrace per simulated cell
+
+    :param sim: dict from synth.calcium_arrays
+    :return: list of CalciumTrace
+    """
+
+    return [caltrace.CalciumTrace(sheetname='Sheet1', colname='Cell' + str(c + 1), tm=sim['time'],
+                                  raw_dt=sim['data'][:, c], bg=sim['background'])
+            for c in range(sim['data'].shape[1])]
+
+
+def prepare_traces(sim):
+    """
+    Run the calcium pipeline up to detection, as the stages after it need its output
+
+    :param sim: dict from synth.calcium_arrays
+    :return: list of (CalciumTrace, rise_starts, rise_ends)
+    """
+
+    trces = make_traces(sim)
+    for trce in trces:
+        trce.make_ratio()
+
+    ratios, smooths, derivs, flipped = caltrace.orient_ratios(np.column_stack([trce.ratio for trce in trces]))
+    for i, trce in enumerate(trces):
+        trce.apply_orientation(ratios[:, i], smooths[:, i], derivs[:, i], flipped[i])
+
+    out = []
+    for trce in trces:
+        rise_starts, rise_ends = events.detect_rises(trce.deriv, y_tol=0.0005, x_tol=10)
+        out.append((trce, rise_starts, rise_ends))
+
+    return out
+
+
+def tracelet_sets(prepared):
+    """
+    Fresh, unfitted tracelet sets of every prepared trace
+
+    :param prepared: list from prepare_traces
+    :return: list of TraceletSet
+    """
+
+    return [tracelet.TraceletSet(tm=trce.median_time, dt=trce.ratio, sm=trce.smooth,
+                                 starts=rise_ends[:-1], ends=rise_starts[1:])
+            for (trce, rise_starts, rise_ends) in prepared]
+
+
+def bench_calcium(frames, cells, repeat, stages, workdir, max_xlsx_frames, dpi):
+    """
+    Time the stages of the calcium pipeline on one simulated sheet
+
+    :return: list of (stage, seconds list, extra info dict)
+    """
+
+    results = []
+    sim = synth.calcium_arrays(cells=cells, frames=frames)
+
+    if 'ingest' in stages and frames <= max_xlsx_frames:
+        path = os.path.join(workdir, 'calcium_' + str(frames) + '.xlsx')
+        synth.write_calcium_workbook(path, cells=cells, frames=frames)
+        times = measure(lambda: list(ingest.read_workbook(path)), repeat=repeat)
+        results.append(('ingest', times, {'bytes': os.path.getsize(path)}))
+
+    if 'ratio' in stages:
+        def ratio(trces):
+            for trce in trces:
+                trce.make_ratio()
+
+        times = measure(ratio, setup=lambda: (make_traces(sim),), repeat=repeat)
+        results.append(('ratio', times, {}))
+
+    prepared = prepare_traces(sim)
+    ratios = np.column_stack([trce.ratio for (trce, _, _) in prepared])
+
+    if 'orient' in stages:
+        times = measure(lambda: caltrace.orient_ratios(ratios), repeat=repeat)
+        n_flipped = int(np.sum([trce.ratio_has_been_flipped for (trce, _, _) in prepared]))
+        results.append(('orient', times, {'flipped': n_flipped, 'expected_flipped': int(sim['flipped'].sum())}))
+
+    if 'smooth' in stages:
+        def smooth():
+            for (trce, _, _) in prepared:
+                sg.savitzky_golay(trce.ratio, 15, 3, diff=True)
+
+        times = measure(smooth, repeat=repeat)
+        results.append(('smooth', times, {}))
+
+    if 'detect' in stages:
+        def detect():
+            for (trce, _, _) in prepared:
+                events.detect_rises(trce.deriv, y_tol=0.0005, x_tol=10)
+
+        times = measure(detect, repeat=repeat)
+        results.append(('detect', times, {'events': int(sum(len(s) for (_, s, _) in prepared))}))
+
+    if 'decay' in stages:
+        sets = tracelet_sets(prepared)
+
+        def decay():
+            for tracelets in sets:
+                tracelets.decay_times()
+
+        times = measure(decay, repeat=repeat)
+        results.append(('decay', times, {'tracelets': int(sum(len(s) for s in sets))}))
+
+    if 'fit_single' in stages:
+        def fit_single(sets):
+            for tracelets in sets:
+                tracelets.optimize(model=2)
+
+        times = measure(fit_single, setup=lambda: (tracelet_sets(prepared),), repeat=repeat)
+        results.append(('fit_single', times, {'tracelets': int(sum(len(s) for s in tracelet_sets(prepared)))}))
+
+    if 'fit_batch' in stages:
+        times = measure(tracelet.optimize_batch, setup=lambda: (tracelet_sets(prepared),), repeat=repeat)
+        results.append(('fit_batch', times, {'tracelets': int(sum(len(s) for s in tracelet_sets(prepared)))}))
+
+    if 'render' in stages:
+        import main, render
+
+        sets = tracelet_sets(prepared)
+        tracelet.optimize_batch(sets)
+        record = main.make_record(prepared[0][0], prepared[0][1], prepared[0][2], sets[0])
+        out = os.path.join(workdir, 'render')
+
+        times = measure(lambda: render.render_column(record, out, dpi), repeat=repeat)
+        results.append(('render', times, {'dpi': dpi}))
+
+    return results
+
+
+def bench_sarcomere(length, profiles, repeat, stages, workdir, max_xlsx_frames):
+    """
+    Time the stages of the sarcomere pipeline on one simulated sheet
+
+    :return: list of (stage, seconds list, extra info dict)
+    """
+
+    results = []
+    sim = synth.sarcomere_arrays(profiles=profiles, length=length)
+
+    if 'sarc_ingest' in stages and length <= max_xlsx_frames:
+        path = os.path.join(workdir, 'sarcomere_' + str(length) + '.xlsx')
+        synth.write_sarcomere_workbook(path, profiles=profiles, length=length)
+        times = measure(lambda: list(ingest.read_workbook(path)), repeat=repeat)
+        results.append(('sarc_ingest', times, {'bytes': os.path.getsize(path)}))
+
+    if 'sarc_detect' in stages:
+        def detect():
+            for (dist, read, _) in sim:
+                read_smooth, read_deriv = sg.savitzky_golay(read, 13, 3, diff=True)
+                events.detect_rises(read_deriv, y_tol=0.1, x_tol=5)
+
+        times = measure(detect, repeat=repeat)
+        results.append(('sarc_detect', times, {}))
+
+    return results
+
+
+def compare(results, baseline_path):
+    """
+    Print the best time of every stage against a previous run
+
+    :param results: list of result dicts of this run
+    :param baseline_path: path to the json file of the previous run
+    :return: None
+    """
+
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    before = dict(((r['stage'], r['size'], r['columns']), r['best']) for r in baseline['results'])
+
+    print('{:<12}{:>10}{:>9}{:>12}{:>12}{:>9}'.format('stage', 'size', 'columns', 'before', 'after', 'ratio'))
+    for r in results:
+        key = (r['stage'], r['size'], r['columns'])
+        if key in before:
+            print('{:<12}{:>10}{:>9}{:>12.4f}{:>12.4f}{:>9.2f}'.format(r['stage'], r['size'], r['columns'],
+                                                                      before[key], r['best'],
+                                                                      before[key] / r['best']))
+
+
+def run(args):
+    """
+    Run the benchmarks and write the results as json
+
+    :param args: parsed arguments
+    :return: list of result dicts
+    """
+
+    stages = set(args.stages)
+    workdir = tempfile.mkdtemp(prefix='autocal_bench_')
+    results = []
+
+    try:
+        for frames in args.frames:
+            for (stage, times, info) in bench_calcium(frames, args.cells, args.repeat, stages, workdir,
+                                                      args.max_xlsx_frames, args.dpi):
+                results.append({'stage': stage, 'size': frames, 'columns': args.cells, 'times': times,
+                                'best': min(times), 'median': float(np.median(times)), 'info': info})
+                print('{:<12} frames={:<8} best={:.4f}s'.format(stage, frames, min(times)))
+
+        for length in args.lengths:
+            for (stage, times, info) in bench_sarcomere(length, args.profiles, args.repeat, stages, workdir,
+                                                        args.max_xlsx_frames):
+                results.append({'stage': stage, 'size': length, 'columns': args.profiles, 'times': times,
+                                'best': min(times), 'median': float(np.median(times)), 'info': info})
+                print('{:<12} pixels={:<8} best={:.4f}s'.format(stage, length, min(times)))
+
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'repeat': args.repeat}
+
+    with open(args.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Time each stage of the AutoCal pipelines on synthetic data.')
+
+    parser.add_argument('-o', '--out', help='path to the json results file', default='bench_results.json')
+    parser.add_argument('--frames', help='calcium sizes: number of 340/380 pairs per cell',
+                        type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--cells', help='number of cells per calcium sheet', type=int, default=8)
+    parser.add_argument('--lengths', help='sarcomere sizes: maximum pixels per line profile',
+                        type=int, nargs='+', default=[300, 3000])
+    parser.add_argument('--profiles', help='number of line profiles per sarcomere sheet', type=int, default=8)
+    parser.add_argument('--stages', help='stages to run', nargs='+', choices=STAGES,
+                        default=[s for s in STAGES if s != 'render'])
+    parser.add_argument('--repeat', help='number of timed runs per stage', type=int, default=3)
+    parser.add_argument('--max_xlsx_frames', help='skip the ingest stages above this size, writing large '
+                                                  'workbooks is slow', type=int, default=20000)
+    parser.add_argument('--dpi', help='resolution of the rendered figure', type=int, default=100)
+    parser.add_argument('--compare', help='json results of a previous run to compare against', default=None)
+
+    run(parser.parse_args())
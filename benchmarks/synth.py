@@ -0,0 +1,201 @@
+"""
+AutoCal
+Synthetic Fura-2 and sarcomere workbooks for benchmarking
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+
+
+def calcium_arrays(cells=8, frames=1000, frame_interval=0.005, beat_rate=1.0, amplitude=0.5,
+                   rise_time=0.08, decay_tau=0.25, noise=0.01, flipped=0.25, seed=0):
+    """
+    Simulate interleaved 340/380 nm recordings of paced cells.
+    Each cell beats at about the given rate with a little jitter; a transient rises over rise_time and decays
+    with decay_tau on top of a baseline ratio of 0.8. The 340 and 380 readings are derived from the ratio with
+    Gaussian noise, and a fraction of cells has the 380 reading recorded first, as happens on the TI50 scope.
+
+    :param cells: int, number of cells (data columns)
+    :param frames: int, number of 340/380 pairs per cell
+    :param frame_interval: float, seconds between pairs
+    :param beat_rate: float, beats per second
+    :param amplitude: float, transient amplitude in ratio units
+    :param rise_time: float, seconds from transient start to peak
+    :param decay_tau: float, decay time constant in seconds
+    :param noise: float, relative noise of each reading
+    :param flipped: float, fraction of cells with swapped 340/380 order
+    :param seed: int, random seed
+    :return: dict with 'time' (2 * frames,), 'data' (2 * frames, cells), 'background' (2 * frames,),
+        'flipped' (cells,) and 'ratio' (frames, cells), the noise-free ratio
+    """
+
+    rng = np.random.RandomState(seed)
+
+    t = np.arange(frames) * frame_interval
+    ratio = np.full((frames, cells), 0.8)
+
+    for c in range(cells):
+        period = 1. / beat_rate
+        onset = rng.uniform(0, period)
+        while onset < t[-1]:
+            since = t - onset
+            after = since >= 0
+            rise = np.clip(since[after] / rise_time, 0, 1)
+            fall = np.exp(-np.clip(since[after] - rise_time, 0, None) / decay_tau)
+            ratio[after, c] += amplitude * rise * fall
+            onset += period * rng.uniform(0.95, 1.05)
+
+    # Slow bleaching of the 380 nm signal
+    f380 = 1000. * np.exp(-t / (50. * t[-1] + 1.))[:, None] * np.ones((1, cells))
+    f340 = ratio * f380
+
+    f340 = f340 * (1 + rng.normal(0, noise, f340.shape))
+    f380 = f380 * (1 + rng.normal(0, noise, f380.shape))
+
+    is_flipped = rng.rand(cells) < flipped
+
+    data = np.empty((2 * frames, cells))
+    data[0::2] = np.where(is_flipped, f380, f340)
+    data[1::2] = np.where(is_flipped, f340, f380)
+
+    time = np.empty(2 * frames)
+    time[0::2] = t
+    time[1::2] = t + frame_interval / 2.
+
+    background = 50. + rng.normal(0, 1, 2 * frames)
+
+    return {'time': time, 'data': data, 'background': background, 'flipped': is_flipped, 'ratio': ratio}
+
+
+def write_calcium_workbook(path, sheets=1, seed=0, **kwargs):
+    """
+    Write simulated recordings in the layout main.py expects: index, time, three unused columns,
+    one column per cell, and the background in the last column. The first row holds the headers.
+
+    :param path: path to the xlsx file
+    :param sheets: int, number of sheets
+    :param seed: int, random seed of the first sheet (later sheets use the following seeds)
+    :param kwargs: passed to calcium_arrays
+    :return: list of the dicts from calcium_arrays, one per sheet
+    """
+
+    import openpyxl as xl
+
+    wb = xl.Workbook(write_only=True)
+    simulated = []
+
+    for s in range(sheets):
+        sim = calcium_arrays(seed=seed + s, **kwargs)
+        simulated.append(sim)
+
+        ws = wb.create_sheet(title='Sheet' + str(s + 1))
+        cells = sim['data'].shape[1]
+        ws.append(['Index', 'Time', 'X', 'Y', 'Z'] + ['Cell' + str(c + 1) for c in range(cells)] + ['Background'])
+
+        for i in range(sim['time'].size):
+            ws.append([i, float(sim['time'][i]), 0, 0, 0] + sim['data'][i].tolist() + [float(sim['background'][i])])
+
+    wb.save(path)
+
+    return simulated
+
+
+def sarcomere_arrays(profiles=8, length=300, pixel=0.05, spacing=1.85, spacing_sd=0.05, noise=0.05, seed=0):
+    """
+    Simulate line profiles across striated cells: a sinusoid of the sarcomere spacing with noise,
+    each profile a different length between half and the full length.
+
+    :param profiles: int, number of line profiles
+    :param length: int, maximum number of pixels per profile
+    :param pixel: float, distance between pixels
+    :param spacing: float, mean sarcomere spacing
+    :param spacing_sd: float, spread of the spacing between profiles
+    :param noise: float, relative noise of the intensity
+    :param seed: int, random seed
+    :return: list of (distance, intensity, spacing) tuples
+    """
+
+    rng = np.random.RandomState(seed)
+    out = []
+
+    for p in range(profiles):
+        n = rng.randint(length // 2, length + 1)
+        dist = np.arange(n) * pixel
+        period = spacing + rng.normal(0, spacing_sd)
+        intensity = 100. + 50. * np.sin(2 * np.pi * dist / period + rng.uniform(0, 2 * np.pi))
+        intensity *= 1 + rng.normal(0, noise, n)
+        out.append((dist, intensity, period))
+
+    return out
+
+
+def write_sarcomere_workbook(path, sheets=1, seed=0, **kwargs):
+    """
+    Write simulated line profiles in the layout sarc.py expects: alternating distance and intensity columns
+    with a header row, shorter profiles padded with empty cells.
+
+    :param path: path to the xlsx file
+    :param sheets: int, number of sheets
+    :param seed: int, random seed of the first sheet
+    :param kwargs: passed to sarcomere_arrays
+    :return: list of the lists from sarcomere_arrays, one per sheet
+    """
+
+    import openpyxl as xl
+
+    wb = xl.Workbook(write_only=True)
+    simulated = []
+
+    for s in range(sheets):
+        profiles = sarcomere_arrays(seed=seed + s, **kwargs)
+        simulated.append(profiles)
+
+        ws = wb.create_sheet(title='Sheet' + str(s + 1))
+        header = []
+        for p in range(len(profiles)):
+            header += ['Distance_' + str(p + 1), 'Gray_Value_' + str(p + 1)]
+        ws.append(header)
+
+        rows = max(dist.size for (dist, _, _) in profiles)
+        for i in range(rows):
+            row = []
+            for (dist, intensity, _) in profiles:
+                if i < dist.size:
+                    row += [float(dist[i]), float(intensity[i])]
+                else:
+                    row += [None, None]
+            ws.append(row)
+
+    wb.save(path)
+
+    return simulated
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write synthetic workbooks for AutoCal.')
+    parser.add_argument('kind', choices=['calcium', 'sarcomere'], help='type of workbook')
+    parser.add_argument('path', help='path to the xlsx file to write')
+    parser.add_argument('--sheets', type=int, default=1, help='number of sheets')
+    parser.add_argument('--cells', type=int, default=8, help='calcium: number of cells')
+    parser.add_argument('--frames', type=int, default=1000, help='calcium: number of 340/380 pairs')
+    parser.add_argument('--beat_rate', type=float, default=1.0, help='calcium: beats per second')
+    parser.add_argument('--noise', type=float, default=0.01, help='relative noise')
+    parser.add_argument('--flipped', type=float, default=0.25, help='calcium: fraction of swapped cells')
+    parser.add_argument('--profiles', type=int, default=8, help='sarcomere: number of line profiles')
+    parser.add_argument('--length', type=int, default=300, help='sarcomere: maximum pixels per profile')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+    args = parser.parse_args()
+
+    if args.kind == 'calcium':
+        write_calcium_workbook(args.path, sheets=args.sheets, seed=args.seed, cells=args.cells, frames=args.frames,
+                               beat_rate=args.beat_rate, noise=args.noise, flipped=args.flipped)
+    else:
+        write_sarcomere_workbook(args.path, sheets=args.sheets, seed=args.seed, profiles=args.profiles,
+                                 length=args.length, noise=args.noise)
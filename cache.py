@@ -0,0 +1,140 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+# Bump whenever the layout of the cached arrays changes so that old entries are no longer used
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.autocal_cache')
+
+
+def file_hash(path, blocksize=1 << 20):
+    """
+    SHA-1 digest of a file's content, read in blocks
+
+    :param path: path to the file
+    :param blocksize: int, number of bytes to read at a time
+    :return: str hex digest
+    """
+
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def entry_path(cache_dir, digest):
+    """
+    Directory holding the cached sheets of one workbook
+
+    :param cache_dir: path to the cache
+    :param digest: str content hash of the workbook
+    :return: path
+    """
+
+    return os.path.join(cache_dir, digest + '_v' + str(CACHE_VERSION))
+
+
+def _json_safe(value):
+    """
+    Header cells may hold dates or other objects, store anything json cannot hold as text
+
+    :param value: header cell value
+    :return: json-serializable value
+    """
+
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+
+    return str(value)
+
+
+def load(cache_dir, digest):
+    """
+    Read the cached sheets of a workbook, with arrays memory-mapped from disk
+
+    :param cache_dir: path to the cache
+    :param digest: str content hash of the workbook
+    :return: list of Sheet objects, or None if the workbook is not cached
+    """
+
+    import ingest
+
+    entry = entry_path(cache_dir, digest)
+    manifest_path = os.path.join(entry, 'manifest.json')
+
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    return [ingest.Sheet(name=s['name'],
+                         header=s['header'],
+                         data=np.load(os.path.join(entry, s['file']), mmap_mode='r'),
+                         exact=dict((int(j), np.load(os.path.join(entry, file_name), mmap_mode='r'))
+                                    for (j, file_name) in s.get('exact', {}).items()))
+            for s in manifest['sheets']]
+
+
+def save(cache_dir, digest, sheets):
+    """
+    Write the sheets of a workbook to the cache, one .npy file per sheet plus a json manifest.
+    The entry is assembled in a temporary directory and moved into place so that readers never see
+    a partial entry.
+
+    :param cache_dir: path to the cache
+    :param digest: str content hash of the workbook
+    :param sheets: list of Sheet objects
+    :return: True
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = entry_path(cache_dir, digest)
+
+    tmp = tempfile.mkdtemp(dir=cache_dir)
+
+    try:
+        manifest = {'version': CACHE_VERSION, 'sheets': []}
+
+        for i, sheet in enumerate(sheets):
+            file_name = 'sheet' + str(i) + '.npy'
+            np.save(os.path.join(tmp, file_name), sheet.data)
+
+            # Columns kept in full precision next to a reduced-precision array
+            exact = {}
+            for (j, col) in sheet.exact.items():
+                exact[str(j)] = 'sheet' + str(i) + '_col' + str(j) + '.npy'
+                np.save(os.path.join(tmp, exact[str(j)]), col)
+
+            manifest['sheets'].append({'name': sheet.name,
+                                       'header': [_json_safe(h) for h in sheet.header],
+                                       'file': file_name,
+                                       'exact': exact})
+
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        os.rename(tmp, entry)
+
+    # If another run cached the same workbook in the meantime, or the cache cannot be written, leave it as is
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return True
@@ -10,37 +10,45 @@ lau1@stanford.edu
 class CalciumTrace(object):
     """
     Object to hold one single calcium trace.
+    All series are held as contiguous float arrays; the 340 and 380 nm readings are reached through
+    strided views of the interleaved data rather than copies.
 
     """
 
-    def __init__(self, sheetname, colname, tm, raw_dt, bg):
+    __slots__ = ('sheetname', 'colname', 'tm', 'raw_dt', 'dt', 'bg',
+                 'ratio', 'median_time', 'smooth', 'deriv', 'ratio_verified', 'ratio_has_been_flipped')
+
+    def __init__(self, sheetname, colname, tm, raw_dt, bg, dtype=float):
         """
 
         :param sheetname:   Sheet name
         :param colname:     Column name
-        :param tm:          A list holding time information
-        :param dt:          A list holding calcium data (both 340 and 380 nm)
-        :param bg:          A list holding background
+        :param tm:          array_like holding time information
+        :param dt:          array_like holding calcium data (both 340 and 380 nm)
+        :param bg:          array_like holding background
+        :param dtype:       float type of the data and everything computed from it, e.g. np.float32 to halve
+                            their memory. Time is always kept in float64, as long recordings need its precision.
         """
 
+        import re
+        import numpy as np
+
         assert len(raw_dt) == len(tm) and len(raw_dt) == len(bg), 'Dimension mismatch in data/background/time!!'
         assert len(raw_dt) % 2 == 0, 'Number of rows not even - check data file!!'
 
-        import re
-
         # Hold the sheet and column data after sanitizing
         self.sheetname = re.sub(r'[^\w\\P]', '', sheetname)
         self.colname = re.sub(r'[^\w\\P]', '', colname)
-        self.tm = tm
-        self.raw_dt = raw_dt    # Prior to background subtraction
-        self.dt = raw_dt        # Will be modified after background subtraction in make_ratio()
-        self.bg = bg
+        self.tm = np.asarray(tm, dtype=float)
+        self.raw_dt = np.asarray(raw_dt, dtype=dtype)    # Prior to background subtraction
+        self.dt = self.raw_dt                             # Will be modified after background subtraction in make_ratio()
+        self.bg = np.asarray(bg, dtype=dtype)
 
         # Private
-        self.ratio = []
-        self.median_time = []
-        self.smooth = []
-        self.deriv = []
+        self.ratio = np.zeros(0, dtype=dtype)
+        self.median_time = np.zeros(0)
+        self.smooth = np.zeros(0, dtype=dtype)
+        self.deriv = np.zeros(0, dtype=dtype)
         self.ratio_verified = False
         self.ratio_has_been_flipped = False
 
@@ -62,7 +70,6 @@ class CalciumTrace(object):
         """
 
         import sg
-        import numpy as np
 
         assert len(self.raw_dt) == len(self.bg), 'Background array different in length than data'
 
@@ -70,25 +77,20 @@ class CalciumTrace(object):
         if correct_background:
             if smooth_background:
 
-                # Separate the 340 and 380 nm into separate tracks and smooth
-                bg_smooth1 = sg.savitzky_golay(np.array(self.bg[::2]), 51, 3)
-                bg_smooth2 = sg.savitzky_golay(np.array(self.bg[1::2]), 51, 3)
-
-                # Interweave the smoothened tracks back together
-                bg_smooth = []
-                for (value1, value2) in zip(bg_smooth1, bg_smooth2):
-                    bg_smooth.extend([value1, value2])
+                # Smooth the 340 and 380 nm tracks side by side, as the two columns of a (n, 2) view,
+                # which leaves them interweaved again when flattened
+                bg_smooth = sg.savitzky_golay(self.bg.reshape(-1, 2), 51, 3, axis=0).ravel()
 
             elif not smooth_background:
-                self.dt = [self.raw_dt[i] - self.bg[i] for i in range(len(self.raw_dt))]
+                self.dt = self.raw_dt - self.bg
 
 
 
         # Taking ratio of every other reading (340 nm) over the immediate following reading (280 nm)
-        self.ratio = [self.dt[0::2][i] / self.dt[1::2][i] for i in range(len(self.dt[0::2]))]
+        self.ratio = self.dt[0::2] / self.dt[1::2]
 
         # Taking the mean time between each 340 nm and 380 nm reading as the assumed time of the reading.
-        self.median_time = [(self.tm[0::2][i] + self.tm[1::2][i]) / 2 for i in range(len(self.tm[0::2]))]
+        self.median_time = (self.tm[0::2] + self.tm[1::2]) / 2
 
         return True
 
@@ -103,15 +105,35 @@ class CalciumTrace(object):
         :return: True
         """
         import sg
-        import numpy as np
-
-        assert self.ratio != [], 'Ratios not yet calculated!!'
 
-        self.smooth = sg.savitzky_golay(np.array(self.ratio), size, order)
+        assert self.ratio.size > 0, 'Ratios not yet calculated!!'
 
         if derivatize:
-            # Take derivative
-            self.deriv = np.diff(self.smooth)
+            # Smoothen and take derivative in the same call
+            self.smooth, self.deriv = sg.savitzky_golay(self.ratio, size, order, diff=True)
+
+        else:
+            self.smooth = sg.savitzky_golay(self.ratio, size, order)
+
+        return True
+
+    def apply_orientation(self, ratio, smooth, deriv, flipped):
+        """
+        Take over a ratio that has been smoothened and oriented together with the other columns of the sheet
+        (see orient_ratios), marking it as verified.
+
+        :param ratio:   ndarray, correctly oriented 340/380 ratio
+        :param smooth:  ndarray, smoothened ratio
+        :param deriv:   ndarray, first derivative of the smoothened ratio
+        :param flipped: T/F whether the 340/380 order was swapped
+        :return: True
+        """
+
+        self.ratio = ratio
+        self.smooth = smooth
+        self.deriv = deriv
+        self.ratio_has_been_flipped = bool(flipped)
+        self.ratio_verified = True
 
         return True
 
@@ -131,12 +153,12 @@ class CalciumTrace(object):
 
         import numpy as np
 
-        assert self.deriv != [], 'Derivative of the calcium trace has not been calculated!!'
+        assert self.deriv.size > 0, 'Derivative of the calcium trace has not been calculated!!'
 
         # Check if the median of the derivative is above the tolerance (default 0)
         if np.median(self.deriv) > deriv_median_tol and not self.ratio_verified:
-            # Get reciprocal of every element via list comprehension
-            self.ratio = [1./r for r in self.ratio]
+            # Get reciprocal of every element
+            self.ratio = 1. / self.ratio
             self.ratio_has_been_flipped = True
 
         # If the median is not above the threshold, then verify the ratio is correct.
@@ -148,4 +170,34 @@ class CalciumTrace(object):
         return True
 
 
+def orient_ratios(ratio, size=15, order=3, deriv_median_tol=0):
+    """
+    Decide the 340/380 order of all columns of a sheet at once, following the same reasoning as
+    CalciumTrace.correct_ratio: a correctly ordered trace rises more sharply than it falls, so the median
+    of its derivative is at or below 0. All columns are smoothened in one call, the columns whose median
+    derivative is above the tolerance are flipped, and only those are smoothened a second time.
+
+    :param ratio: ndarray, shape (n, columns), one 340/380 ratio trace per column
+    :param size: int, Savitzky-Golay window size
+    :param order: int, Savitzky-Golay polynomial order
+    :param deriv_median_tol: Tolerance of derivative median above or below 0
+    :return: tuple of (ratio, smooth, deriv, flipped) with flipped a boolean array, one value per column
+    """
+
+    import sg
+    import numpy as np
+
+    # Keep every column contiguous, they are handed out one by one afterwards, in their own float precision
+    ratio = np.asarray(ratio)
+    ratio = np.asfortranarray(ratio, dtype=ratio.dtype if ratio.dtype.kind == 'f' else float)
+
+    smooth, deriv = sg.savitzky_golay(ratio, size, order, axis=0, diff=True)
+    flipped = np.median(deriv, axis=0) > deriv_median_tol
+
+    if flipped.any():
+        ratio = ratio.copy(order='F')
+        ratio[:, flipped] = 1. / ratio[:, flipped]
+        smooth[:, flipped], deriv[:, flipped] = sg.savitzky_golay(ratio[:, flipped], size, order,
+                                                                  axis=0, diff=True)
 
+    return ratio, smooth, deriv, flipped
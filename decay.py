@@ -0,0 +1,101 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+
+
+# Fraction of the decay amplitude (above the end of the tracelet) defining each interval.
+# t10 is the time spent above 90% of the amplitude, t50 above 50% and t90 above 10%.
+DECAY_LEVELS = (('t10', 0.9), ('t50', 0.5), ('t90', 0.1))
+
+
+def decay_times(x, y_sm, starts, ends, interpolate=True):
+    """
+    Calculate the decay intervals of all tracelets of a trace at once.
+    Each tracelet runs from starts[i] up to (not including) ends[i] of the trace. For every level, the interval
+    is the time from the first to the last point of the smoothened tracelet above that level. With interpolation,
+    the interval ends are placed at the level crossings by linear interpolation between neighbouring samples
+    instead of snapping to the samples themselves.
+
+    :param x: array_like, time of the trace
+    :param y_sm: array_like, smoothened ratio of the trace
+    :param starts: array_like of int, first index of each tracelet
+    :param ends: array_like of int, index after the last point of each tracelet
+    :param interpolate: T/F whether to interpolate at the level crossings
+    :return: dict of ndarrays 't10', 't50', 't90', 't100', one value per tracelet, and 'valid', marking the
+        tracelets that have any decay to measure
+    """
+
+    x = np.asarray(x, dtype=float)
+    y_sm = np.asarray(y_sm, dtype=float)
+    starts = np.asarray(starts, dtype=int)
+    ends = np.asarray(ends, dtype=int)
+
+    n = starts.size
+
+    if n == 0:
+        times = dict((name, np.zeros(0)) for name in ('t10', 't50', 't90', 't100'))
+        times['valid'] = np.zeros(0, dtype=bool)
+        return times
+
+    lengths = ends - starts
+    width = lengths.max()
+    rows = np.arange(n)
+
+    # Lay the tracelets out as rows of a padded matrix of indices into the trace
+    offsets = np.arange(width)
+    mask = offsets < lengths[:, None]
+    idx = np.where(mask, starts[:, None] + offsets, 0)
+
+    tx = x[idx]
+    ty = np.where(mask, y_sm[idx], -np.inf)
+
+    y_last = y_sm[ends - 1]
+    y_max = ty.max(axis=1)
+
+    times = {'t100': x[ends - 1] - x[starts]}
+    valid = np.zeros(n, dtype=bool)
+
+    for (name, level) in DECAY_LEVELS:
+        threshold = level * (y_max - y_last) + y_last
+        above = ty > threshold[:, None]
+        has_any = above.any(axis=1)
+
+        first = np.argmax(above, axis=1)
+        last = width - 1 - np.argmax(above[:, ::-1], axis=1)
+
+        t_first = tx[rows, first]
+        t_last = tx[rows, last]
+
+        if interpolate:
+            # Rising crossing between first - 1 and first, if the tracelet does not start above the level
+            before = np.maximum(first - 1, 0)
+            y0, y1 = ty[rows, before], ty[rows, first]
+            cross = has_any & (first > 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                frac = np.where(cross, (threshold - y0) / (y1 - y0), 0.)
+            t_first = np.where(cross, tx[rows, before] + frac * (t_first - tx[rows, before]), t_first)
+
+            # Falling crossing between last and last + 1, if the tracelet does not end above the level
+            after = np.minimum(last + 1, lengths - 1)
+            y0, y1 = ty[rows, last], ty[rows, after]
+            cross = has_any & (last < lengths - 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                frac = np.where(cross, (y0 - threshold) / (y0 - y1), 0.)
+            t_last = np.where(cross, t_last + frac * (tx[rows, after] - t_last), t_last)
+
+        times[name] = t_last - t_first
+
+        # Only tracelets with points above the 90% level are measured, as the lower levels then always have some
+        if name == 't10':
+            valid = has_any
+
+    times['valid'] = valid
+
+    return times
@@ -0,0 +1,75 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import kernels
+
+
+def detect_rises(deriv, y_tol, x_tol):
+    """
+    Find the intervals where the derivative stays above the y tolerance for more than x tolerance points.
+    Runs are located by run-length encoding the boolean mask of the derivative instead of walking it
+    point by point. As in the original scan, an interval only counts once the derivative drops back to or
+    below the y tolerance, so a rise still under way at the very end of the trace is not reported.
+
+    :param deriv: array_like, first derivative of the smoothened trace
+    :param y_tol: float, y tolerance for peak detection
+    :param x_tol: int, x tolerance for peak detection (interval must be longer than this)
+    :return: (rise_starts, rise_ends) int ndarrays of the first and last index of each interval
+    """
+
+    if kernels.enabled():
+        return kernels.detect_rises(deriv, y_tol, x_tol)
+
+    above = np.asarray(deriv) > y_tol
+    n = above.size
+
+    # Edges of every run of True, with the run start inclusive and the run end exclusive
+    padded = np.concatenate(([False], above, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts = edges[0::2]
+    stops = edges[1::2]
+
+    keep = (stops < n) & (stops - starts > x_tol)
+
+    return starts[keep], stops[keep] - 1
+
+
+def detect_rises_columns(deriv, lengths, y_tol, x_tol):
+    """
+    detect_rises for every column of a 2-D derivative at once, e.g. all profiles of a sheet padded to the
+    same length. Each column is treated as if on its own, ending at its length.
+
+    :param deriv: ndarray, shape (samples, columns), first derivatives, NaN past the end of each column
+    :param lengths: array of int, number of derivative values of each column
+    :param y_tol: float, y tolerance for peak detection
+    :param x_tol: int, x tolerance for peak detection (interval must be longer than this)
+    :return: (columns, rise_starts, rise_ends) int ndarrays, one entry per interval in column and index order
+    """
+
+    if kernels.enabled():
+        return kernels.detect_rises_columns(deriv, lengths, y_tol, x_tol)
+
+    deriv = np.asarray(deriv)
+    lengths = np.asarray(lengths, dtype=int)
+
+    with np.errstate(invalid='ignore'):
+        above = (deriv > y_tol) & (np.arange(deriv.shape[0])[:, np.newaxis] < lengths)
+
+    # Edges of every run of True down each column, listed column by column
+    padded = np.zeros((above.shape[0] + 2, above.shape[1]), dtype=bool)
+    padded[1:-1] = above
+    columns, edges = np.nonzero((padded[1:] != padded[:-1]).T)
+    starts = edges[0::2]
+    stops = edges[1::2]
+    columns = columns[0::2]
+
+    keep = (stops < lengths[columns]) & (stops - starts > x_tol)
+
+    return columns[keep], starts[keep], stops[keep] - 1
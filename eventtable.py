@@ -0,0 +1,174 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import csv
+import numpy as np
+
+
+# Numeric fields of one event (rise and the decay tracelet following it), in table order
+EVENT_FIELDS = (('event', int),
+                ('start_time', float),
+                ('end_time', float),
+                ('rise_time', float),
+                ('amplitude', float),
+                ('t10', float),
+                ('t50', float),
+                ('t90', float),
+                ('t100', float),
+                ('k', float),
+                ('tau', float),
+                ('y1', float),
+                ('R2', float),
+                ('fit_success', bool),
+                ('fit_evaluations', int))
+
+# Columns of the written table, identifiers first
+TABLE_FIELDS = ('workbook', 'sheet', 'column') + tuple(name for (name, _) in EVENT_FIELDS)
+
+
+def column_events(median_time, ratio, rise_starts, rise_ends, decay_t, tracelets):
+    """
+    One row per detected rise of a column. The decay attributes and the fit belong to the tracelet from the
+    end of that rise to the start of the next one, so they are missing (NaN, not successful) for the last rise
+    and wherever the tracelet has no decay to measure. The fit (k, tau, y1 and R2) is NaN wherever it failed.
+
+    :param median_time: ndarray time of the trace
+    :param ratio: ndarray ratio of the trace
+    :param rise_starts: array of indices where the trace begins to rise
+    :param rise_ends: array of indices where the trace stops rising
+    :param decay_t: dict of decay times from TraceletSet.decay_times
+    :param tracelets: fitted TraceletSet of the trace
+    :return: dict of ndarrays, one entry per field of EVENT_FIELDS
+    """
+
+    median_time = np.asarray(median_time)
+    ratio = np.asarray(ratio)
+    rise_starts = np.asarray(rise_starts, dtype=int)
+    rise_ends = np.asarray(rise_ends, dtype=int)
+
+    n = rise_starts.size
+    m = len(tracelets)
+
+    table = {'event': np.arange(n),
+             'start_time': median_time[rise_starts].astype(float),
+             'end_time': median_time[rise_ends].astype(float),
+             'rise_time': (median_time[rise_ends] - median_time[rise_starts]).astype(float),
+             'amplitude': ratio[rise_ends].astype(float) - ratio[rise_starts].astype(float)}
+
+    valid = decay_t['valid']
+    for name in ('t10', 't50', 't90', 't100'):
+        table[name] = np.full(n, np.nan)
+        table[name][:m] = np.where(valid, decay_t[name], np.nan)
+
+    # Failed fits keep the placeholders they were created with, which are not results
+    fitted = np.asarray(tracelets.opt_success, dtype=bool)
+    for (name, values) in (('k', tracelets.opt_k), ('tau', tracelets.opt_tau),
+                           ('y1', tracelets.opt_y1), ('R2', tracelets.R2)):
+        table[name] = np.full(n, np.nan)
+        table[name][:m] = np.where(fitted, values, np.nan)
+
+    table['fit_success'] = np.zeros(n, dtype=bool)
+    table['fit_success'][:m] = tracelets.opt_success
+    table['fit_evaluations'] = np.zeros(n, dtype=int)
+    table['fit_evaluations'][:m] = tracelets.opt_nfev
+
+    return table
+
+
+def to_lists(table):
+    """
+    Events of a column as plain lists, e.g. to keep them in the results store
+
+    :param table: dict of ndarrays from column_events
+    :return: dict of lists
+    """
+
+    return dict((name, table[name].tolist()) for (name, _) in EVENT_FIELDS)
+
+
+def from_lists(lists):
+    """
+    Events of a column kept by to_lists
+
+    :param lists: dict of lists
+    :return: dict of ndarrays
+    """
+
+    return dict((name, np.asarray(lists[name], dtype=dtype)) for (name, dtype) in EVENT_FIELDS)
+
+
+def concat(tables, workbook, sheetnames, colnames):
+    """
+    Stack the events of many columns into one table, labelling every row with its workbook, sheet and column
+
+    :param tables: list of dicts from column_events
+    :param workbook: str, workbook name
+    :param sheetnames: list of str, sheet of each table
+    :param colnames: list of str, column of each table
+    :return: dict of ndarrays, one entry per field of TABLE_FIELDS
+    """
+
+    counts = [t['event'].size for t in tables]
+
+    out = {'workbook': np.array([workbook] * sum(counts), dtype=object),
+           'sheet': np.repeat(np.array(sheetnames, dtype=object), counts),
+           'column': np.repeat(np.array(colnames, dtype=object), counts)}
+
+    for (name, dtype) in EVENT_FIELDS:
+        out[name] = np.concatenate([t[name] for t in tables]) if tables else np.zeros(0, dtype=dtype)
+
+    return out
+
+
+def write_table(table, stem, fmt='auto'):
+    """
+    Write the event table as Parquet or Feather if pyarrow is installed, otherwise as CSV
+
+    :param table: dict of ndarrays from concat
+    :param stem: path to the output file without extension
+    :param fmt: 'parquet', 'feather', 'csv', or 'auto' for Parquet when available and CSV otherwise
+    :return: path to the written file
+    """
+
+    if fmt in ('auto', 'parquet', 'feather'):
+        try:
+            import pyarrow as pa
+
+        except ImportError:
+            if fmt != 'auto':
+                raise
+            fmt = 'csv'
+
+        else:
+            arrow_table = pa.table([pa.array(table[name].tolist() if table[name].dtype == object else table[name])
+                                    for name in TABLE_FIELDS],
+                                   names=list(TABLE_FIELDS))
+
+            if fmt == 'feather':
+                import pyarrow.feather as feather
+
+                path = stem + '.feather'
+                feather.write_feather(arrow_table, path)
+
+            else:
+                import pyarrow.parquet as pq
+
+                path = stem + '.parquet'
+                pq.write_table(arrow_table, path, compression='snappy')
+
+            return path
+
+    path = stem + '.csv'
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TABLE_FIELDS)
+        writer.writerows(zip(*[table[name].tolist() for name in TABLE_FIELDS]))
+
+    return path
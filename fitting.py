@@ -0,0 +1,400 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import scipy.optimize
+import models
+
+
+def _prepare(x, y):
+    """
+    Convert a tracelet to float arrays with time measured from the first point
+
+    :param x: array_like time
+    :param y: array_like ratio
+    :return: (t, y) ndarrays
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    assert x.shape == y.shape and x.size > 0, 'Tracelet time and data must be non-empty and of equal length'
+
+    return x - x[0], y
+
+
+def _finish(res):
+    """
+    Attach the residual sum of squares to a least squares result
+
+    :param res: scipy OptimizeResult from least_squares
+    :return: the same result with res.ss added
+    """
+
+    # least_squares reports cost as half the sum of squared residuals
+    res.ss = 2. * res.cost
+
+    return res
+
+
+def fit_zero(x, y, k0=2.):
+    """
+    Zeroth-order, one-parameter fit (k) with the line anchored at the first point
+
+    :param x: array_like time
+    :param y: array_like ratio
+    :param k0: float initial guess of k
+    :return: scipy OptimizeResult, res.x[0] is k, res.ss is the residual sum of squares
+    """
+
+    t, y = _prepare(x, y)
+    y0 = y[0]
+    y1 = y[-1]
+
+    def residuals(para):
+        return models.model_zero(t, para[0], y0, y1) - y
+
+    def jacobian(para):
+        return models.jacobian_zero(t, para[0], y0, y1)
+
+    res = scipy.optimize.least_squares(residuals, np.array([k0], dtype=float), jac=jacobian)
+
+    return _finish(res)
+
+
+def fit_first_fixed(x, y, k0=2.):
+    """
+    First-order, one-parameter fit (k) with the plateau fixed at the last point
+
+    :param x: array_like time
+    :param y: array_like ratio
+    :param k0: float initial guess of k
+    :return: scipy OptimizeResult, res.x[0] is k, res.ss is the residual sum of squares
+    """
+
+    t, y = _prepare(x, y)
+    y0 = y[0]
+    y1 = y[-1]
+
+    def residuals(para):
+        return models.model_first(t, para[0], y0, y1) - y
+
+    def jacobian(para):
+        return models.jacobian_first(t, para[0], y0, y1)[:, :1]
+
+    res = scipy.optimize.least_squares(residuals, np.array([k0], dtype=float), jac=jacobian)
+
+    return _finish(res)
+
+
+def fit_first(x, y, k0=2., y1_0=None, max_nfev=500):
+    """
+    First-order, two-parameter fit (k and plateau y1) with the curve anchored at the first point
+
+    :param x: array_like time
+    :param y: array_like ratio
+    :param k0: float initial guess of k
+    :param y1_0: float initial guess of the plateau, defaults to the last point
+    :param max_nfev: int maximum number of residual evaluations
+    :return: scipy OptimizeResult, res.x is [k, y1], res.ss is the residual sum of squares
+    """
+
+    t, y = _prepare(x, y)
+    y0 = y[0]
+
+    if y1_0 is None:
+        y1_0 = y[-1]
+
+    def residuals(para):
+        return models.model_first(t, para[0], y0, para[1]) - y
+
+    def jacobian(para):
+        return models.jacobian_first(t, para[0], y0, para[1])
+
+    res = scipy.optimize.least_squares(residuals, np.array([k0, y1_0], dtype=float), jac=jacobian,
+                                       max_nfev=max_nfev)
+
+    return _finish(res)
+
+
+def fit_first_varpro(x, y, k0=2., k_bounds=None, maxiter=50, ftol=1e-12, xtol=1e-10):
+    """
+    First-order, two-parameter fit (k and plateau y1) by variable projection. For any k the best plateau is
+    a linear least squares solution in closed form, so only k is searched: Gauss-Newton steps on log k (which
+    keeps k positive) within bounds, on the residuals with the plateau projected out. Falls back to fit_first
+    if the search does not converge inside the bounds; a fallback fit is only successful with a positive k.
+
+    :param x: array_like time
+    :param y: array_like ratio
+    :param k0: float initial guess of k
+    :param k_bounds: (lowest, highest) k searched, defaults to 1e-3 and 1e3 over the time span of the tracelet
+    :param maxiter: int maximum number of Gauss-Newton steps
+    :param ftol: float relative change in sum of squares below which the search is converged
+    :param xtol: float change in log k below which the search is converged
+    :return: scipy OptimizeResult, res.x is [k, y1], res.ss is the residual sum of squares, res.nfev the number
+        of residual evaluations, res.method 'varpro' or 'least_squares' for the fallback
+    """
+
+    t, y = _prepare(x, y)
+    y0 = y[0]
+    d = y - y0
+    span = t[-1]
+
+    def fallback(nfev):
+        res = fit_first(x, y, k0=k0, y1_0=y[-1])
+        res.nfev += nfev
+        res.method = 'least_squares'
+
+        # The unbounded search may end on a k that describes no decay
+        if res.success and not (np.isfinite(res.x[0]) and res.x[0] > 0):
+            res.success = False
+            res.message = 'Rate constant is not positive.'
+
+        return res
+
+    if t.size < 3 or not span > 0:
+        return fallback(0)
+
+    if k_bounds is None:
+        k_bounds = (1e-3 / span, 1e3 / span)
+
+    u_lo, u_hi = np.log(k_bounds[0]), np.log(k_bounds[1])
+
+    def project(u):
+        # Plateau in closed form for this k, and the residuals and their derivative along log k
+        k = np.exp(u)
+        e = np.exp(-t * k)
+        g = 1. - e
+        dg = k * t * e
+        gg = np.dot(g, g)
+        a = np.dot(g, d) / gg
+        da = (np.dot(dg, d) - 2. * a * np.dot(g, dg)) / gg
+        r = a * g - d
+        return r, a * dg + da * g, a
+
+    u = np.clip(np.log(k0) if k0 > 0 else 0., u_lo, u_hi)
+    r, j, a = project(u)
+    ss = np.dot(r, r)
+    nfev = 1
+    converged = False
+
+    for nit in range(1, maxiter + 1):
+        jj = np.dot(j, j)
+        if not jj > 0:
+            break
+
+        # Gauss-Newton step, halved until it improves the fit
+        step = -np.dot(j, r) / jj
+        improved = False
+        for _ in range(30):
+            trial = np.clip(u + step, u_lo, u_hi)
+            trial_r, trial_j, trial_a = project(trial)
+            trial_ss = np.dot(trial_r, trial_r)
+            nfev += 1
+
+            if trial_ss <= ss:
+                improved = True
+                break
+            step /= 2.
+
+        if not improved:
+            # No step along log k improves the fit any more, which is a minimum
+            converged = True
+            break
+
+        small_step = abs(trial - u) <= xtol
+        small_gain = (ss - trial_ss) <= ftol * ss
+
+        u, r, j, a, ss = trial, trial_r, trial_j, trial_a, trial_ss
+
+        if small_step or small_gain:
+            converged = True
+            break
+
+    # A minimum on a bound means the decay is not first-order within the range searched
+    inside = u_lo < u < u_hi
+
+    if not (converged and inside and np.isfinite(ss)):
+        return fallback(nfev)
+
+    k = np.exp(u)
+
+    return scipy.optimize.OptimizeResult(x=np.array([k, y0 + a]), ss=ss, cost=ss / 2., nfev=nfev, nit=nit,
+                                         success=True, status=1, method='varpro',
+                                         message='Variable projection converged.')
+
+
+def pack(xs, ys):
+    """
+    Pack ragged tracelets into zero-padded 2-D arrays with a mask of valid points
+
+    :param xs: list of array_like time, one per tracelet
+    :param ys: list of array_like ratio, one per tracelet
+    :return: (t, y, mask) ndarrays of shape (n tracelets, longest tracelet), time measured from each first point
+    """
+
+    assert len(xs) == len(ys), 'Number of time and data tracelets differ'
+
+    lengths = np.array([len(x) for x in xs], dtype=int)
+    width = lengths.max() if len(lengths) > 0 else 0
+
+    t = np.zeros((len(xs), width))
+    y = np.zeros((len(xs), width))
+    mask = np.arange(width) < lengths[:, None]
+
+    for i, (x_i, y_i) in enumerate(zip(xs, ys)):
+        t_i, y_i = _prepare(x_i, y_i)
+        t[i, :len(t_i)] = t_i
+        y[i, :len(y_i)] = y_i
+
+    return t, y, mask
+
+
+def fit_first_batch(xs, ys, k0=2., y1_0=None, k_bounds=None, maxiter=200, ftol=1e-10, xtol=1e-10, gtol=1e-6,
+                    rcond=1e-10):
+    """
+    First-order, two-parameter fit of many tracelets at once. Every tracelet keeps its own damped
+    Gauss-Newton (Levenberg-Marquardt) iteration, but the 2x2 normal equations of all tracelets are
+    assembled and solved as array operations so the whole set costs one Python loop.
+
+    :param xs: list of array_like time, one per tracelet
+    :param ys: list of array_like ratio, one per tracelet
+    :param k0: float or ndarray initial guess of k
+    :param y1_0: float or ndarray initial guess of the plateau, defaults to the last point of each tracelet
+    :param k_bounds: (lowest, highest) k searched, over the time span of each tracelet; defaults to (1e-3, 1e3)
+        as in fit_first_varpro
+    :param maxiter: int maximum number of iterations
+    :param ftol: float relative change in sum of squares below which a tracelet is converged
+    :param xtol: float relative change in parameters below which a tracelet is converged
+    :param gtol: float cosine between the residuals and either Jacobian column below which the gradient is small
+    :param rcond: float reciprocal condition of the normal equations below which k and y1 are not determined
+    :return: scipy OptimizeResult with per-tracelet arrays k, y1, tau, ss, R2, success, nit and nfev (residual
+        evaluations, one per iteration plus the first, as counted by the other fits). success is
+        True only for tracelets that converged, with a small gradient and well-conditioned normal equations,
+        to a k inside the bounds and a fit better than the mean (R2 >= 0).
+    """
+
+    t, y, mask = pack(xs, ys)
+    n = t.shape[0]
+    lengths = mask.sum(axis=1)
+    rows = np.arange(n)
+
+    if k_bounds is None:
+        k_bounds = (1e-3, 1e3)
+
+    # A tracelet of a single time point is never fitted, and leaves k unbounded
+    span = t[rows, lengths - 1] if n > 0 else np.zeros(0)
+    with np.errstate(divide='ignore'):
+        k_lo = np.where(span > 0, k_bounds[0] / span, 0.)
+        k_hi = np.where(span > 0, k_bounds[1] / span, np.inf)
+
+    y0 = y[:, 0] if n > 0 else np.zeros(0)
+    k = np.broadcast_to(np.asarray(k0, dtype=float), (n,)).copy()
+    if y1_0 is None:
+        y1 = y[rows, lengths - 1] if n > 0 else np.zeros(0)
+    else:
+        y1 = np.broadcast_to(np.asarray(y1_0, dtype=float), (n,)).copy()
+
+    k = np.clip(k, k_lo, k_hi)
+
+    def evaluate(idx, k, y1):
+        # k is positive, so the exponentials stay within (0, 1]; a diverging plateau step may still overflow the
+        # squares to inf, which is then rejected as no improvement
+        e = np.exp(-t[idx] * k[:, None]) * mask[idx]
+        r = (y0[idx, None] + (y1 - y0[idx])[:, None] * (mask[idx] - e) - y[idx]) * mask[idx]
+        with np.errstate(over='ignore', invalid='ignore'):
+            return e, r, np.sum(r ** 2, axis=1)
+
+    e, r, ss = evaluate(rows, k, y1)
+    ss_start = ss.copy()
+    sst = np.sum(((y - (np.sum(y * mask, axis=1) / np.maximum(lengths, 1))[:, None]) * mask) ** 2, axis=1)
+
+    lam = np.full(n, 1e-3)
+    active = span > 0
+    converged_all = np.zeros(n, dtype=bool)
+    nit = np.zeros(n, dtype=int)
+
+    for it in range(maxiter):
+        # Only the tracelets that have not converged yet take part in the next iteration
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+
+        k_a, y1_a, e_a, r_a, ss_a, lam_a = k[idx], y1[idx], e[idx], r[idx], ss[idx], lam[idx]
+
+        # Jacobian columns with respect to k and y1
+        j_k = (y1_a - y0[idx])[:, None] * t[idx] * e_a
+        j_y = mask[idx] - e_a
+
+        a_kk = np.sum(j_k ** 2, axis=1)
+        a_ky = np.sum(j_k * j_y, axis=1)
+        a_yy = np.sum(j_y ** 2, axis=1)
+        g_k = np.sum(j_k * r_a, axis=1)
+        g_y = np.sum(j_y * r_a, axis=1)
+
+        # Damped normal equations, solved in closed form for every tracelet
+        d_kk = a_kk * (1. + lam_a)
+        d_yy = a_yy * (1. + lam_a)
+        det = d_kk * d_yy - a_ky ** 2
+        full_rank = det > 0
+        solvable = full_rank | (d_kk > 0) | (d_yy > 0)
+
+        # Rank-deficient systems (e.g. plateau equal to the first point) fall back to diagonal steps
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step_k = np.where(full_rank, -(d_yy * g_k - a_ky * g_y) / det,
+                              np.where(d_kk > 0, -g_k / d_kk, 0.))
+            step_y = np.where(full_rank, -(d_kk * g_y - a_ky * g_k) / det,
+                              np.where(d_yy > 0, -g_y / d_yy, 0.))
+
+            # Undamped, relative tests: k and y1 are determined only if the Jacobian columns are not nearly
+            # parallel, and the fit is at a minimum only if the residuals are nearly orthogonal to both
+            conditioned = (a_kk * a_yy - a_ky ** 2) > rcond * a_kk * a_yy
+            small_grad = ((np.abs(g_k) <= gtol * np.sqrt(a_kk * ss_a)) &
+                          (np.abs(g_y) <= gtol * np.sqrt(a_yy * ss_a))) | (ss_a <= 1e-24 * sst[idx])
+
+        # Steps stay within the bounds of k
+        trial_k = np.clip(k_a + step_k, k_lo[idx], k_hi[idx])
+        trial_y1 = y1_a + step_y
+        trial_e, trial_r, trial_ss = evaluate(idx, trial_k, trial_y1)
+
+        accept = solvable & np.isfinite(trial_ss) & (trial_ss <= ss_a)
+        nit[idx] += 1
+
+        small_step = (np.abs(trial_k - k_a) <= xtol * (np.abs(k_a) + xtol)) & \
+                     (np.abs(step_y) <= xtol * (np.abs(y1_a) + xtol))
+        small_gain = (ss_a - trial_ss) <= ftol * ss_a
+
+        # A tracelet has converged once an accepted step no longer improves it and the gradient is small; a tiny
+        # gain alone may only mean that heavy damping keeps the steps short. One whose system cannot be solved,
+        # whose damping has grown so large that no step improves it, or that settles at a bound of k or where k
+        # and y1 are not determined, stops without converging.
+        settled = accept & (small_step | small_gain)
+        converged = settled & small_grad & conditioned
+        at_bound = (trial_k <= k_lo[idx]) | (trial_k >= k_hi[idx])
+        stuck = ~solvable | (lam_a > 1e12) | (settled & (at_bound | ~conditioned))
+
+        k[idx] = np.where(accept, trial_k, k_a)
+        y1[idx] = np.where(accept, trial_y1, y1_a)
+        e[idx] = np.where(accept[:, None], trial_e, e_a)
+        r[idx] = np.where(accept[:, None], trial_r, r_a)
+        ss[idx] = np.where(accept, trial_ss, ss_a)
+        lam[idx] = np.where(accept, lam_a / 3., lam_a * 2.)
+
+        converged_all[idx] = converged
+        active[idx] = ~(converged | stuck)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = 1. / k
+        R2 = 1. - ss / sst
+
+    # A k on its bound means the decay is not first-order within the range searched, and a fit worse than the
+    # mean of the tracelet, or than its starting point, describes nothing
+    success = converged_all & np.isfinite(k) & (k > k_lo) & (k < k_hi) & (R2 >= 0) & (ss <= ss_start)
+
+    return scipy.optimize.OptimizeResult(k=k, y1=y1, tau=tau, ss=ss, R2=R2, success=success, nit=nit, nfev=nit + 1)
@@ -0,0 +1,201 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import openpyxl as xl
+
+
+class Sheet(object):
+    """
+    Object to hold the numeric content of one worksheet.
+    The first row is kept apart as the header, every other cell is stored in a 2-D float array
+    (one column per spreadsheet column) with NaN wherever a cell is empty or not a number.
+
+    """
+
+    def __init__(self, name, header, data, exact=None):
+        """
+
+        :param name:    Sheet name
+        :param header:  list of the first-row values, one per column
+        :param data:    ndarray, shape (rows, columns), excluding the header row
+        :param exact:   dict of float64 ndarrays keyed by column index, for columns kept in full precision when
+                        data is held in a reduced precision
+        """
+
+        self.name = name
+        self.header = header
+        self.data = data
+        self.exact = exact if exact is not None else {}
+
+    def __str__(self):
+        """
+        Printing class information.
+
+        :return: Printed class information
+        """
+        return ('Sheet ' + self.name + ' with ' + str(self.data.shape[0]) + ' rows and ' +
+                str(self.data.shape[1]) + ' columns.')
+
+    def column(self, i, dropna=False):
+        """
+        Get one column of data (without header)
+
+        :param i:       int, column index
+        :param dropna:  T/F whether to leave out empty cells
+        :return: ndarray
+        """
+
+        col = self.exact[i] if i in self.exact else self.data[:, i]
+
+        if dropna:
+            col = col[~np.isnan(col)]
+
+        return col
+
+
+def _iter_values(sheet):
+    """
+    Iterate over the rows of a worksheet as tuples of cell values, without keeping cell objects around
+
+    :param sheet: openpyxl worksheet
+    :return: generator of tuples
+    """
+
+    try:
+        rows = sheet.iter_rows(values_only=True)
+
+    # Older openpyxl versions do not have values_only, take each value as the row streams by
+    except TypeError:
+        rows = (tuple(cell.value for cell in row) for row in sheet.iter_rows())
+
+    return rows
+
+
+def _as_float(value):
+    """
+    Convert one cell value to float, with NaN for empty and non-numeric cells
+
+    :param value: cell value
+    :return: float
+    """
+
+    # bool is a subclass of int but is not a reading
+    if type(value) in (float, int):
+        return value
+
+    return np.nan
+
+
+def read_sheet(sheet, name, dtype=float, exact=()):
+    """
+    Stream one worksheet row by row into a preallocated array of columns
+
+    :param sheet:   openpyxl worksheet, ideally from a read-only workbook
+    :param name:    sheet name
+    :param dtype:   float type of the array, e.g. np.float32 to halve its memory
+    :param exact:   indices of columns also kept in float64 when dtype is reduced, e.g. the time column
+    :return: Sheet object
+    """
+
+    # Only needed where the array itself is less precise than the cells
+    exact = [j for j in exact if np.dtype(dtype) != np.float64]
+
+    rows = _iter_values(sheet)
+
+    try:
+        header = list(next(rows))
+    except StopIteration:
+        return Sheet(name=name, header=[], data=np.zeros((0, 0), dtype=dtype))
+
+    # The dimensions recorded in the file are only a hint, grow the array if they turn out too small
+    n_rows = max((sheet.max_row or 1) - 1, 1)
+    n_cols = max(sheet.max_column or 0, len(header), 1)
+
+    # Column-major storage keeps every data column contiguous for the analysis that follows
+    data = np.full((n_rows, n_cols), np.nan, dtype=dtype, order='F')
+    full = np.full((n_rows, len(exact)), np.nan)
+
+    i = -1
+    last = -1
+    for i, row in enumerate(rows):
+
+        if i >= data.shape[0]:
+            data = np.concatenate((data, np.full(data.shape, np.nan, dtype=dtype, order='F')), axis=0)
+            full = np.concatenate((full, np.full(full.shape, np.nan)), axis=0)
+
+        if len(row) > data.shape[1]:
+            extra = np.full((data.shape[0], len(row) - data.shape[1]), np.nan, dtype=dtype, order='F')
+            data = np.concatenate((data, extra), axis=1)
+
+        values = [_as_float(value) for value in row]
+        data[i, :len(values)] = values
+        for (k, j) in enumerate(exact):
+            if j < len(values):
+                full[i, k] = values[j]
+
+        # Remember the last row holding any value, read-only sheets often report trailing empty rows
+        if any(value == value for value in values):
+            last = i
+
+    data = np.asfortranarray(data[:last + 1])
+    header += [None] * (data.shape[1] - len(header))
+
+    return Sheet(name=name, header=header, data=data,
+                 exact=dict((j, full[:last + 1, k].copy()) for (k, j) in enumerate(exact)))
+
+
+def read_workbook(path, cache_dir=None, dtype=float, exact=()):
+    """
+    Open an Excel workbook in read-only streaming mode and read every sheet into an array.
+    If a cache directory is given, the arrays are taken from the cache when the same file content has
+    been read before, and are written there otherwise.
+
+    :param path: path to the xlsx file
+    :param cache_dir: path to the on-disk cache, or None to always parse the workbook
+    :param dtype: float type of the arrays, e.g. np.float32 to halve their memory
+    :param exact: indices of columns also kept in float64 when dtype is reduced, e.g. the time column
+    :return: generator of Sheet objects, in workbook order
+    """
+
+    if cache_dir is not None:
+        import cache
+
+        digest = cache.file_hash(path)
+
+        # Arrays of other precisions are cached apart, so that a run never gets less precision than it asked for
+        if np.dtype(dtype) != np.float64:
+            digest += '_' + np.dtype(dtype).name + ''.join('_' + str(j) for j in sorted(exact))
+        sheets = cache.load(cache_dir, digest)
+
+        if sheets is not None:
+            for sheet in sheets:
+                yield sheet
+            return
+
+        sheets = []
+
+    xl0 = xl.load_workbook(filename=path, read_only=True, data_only=True)
+
+    try:
+        for sheetname in xl0.sheetnames:
+            sheet = read_sheet(xl0[sheetname], sheetname, dtype=dtype, exact=exact)
+
+            if cache_dir is not None:
+                sheets.append(sheet)
+
+            yield sheet
+
+    finally:
+        # Read-only workbooks keep the file open until closed
+        if hasattr(xl0, 'close'):
+            xl0.close()
+
+    if cache_dir is not None:
+        cache.save(cache_dir, digest, sheets)
@@ -0,0 +1,294 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import os
+import sys
+import time
+import warnings
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Set AUTOCAL_JIT=0 to keep to the NumPy path even where Numba is installed
+JIT_ENV = 'AUTOCAL_JIT'
+
+# None until first asked, then 'checking' while the self-check runs, then 'numba' or 'numpy'
+_backend = None
+
+
+def available():
+    """
+    Whether a JIT compiler is installed and allowed
+
+    :return: T/F
+    """
+
+    return numba is not None and os.environ.get(JIT_ENV, '1') != '0'
+
+
+def enabled():
+    """
+    Whether the compiled kernels are in use. Decided on first call: the kernels are compiled and checked against
+    the NumPy path once per process, and left unused if they do not match.
+
+    :return: T/F
+    """
+
+    global _backend
+
+    if _backend is None:
+        if not available():
+            _backend = 'numpy'
+
+        else:
+            # The reference results are computed while the kernels are still off
+            _backend = 'checking'
+            try:
+                passed = self_check()
+            except Exception as e:
+                warnings.warn('Compiled kernels failed to run (' + repr(e) + '), using NumPy instead.')
+                passed = False
+            _backend = 'numba' if passed else 'numpy'
+
+    return _backend == 'numba'
+
+
+def backend():
+    """
+    Name of the backend in use
+
+    :return: 'numba' or 'numpy'
+    """
+
+    return 'numba' if enabled() else 'numpy'
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _detect_rises(deriv, y_tol, x_tol):
+        n = deriv.size
+        starts = np.empty(n // 2 + 1, dtype=np.int64)
+        ends = np.empty(n // 2 + 1, dtype=np.int64)
+        count = 0
+        run_start = -1
+
+        for i in range(n):
+            if deriv[i] > y_tol:
+                if run_start < 0:
+                    run_start = i
+            elif run_start >= 0:
+                if i - run_start > x_tol:
+                    starts[count] = run_start
+                    ends[count] = i - 1
+                    count += 1
+                run_start = -1
+
+        return starts[:count].copy(), ends[:count].copy()
+
+    @numba.njit(cache=True)
+    def _detect_rises_columns(deriv, lengths, y_tol, x_tol):
+        m = deriv.shape[1]
+        size = 0
+        for j in range(m):
+            size += lengths[j] // 2 + 1
+
+        columns = np.empty(size, dtype=np.int64)
+        starts = np.empty(size, dtype=np.int64)
+        ends = np.empty(size, dtype=np.int64)
+        count = 0
+
+        for j in range(m):
+            run_start = -1
+            for i in range(min(lengths[j], deriv.shape[0])):
+                if deriv[i, j] > y_tol:
+                    if run_start < 0:
+                        run_start = i
+                elif run_start >= 0:
+                    if i - run_start > x_tol:
+                        columns[count] = j
+                        starts[count] = run_start
+                        ends[count] = i - 1
+                        count += 1
+                    run_start = -1
+
+        return columns[:count].copy(), starts[:count].copy(), ends[:count].copy()
+
+    @numba.njit(cache=True)
+    def _head_padding(y, half_window):
+        out = np.empty((half_window, y.shape[1]), dtype=y.dtype)
+        for i in range(half_window):
+            for j in range(y.shape[1]):
+                out[i, j] = y[0, j] - abs(y[half_window - i, j] - y[0, j])
+        return out
+
+    @numba.njit(cache=True)
+    def _tail_padding(y, half_window):
+        n = y.shape[0]
+        out = np.empty((half_window, y.shape[1]), dtype=y.dtype)
+        for i in range(half_window):
+            for j in range(y.shape[1]):
+                out[i, j] = y[n - 1, j] + abs(y[n - 2 - i, j] - y[n - 1, j])
+        return out
+
+
+def _floating(a):
+    """
+    Contiguous array in its own float precision, or in float64 if it is not a float array
+
+    :param a: array_like
+    :return: ndarray
+    """
+
+    a = np.ascontiguousarray(a)
+
+    return a if a.dtype in (np.float32, np.float64) else a.astype(float)
+
+
+def detect_rises(deriv, y_tol, x_tol):
+    """
+    Compiled events.detect_rises
+
+    :param deriv: array_like, first derivative of the smoothened trace
+    :param y_tol: float, y tolerance for peak detection
+    :param x_tol: int, x tolerance for peak detection (interval must be longer than this)
+    :return: (rise_starts, rise_ends) int ndarrays of the first and last index of each interval
+    """
+
+    deriv = _floating(deriv).ravel()
+
+    # Compared in the precision of the derivative, as NumPy does
+    return _detect_rises(deriv, deriv.dtype.type(y_tol), int(x_tol))
+
+
+def detect_rises_columns(deriv, lengths, y_tol, x_tol):
+    """
+    Compiled events.detect_rises_columns
+
+    :param deriv: ndarray, shape (samples, columns), first derivatives, NaN past the end of each column
+    :param lengths: array of int, number of derivative values of each column
+    :param y_tol: float, y tolerance for peak detection
+    :param x_tol: int, x tolerance for peak detection (interval must be longer than this)
+    :return: (columns, rise_starts, rise_ends) int ndarrays, one entry per interval in column and index order
+    """
+
+    deriv = _floating(deriv)
+
+    return _detect_rises_columns(deriv, np.asarray(lengths, dtype=np.int64), deriv.dtype.type(y_tol), int(x_tol))
+
+
+def head_padding(y, half_window):
+    """
+    Compiled sg.head_padding
+
+    :param y: ndarray, signal along the first axis, at least half_window + 1 long
+    :param half_window: int, half the window size
+    :return: ndarray, half_window values along the first axis
+    """
+
+    y = _floating(y)
+
+    return _head_padding(y.reshape(y.shape[0], -1), int(half_window)).reshape((half_window,) + y.shape[1:])
+
+
+def tail_padding(y, half_window):
+    """
+    Compiled sg.tail_padding
+
+    :param y: ndarray, signal along the first axis, at least half_window + 1 long
+    :param half_window: int, half the window size
+    :return: ndarray, half_window values along the first axis
+    """
+
+    y = _floating(y)
+
+    return _tail_padding(y.reshape(y.shape[0], -1), int(half_window)).reshape((half_window,) + y.shape[1:])
+
+
+def self_check(seed=0):
+    """
+    Compare every compiled kernel with its NumPy counterpart on random data. Run with the kernels switched
+    off (as enabled() does), so that the counterparts take their NumPy path.
+
+    :param seed: int, random seed
+    :return: T/F whether all results match
+    """
+
+    import events
+    import sg
+
+    rng = np.random.RandomState(seed)
+    mismatches = []
+
+    # Derivative-like data with runs above the tolerance, a run still going at the end, and empty cells
+    deriv = np.sin(np.linspace(0, 60, 5000)) + rng.normal(0, 0.3, 5000)
+    deriv[100:110] = np.nan
+    lengths = np.array([5000, 3000, 17, 1, 4000])
+    columns = np.full((5000, lengths.size), np.nan)
+    for (j, n) in enumerate(lengths):
+        columns[:n, j] = np.roll(deriv, 37 * j)[:n]
+
+    # Both in double and in single precision (--dtype float32)
+    for dtype in (np.float64, np.float32):
+        d, c = deriv.astype(dtype), columns.astype(dtype)
+
+        for (expected, got, name) in ((events.detect_rises(d, 0.5, 5), detect_rises(d, 0.5, 5), 'detect_rises'),
+                                      (events.detect_rises_columns(c, lengths, 0.5, 5),
+                                       detect_rises_columns(c, lengths, 0.5, 5), 'detect_rises_columns')):
+            if not all(np.array_equal(e, g) for (e, g) in zip(expected, got)):
+                mismatches.append(name + ' in ' + np.dtype(dtype).name)
+
+        for y in (rng.normal(0, 1, 200).astype(dtype), rng.normal(0, 1, (200, 7)).astype(dtype)):
+            expected = (sg.head_padding(y, 6), sg.tail_padding(y, 6))
+            got = (head_padding(y, 6), tail_padding(y, 6))
+            if not all(e.dtype == g.dtype and np.array_equal(e, g) for (e, g) in zip(expected, got)):
+                mismatches.append('padding of ' + str(y.ndim) + '-D signals in ' + np.dtype(dtype).name)
+
+    if mismatches:
+        warnings.warn('Compiled kernels do not match the NumPy path (' + ', '.join(mismatches) +
+                      '), using NumPy instead.')
+
+    return not mismatches
+
+
+#
+# Compile, check and time the kernels against the NumPy path
+#
+
+if __name__ == "__main__":
+
+    # The pipeline modules see this module under its own name, not as __main__
+    import kernels
+    import events
+
+    if not kernels.available():
+        print('Numba is not installed or ' + JIT_ENV + '=0, the NumPy path is used.')
+        sys.exit(0)
+
+    start = time.perf_counter()
+    ok = kernels.enabled()
+    print('backend: ' + kernels.backend() + ', compiled and checked in ' +
+          '%.2f' % (time.perf_counter() - start) + ' s')
+
+    if ok:
+        deriv = np.sin(np.linspace(0, 6000, 1000000)) + np.random.RandomState(1).normal(0, 0.3, 1000000)
+
+        # Time the same call through both backends
+        for name in ('numba', 'numpy'):
+            kernels._backend = name
+            start = time.perf_counter()
+            for _ in range(10):
+                events.detect_rises(deriv, 0.5, 5)
+            print('detect_rises, 1e6 samples, ' + name + ': ' + '%.4f' % ((time.perf_counter() - start) / 10) + ' s')
+
+    sys.exit(0 if ok else 1)
@@ -8,15 +8,229 @@ lau1@stanford.edu
 """
 
 
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-import matplotlib.patches as pch
-import openpyxl as xl
-import caltrace, tracecol, tracelet, models
+import caltrace, tracecol, tracelet, ingest, render, events
 import os, sys, argparse
+import cache, profiling, batch, store, eventtable, precision
+import concurrent.futures
 import numpy as np
 
-def parsefile(args):
+
+# Savitzky-Golay window and order used to smoothen the ratios, and the kinetic model fitted to the tracelets
+SG_WINDOW = 15
+SG_ORDER = 3
+FIT_MODEL = 2
+
+
+def analysis_params(args):
+    """
+    Every parameter that changes the results of a column, as kept alongside its results in the store
+
+    :param args: parsed arguments
+    :return: dict
+    """
+
+    params = {'x_tol': args.x_tol,
+              'y_tol': args.y_tol,
+              'cor_bg': args.cor_bg,
+              'bg': args.bg,
+              'sg_window': SG_WINDOW,
+              'sg_order': SG_ORDER,
+              'model': FIT_MODEL,
+              'batch_fit': args.batch_fit,
+              'warm_start': not args.cold_start,
+              'interpolate': not args.no_interp}
+
+    # Only reduced precision is recorded, so that results kept before the option existed still count
+    if args.dtype != 'float64':
+        params['dtype'] = args.dtype
+
+    return params
+
+
+def column_result(record, colcl, col_events):
+    """
+    The part of a column's analysis kept in the store: its attributes, events, orientation, detected rises
+    and fits
+
+    :param record: dict, column record from make_record
+    :param colcl: TraceCollection of the column
+    :param col_events: dict of ndarrays, event table of the column from eventtable.column_events
+    :return: json-serializable dict
+    """
+
+    return {'flipped': bool(record['flipped']),
+            'attributes': colcl.to_dict(),
+            'events': eventtable.to_lists(col_events),
+            'rise_starts': [int(i) for i in record['rise_starts']],
+            'rise_ends': [int(i) for i in record['rise_ends']],
+            'fits': [dict((name, float(value) if name not in ('start', 'end', 'success') else value)
+                          for (name, value) in fit.items()) for fit in record['fits']]}
+
+
+def make_record(trce, rise_starts, rise_ends, tracelets):
+    """
+    Turn one analyzed and fitted column into a plain record of arrays and numbers,
+    which is all that is needed to plot the column later on
+
+    :param trce: CalciumTrace object
+    :param rise_starts: array of indices where the trace begins to rise
+    :param rise_ends: array of indices where the trace stops rising
+    :param tracelets: TraceletSet of the trace
+    :return: dict
+    """
+
+    fits = []
+    for i in range(len(tracelets)):
+        fits.append({'start': int(tracelets.starts[i]),
+                     'end': int(tracelets.ends[i]),
+                     'success': bool(tracelets.opt_success[i]),
+                     'k': tracelets.opt_k[i],
+                     'y1': tracelets.opt_y1[i],
+                     'tau': tracelets.opt_tau[i],
+                     'R2': tracelets.R2[i]})
+
+    return {'sheetname': trce.sheetname,
+            'colname': trce.colname,
+            'flipped': trce.ratio_has_been_flipped,
+            'median_time': trce.median_time,
+            'ratio': trce.ratio,
+            'smooth': trce.smooth,
+            'deriv': trce.deriv,
+            'rise_starts': list(rise_starts),
+            'rise_ends': list(rise_ends),
+            'fits': fits}
+
+
+def summarize_sheet(sheetname, trcecl, columns):
+    """
+    Count, mean, standard deviation, minimum and maximum of every attribute of a sheet, for the cross-workbook
+    summary
+
+    :param sheetname: sanitized sheet name
+    :param trcecl: TraceCollection of the sheet
+    :param columns: int, number of data columns analyzed
+    :return: dict
+    """
+
+    summary = {'sheet': sheetname, 'columns': columns}
+    summary.update(trcecl.summary())
+
+    # Running statistics without the values, so that sheets can be merged into workbook and batch totals
+    summary['stats'] = trcecl.state()
+
+    return summary
+
+
+def analyze_column(task):
+    """
+    Analyze one data column of a sheet whose ratio has already been smoothened and oriented:
+    detect peaks, calculate rise and decay attributes and fit the tracelets (unless the sheet is batch fitted).
+    Each column is independent of the others, so this runs in a worker process when --jobs is above one.
+
+    :param task: tuple of (CalciumTrace, args)
+    :return: tuple of (CalciumTrace, rise_starts, rise_ends, TraceletSet, dict of decay times,
+        TraceCollection of this column, profiling record of this column)
+    """
+
+    trce, args = task
+
+    # Stage timings are collected here and merged into the sheet's profile by the caller
+    prof = profiling.Profiler(enabled=args.profile)
+
+    # Collect the attributes of this column alone, they are merged into the sheet collection in column order
+    colcl = tracecol.TraceCollection()
+
+    #
+    # Detect peak in each pulse
+    #
+
+    # Peak detection tolerance parameters (these will be specifiable in argparse later).
+    x_tolerance = args.x_tol
+    y_tolerance = args.y_tol
+
+    # Indices where the trace begins to rise, and stops rising
+    with prof.stage('detect'):
+        rise_starts, rise_ends = events.detect_rises(trce.deriv, y_tol=y_tolerance, x_tol=x_tolerance)
+
+    prof.count('events', len(rise_starts))
+
+
+    #
+    # CALCULATE ATTRIBUTES
+    #
+
+    #
+    # Rise times are calculated as the time interval between the start and end of each rise cycles
+    #
+    assert len(rise_starts) == len(rise_ends), 'Check this trace - incorrect number of cycles detected.'
+
+    rise_t = [trce.median_time[rise_ends[i]] - trce.median_time[rise_starts[i]] for i in
+              range(len(rise_starts))]
+
+    colcl.rise_ts += rise_t
+
+    #
+    # Rise amplitudes are the corresponding increase in ratios during the same intervals
+    #
+
+    amplitude = [float(trce.ratio[rise_ends[i]]) - float(trce.ratio[rise_starts[i]]) for i in
+              range(len(rise_starts))]
+
+    colcl.amplitudes += amplitude
+
+
+    # From the first peak (rise_end) to the next trough (rise_start),
+    # Define an interval of the calcium trace and make that into a tracelet for curve-fitting.
+    # The tracelets are views into the trace, kept as offsets only.
+    tracelets = tracelet.TraceletSet(tm=trce.median_time,
+                                     dt=trce.ratio,
+                                     sm=trce.smooth,
+                                     starts=rise_ends[:-1],
+                                     ends=rise_starts[1:])
+
+    #
+    # CALCULATE DECAY ATTRIBUTES FOR ALL TRACELETS OF THE TRACE AT ONCE
+    #
+    with prof.stage('decay'):
+        decay_t = tracelets.decay_times(interpolate=not args.no_interp)
+
+    prof.count('tracelets', len(tracelets))
+
+    colcl.t10s += list(decay_t['t10'][decay_t['valid']])
+    colcl.t50s += list(decay_t['t50'][decay_t['valid']])
+    colcl.t90s += list(decay_t['t90'][decay_t['valid']])
+    colcl.t100s += list(decay_t['t100'][decay_t['valid']])
+
+    #
+    # Do curvefitting for tracelets, unless the whole sheet is fitted in one batch
+    #
+    if not args.batch_fit:
+        with prof.stage('fit'):
+            tracelets.optimize(model=FIT_MODEL, warm=not args.cold_start)
+
+        prof.count('fits', len(tracelets))
+        prof.count('solver_evaluations', int(tracelets.opt_nfev.sum()))
+        colcl.taus += list(tracelets.opt_tau[tracelets.opt_success])
+
+    return trce, rise_starts, rise_ends, tracelets, decay_t, colcl, prof.total
+
+
+def _render_now(fn, *fn_args):
+    """
+    Render a figure right away, standing in for a pool's submit when there is no render pool
+
+    :param fn: rendering function
+    :param fn_args: its arguments
+    :return: completed Future holding the result
+    """
+
+    future = concurrent.futures.Future()
+    future.set_result(fn(*fn_args))
+
+    return future
+
+
+def parsefile(args, tables=None):
     """
     Parse the excel spreadsheet, assuming it is a standard output from the calcium imager,
     Take relevant columns and create trace objects
@@ -24,34 +238,63 @@ def parsefile(args):
     Usage:  python main.py 'data/12-01-16 A slide.xlsx'
     Usage: python main.py 'data/6-27-17 204_test.xlsx'
     :param path:
-    :return:
+    :param tables: list to append the event table of the workbook to, e.g. to compare two runs
+    :return: list of per-sheet summaries, see summarize_sheet
     """
 
 
 
     path = args.path
 
-    # Read the Excel file
-    xl0 = xl.load_workbook(filename=path)
-
-    # Get all the sheets, for each sheet
-    for sheetname in xl0.get_sheet_names():
-
-        # Read the sheet
-        sheet = xl0.get_sheet_by_name(sheetname)
+    # Wall time and counters of each stage, only recorded with --profile
+    prof = profiling.Profiler(enabled=args.profile)
+
+    # Results of columns analyzed before, only kept with --store
+    results = store.ResultStore(args.store) if args.store is not None else None
+    params = analysis_params(args)
+
+    # Spread the per-column work over a pool of processes if more than one job is requested
+    if args.jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+        mapper = executor.map
+    else:
+        executor = None
+        mapper = map
+
+    # Figures are rendered by a separate pool so that analysis does not wait on them
+    render_jobs = args.jobs if args.render_jobs is None else args.render_jobs
+    if render_jobs > 1 and not args.no_plots:
+        render_executor = concurrent.futures.ProcessPoolExecutor(max_workers=render_jobs)
+        render_submit = render_executor.submit
+    else:
+        render_executor = None
+        render_submit = _render_now
+    renders = []
+    summaries = []
+
+    # Events of every column of the run, written as one table at the end
+    event_tables = []
+    event_sheets = []
+    event_columns = []
+
+    # Create directory if not exists
+    os.makedirs(args.out, exist_ok=True)
+
+    # Stream the Excel file in read-only mode, one sheet of numeric columns at a time. The time column (1) is kept
+    # in float64 whatever the precision of the data
+    sheets = ingest.read_workbook(path, cache_dir=args.cache, dtype=args.dtype, exact=(1,))
+    for sheet in prof.iterate('ingest', sheets):
+
+        sheetname = sheet.name
+        prof.begin_sheet(sheetname)
 
         # Start a new trace collection
         trcecl = tracecol.TraceCollection()
 
-        # Within each sheet, get all the columns via the generator
-        cols = []
-        for col in sheet.columns:
-            cols.append(col)
-
         # Specify which columns contain data on the time, background, and data?
         b_cols = args.bg # This should be -1 or 15
         t_cols = 1
-        d_cols = list(range(5, len(cols)))
+        d_cols = list(range(5, sheet.data.shape[1]))
 
         # Remove the background column from the list of data columns
         if args.bg == -1:
@@ -61,304 +304,214 @@ def parsefile(args):
             del d_cols[b_cols - d_cols[0]]
 
 
-        # Get background and time data in the form of lists via list comprehension
-        bck = [cell.value for cell in cols[b_cols]]
-        t = [cell.value for cell in cols[t_cols]]
+        # Get background and time data as array columns
+        bck = sheet.column(b_cols)
+        t = sheet.column(t_cols)
 
-        # Loop through the data columns and for each column make a Trace object
+        # Create one trace object per data column
+        trces = []
         for d_col in d_cols:
-            d = [cell.value for cell in cols[d_col]]
-
-            # Create trace object.
             trce = caltrace.CalciumTrace(sheetname=sheetname,
-                                         colname=d[0],
-                                         tm=t[1:],
-                                         raw_dt=d[1:],
-                                         bg=bck[1:],
+                                         colname=sheet.header[d_col],
+                                         tm=t,
+                                         raw_dt=sheet.column(d_col),
+                                         bg=bck,
+                                         dtype=args.dtype,
                                          )
 
             # If verbose, print the trace via the pretty print function defined in class (not fully implemented).
             if args.verbose:
                 print(trce)
 
+            trces.append(trce)
+
+        # Columns whose figures are drawn, if any
+        if args.no_plots:
+            plotted = set()
+        else:
+            plotted = set(render.sample_records(list(range(len(trces))), args.plot_sample))
+
+        #
+        # Take the results of columns analyzed before with the same data and parameters from the store,
+        # unless their figure is due but missing
+        #
+        keys = [None] * len(trces)
+        stored = [None] * len(trces)
+        if results is not None:
+            shared = store.sheet_digest(t, bck)
+            for i, trce in enumerate(trces):
+                keys[i] = store.column_key(trce.raw_dt, shared, params)
+                result = results.get(keys[i])
+
+                if result is not None and (i not in plotted or
+                                           os.path.isfile(render.column_path(args.out, trce.sheetname,
+                                                                             trce.colname))):
+                    stored[i] = result
+
+        todo = [trce for (trce, result) in zip(trces, stored) if result is None]
+
+        prof.count('columns', len(trces))
+        prof.count('columns_reused', len(trces) - len(todo))
+        prof.count('samples', sum(trce.raw_dt.size // 2 for trce in todo))
+
+        for trce in todo:
             # For the newly created Trace object, create the 340/380 ratio from raw trace data
             # cor_bg controls whether to subtract background
-            trce.make_ratio(correct_background=args.cor_bg)
-
-            while_counter = 1
-            # Smoothen, get derivative, check whether derivative is below 0, if not, flip then smoothen again
-            while not trce.ratio_verified:
-                # Run a low pass filter to smoothen the raw trace, then get the first derivative
-                trce.smoothen(size=15,
-                              order=3,
-                              derivatize=True)
-
-                # If the median of the derivative is above 0 it should mean the trace is rising more often
-                # than it is falling. In which case we will think the 340/380 ratios are flipped.
-                # If the trace initially needs flipping, then correct_ratio()  verifies the trace is good
-                # when run the second time with the flipped trace, this ensures the flipped trace is smoothened
-                # With the same parameters (size, order, etc.)
-                trce.correct_ratio(deriv_median_tol=0)
-                while_counter += 1
-
-                print('Flipping debug counter:' + str(while_counter))
-                if while_counter > 10:
-                    break
-
-
-            #
-            # Detect peak in each pulse
-            #
-
-            # Peak detection tolerance parameters (these will be specifiable in argparse later).
-            x_tolerance = args.x_tol
-            y_tolerance = args.y_tol
-
-            # List of times when the traces begin to rise, and stops rising
-            rise_starts = []
-            rise_ends = []
-            rise_interval = []
-
-            for i in range(len(trce.deriv)):
-
-                # Mark the interval where the differential is above the y-tolerance
-                if trce.deriv[i] > y_tolerance:
-                    rise_interval.append(i)
-
-                # Once the differential drops below the y_tolerance value,
-                # Check if the interval is long enough (> x_tolerance)
-                # If it is, mark the beginning and the end of the interval
-                else:
-                    if len(rise_interval) > x_tolerance:
-                        rise_starts.append(rise_interval[0])
-                        rise_ends.append(rise_interval[-1])
-                    rise_interval = []
-
-
-            #
-            # CALCULATE ATTRIBUTES
-            #
-
-            #
-            # Rise times are calculated as the time interval between the start and end of each rise cycles
-            #
-            assert len(rise_starts) == len(rise_ends), 'Check this trace - incorrect number of cycles detected.'
-
-            rise_t = [trce.median_time[rise_ends[i]] - trce.median_time[rise_starts[i]] for i in
-                      range(len(rise_starts))]
-
-            trcecl.rise_ts += rise_t
-
-            #
-            # Rise amplitudes are the corresponding increase in ratios during the same intervals
-            #
-
-            amplitude = [trce.ratio[rise_ends[i]] - trce.ratio[rise_starts[i]] for i in
-                      range(len(rise_starts))]
-
-            trcecl.amplitudes += amplitude
-
-
-            #
-            # Plot out the figures
-            #
-
-            fig = plt.figure()
-            fig.suptitle('Sheet: ' + trce.sheetname + ' Column: ' + trce.colname, fontsize=14)
-
-            splt = fig.add_subplot(511)
-            splt.plot(trce.median_time, trce.ratio)
-            ttl = pch.Patch(color='red', label='1: raw trace')
-            splt.legend(handles=[ttl], fontsize=6)
-            splt.set_xlabel('t')
-            splt.set_ylabel('ratio')
-
-            # Plot out the smoothened trace
-            splt = fig.add_subplot(512)
-            splt.plot(trce.median_time, trce.smooth)
-            ttl = pch.Patch(color='red', label='2: low pass polynomial filter')
-            splt.legend(handles=[ttl], fontsize=6)
-            # plt.plot([median_time[i] for i in rise_start],
-            #          [smooth[i] for i in rise_start], 'ro')
-            # plt.plot([median_time[i] for i in rise_end],
-            #          [smooth[i] for i in rise_end], 'ro')
-
-            splt = fig.add_subplot(513)
-            # Plot out the differential
-            splt.plot(trce.median_time[1:], trce.deriv)
-            splt.plot([trce.median_time[i] for i in rise_starts],
-                     [trce.deriv[i] for i in rise_starts], 'ro')
-            splt.plot([trce.median_time[i] for i in rise_ends],
-                     [trce.deriv[i] for i in rise_ends], 'ro')
-            ttl = pch.Patch(color='red', label='3: peak detection in derivative')
-            splt.legend(handles=[ttl], fontsize=6)
-
-            splt = fig.add_subplot(514)
-            splt.plot(trce.median_time, trce.ratio)
-            splt.plot([trce.median_time[i] for i in rise_starts],
-                     [trce.ratio[i] for i in rise_starts], 'ro')
-            splt.plot([trce.median_time[i] for i in rise_ends],
-                     [trce.ratio[i] for i in rise_ends], 'ro')
-            ttl = pch.Patch(color='red', label='4: apply peaks to raw')
-            splt.legend(handles=[ttl], fontsize=6)
-
-            splt = fig.add_subplot(515)
-            splt.plot(trce.median_time, trce.ratio)
-            splt.plot([trce.median_time[i] for i in rise_starts],
-                     [trce.ratio[i] for i in rise_starts], 'ro')
-            splt.plot([trce.median_time[i] for i in rise_ends],
-                     [trce.ratio[i] for i in rise_ends], 'ro')
-            ttl = pch.Patch(color='red', label='5: fit kinetic curve')
-            splt.legend(handles=[ttl], fontsize=6)
-
-            # From the first peak (rise_end) to the next trough (rise_start),
-            # Define an interval of the calcium trace and make that into a tracelet object
-            # for curve-fitting
-            tracelet_intervals = [(rise_ends[i], rise_starts[i + 1]) for i in range(len(rise_ends) - 1)]
-
-            for (start, end) in tracelet_intervals:
-                print(trce.smooth[range(start, end)])
-                trcelt = tracelet.Tracelet(tm=trce.median_time[start:end],
-                                           dt=trce.ratio[start:end],
-                                           sm=trce.smooth[start:end])
-
-
-                #
-                # CALCULATE DECAY ATTRIBUTES FOR TRACELETS
-                # (Can probably also do this at the trace level but code seems longer)
-                #
-
-                ratio_at_90pct = (0.9 * (np.max(trcelt.y_sm)-trcelt.y_sm[-1])) + trcelt.y_sm[-1]
-                ratio_at_50pct = (0.5 * (np.max(trcelt.y_sm) - trcelt.y_sm[-1])) + trcelt.y_sm[-1]
-                ratio_at_10pct = (0.1 * (np.max(trcelt.y_sm) - trcelt.y_sm[-1])) + trcelt.y_sm[-1]
-
-                interval_t10 = [trcelt.x[i] for i in range(len(trcelt.x)) if trcelt.y_sm[i] > ratio_at_90pct]
-                interval_t50 = [trcelt.x[i] for i in range(len(trcelt.x)) if trcelt.y_sm[i] > ratio_at_50pct]
-                interval_t90 = [trcelt.x[i] for i in range(len(trcelt.x)) if trcelt.y_sm[i] > ratio_at_10pct]
-
-                try:
-                    trcecl.t10s += [interval_t10[-1]-interval_t10[0]]
-                    trcecl.t50s += [interval_t50[-1] - interval_t50[0]]
-                    trcecl.t90s += [interval_t90[-1] - interval_t90[0]]
-                    trcecl.t100s += [trcelt.x[-1] - trcelt.x[0]]
-
-                except IndexError:
-                    pass
-
-                #
-                # Do curvefitting for tracelet
-                #
-                trcelt.optimize(model=2)
-
-                if trcelt.opt_success:
-
-                    splt.plot(trcelt.x, trcelt.y, color='purple')
-                    splt.plot(trcelt.x,
-                              #[models.model_zero(x - trcelt.x[0], trcelt.opt_k, trcelt.y[0], trcelt.y[-1]) for x in trcelt.x],
-                              [models.model_first(x - trcelt.x[0], trcelt.opt_k, trcelt.y[0], trcelt.opt_y1) for x in
-                               trcelt.x],
-                              color='green')
-                    splt.text(trcelt.x[0],
-                              trcelt.y[0],
-                              'k:' + (str(trcelt.opt_k))[:5] + '\n' +
-                              'tau:' + (str(trcelt.opt_tau))[:5] + '\n' +
-                              'R2:' + (str(trcelt.R2))[:5],
-                              color='red',
-                              fontsize=5)
-
-                    trcecl.taus += [trcelt.opt_tau]
-
-
-            # Save the picutre and then close the plot.
-
-            # Create directory if not exists
-            os.makedirs(args.out, exist_ok=True)
-            save_path = os.path.join(args.out, trce.sheetname + trce.colname + '.png')
-            fig.savefig(save_path, dpi=300)
-            plt.close()
-
-        num_bins = 10
-        fig = plt.figure()
-        fig.suptitle(trce.sheetname, fontsize=14)
-
-        splt = fig.add_subplot(321)
-        n, bins, patches = plt.hist(trcecl.rise_ts, num_bins, normed=1, facecolor='blue', alpha=0.5)
-        y = mlab.normpdf(bins, np.mean(trcecl.rise_ts), np.std(trcecl.rise_ts))
-        splt.plot(bins, y, 'r--')
-        ttl = pch.Patch(color='red', label='Rise time \n mean:' +\
-                                           str(np.round(np.mean(trcecl.rise_ts), 2)) + '\n sd:' +\
-                                           str(np.round(np.std(trcecl.rise_ts), 2)))
-        splt.legend(handles=[ttl], fontsize=6)
-
-        splt = fig.add_subplot(322)
-        n, bins, patches = plt.hist(trcecl.t10s, num_bins, normed=1, facecolor='blue', alpha=0.5)
-        y = mlab.normpdf(bins, np.mean(trcecl.t10s), np.std(trcecl.t10s))
-        splt.plot(bins, y, 'r--')
-        ttl = pch.Patch(color='red', label='T10 \n mean:' + \
-                                           str(np.round(np.mean(trcecl.t10s), 2)) + '\n sd:' + \
-                                           str(np.round(np.std(trcecl.t10s), 2)))
-        splt.legend(handles=[ttl], fontsize=6)
-
-        splt = fig.add_subplot(323)
-        n, bins, patches = plt.hist(trcecl.t50s, num_bins, normed=1, facecolor='blue', alpha=0.5)
-        y = mlab.normpdf(bins, np.mean(trcecl.t50s), np.std(trcecl.t50s))
-        splt.plot(bins, y, 'r--')
-        ttl = pch.Patch(color='red', label='T50 \n mean:' + \
-                                           str(np.round(np.mean(trcecl.t50s), 2)) + '\n sd:' + \
-                                           str(np.round(np.std(trcecl.t50s), 2)))
-        splt.legend(handles=[ttl], fontsize=6)
-
-        splt = fig.add_subplot(324)
-        n, bins, patches = plt.hist(trcecl.t90s, num_bins, normed=1, facecolor='blue', alpha=0.5)
-        y = mlab.normpdf(bins, np.mean(trcecl.t90s), np.std(trcecl.t90s))
-        splt.plot(bins, y, 'r--')
-        ttl = pch.Patch(color='red', label='T90 \n mean:' + \
-                                           str(np.round(np.mean(trcecl.t90s), 2)) + '\n sd:' + \
-                                           str(np.round(np.std(trcecl.t90s), 2)))
-        splt.legend(handles=[ttl], fontsize=6)
-
-        splt = fig.add_subplot(325)
-        n, bins, patches = plt.hist(trcecl.amplitudes, num_bins, normed=1, facecolor='blue', alpha=0.5)
-        y = mlab.normpdf(bins, np.mean(trcecl.amplitudes), np.std(trcecl.amplitudes))
-        splt.plot(bins, y, 'r--')
-        ttl = pch.Patch(color='red', label='Amplitude \n mean:' + \
-                                           str(np.round(np.mean(trcecl.amplitudes), 2)) + '\n sd:' + \
-                                           str(np.round(np.std(trcecl.amplitudes), 2)))
-        splt.legend(handles=[ttl], fontsize=6)
-
-        splt = fig.add_subplot(326)
-        n, bins, patches = plt.hist(trcecl.taus, num_bins, normed=1, facecolor='blue', alpha=0.5)
-        y = mlab.normpdf(bins, np.mean(trcecl.taus), np.std(trcecl.taus))
-        splt.plot(bins, y, 'r--')
-        ttl = pch.Patch(color='red', label='Tau \n mean:' + \
-                                           str(np.round(np.mean(trcecl.taus), 2)) + '\n sd:' + \
-                                           str(np.round(np.std(trcecl.taus), 2)))
-        splt.legend(handles=[ttl], fontsize=6)
-
-        save_path = os.path.join(args.out, trce.sheetname + '_histograms.png')
-        plt.savefig(save_path, dpi=300)
-        plt.close()
+            with prof.stage('ratio'):
+                trce.make_ratio(correct_background=args.cor_bg)
+
+        # Smoothen all ratios together, check the derivative medians and flip the columns whose
+        # 340/380 order is swapped, in one pass over the sheet
+        if todo:
+            with prof.stage('orient'):
+                ratios, smooths, derivs, flipped = caltrace.orient_ratios(np.column_stack([trce.ratio
+                                                                                           for trce in todo]),
+                                                                          size=SG_WINDOW,
+                                                                          order=SG_ORDER,
+                                                                          deriv_median_tol=0)
+
+            for i, trce in enumerate(todo):
+                trce.apply_orientation(ratios[:, i], smooths[:, i], derivs[:, i], flipped[i])
+
+                if args.verbose and flipped[i]:
+                    print('verbosity 1: 340/380 order flipped in sheet: ' + sheetname + ' column: ' + trce.colname)
+
+        # Analyze every column, in a process pool if asked for. Results come back in column order.
+        with prof.stage('analyze'):
+            analyzed = list(mapper(analyze_column, [(trce, args) for trce in todo]))
+
+        for (_, _, _, _, _, _, col_prof) in analyzed:
+            prof.merge(col_prof)
+
+        #
+        # Fit every tracelet of the sheet together in one vectorized solver call
+        #
+        if args.batch_fit:
+            with prof.stage('fit'):
+                tracelet.optimize_batch([tracelets for (_, _, _, tracelets, _, _, _) in analyzed],
+                                        warm=not args.cold_start)
+
+            for (_, _, _, tracelets, _, colcl, _) in analyzed:
+                colcl.taus += list(tracelets.opt_tau[tracelets.opt_success])
+                prof.count('fits', len(tracelets))
+                prof.count('solver_evaluations', int(tracelets.opt_nfev.sum()))
+
+        #
+        # Reduce the analysis to plain records, figures are drawn from these alone, and merge the
+        # attributes of new and stored columns in column order
+        #
+        records = []
+        analyzed = iter(analyzed)
+        for i, trce in enumerate(trces):
+            if stored[i] is None:
+                _, rise_starts, rise_ends, tracelets, decay_t, colcl, _ = next(analyzed)
+                record = make_record(trce, rise_starts, rise_ends, tracelets)
+                col_events = eventtable.column_events(trce.median_time, trce.ratio, rise_starts, rise_ends,
+                                                      decay_t, tracelets)
+
+                if results is not None:
+                    results.put(keys[i], trce.sheetname, trce.colname, column_result(record, colcl, col_events))
+
+            else:
+                colcl = tracecol.TraceCollection()
+                colcl.load(stored[i]['attributes'])
+                col_events = eventtable.from_lists(stored[i]['events'])
+                record = {'sheetname': trce.sheetname,
+                          'colname': trce.colname,
+                          'flipped': stored[i]['flipped'],
+                          'stored': True}
+
+            trcecl.extend(colcl)
+            records.append(record)
+
+            event_tables.append(col_events)
+            event_sheets.append(trce.sheetname)
+            event_columns.append(trce.colname)
+
+        if results is not None:
+            results.commit()
+
+        # Sheet name as sanitized by the traces, used for the output file names
+        safe_name = records[-1]['sheetname']
+
+        #
+        # Hand the figures to the renderer, they are drawn while the next sheet is analyzed.
+        # Figures of stored columns are already on disk.
+        #
+        if not args.no_plots:
+            with prof.stage('render'):
+                for i in sorted(plotted):
+                    if stored[i] is None:
+                        renders.append(render_submit(render.render_column, records[i], args.out, args.dpi))
+
+            renders.append(render_submit(render.render_histograms, safe_name, trcecl, args.out, args.dpi))
 
         #
         # Save all distances as CSV
         #
-        csv_path = os.path.join(args.out, trce.sheetname + '_risetime.csv')
-        np.savetxt(csv_path, np.array(trcecl.rise_ts), fmt='%.3f', delimiter=",")
+        written = []
+        with prof.stage('csv'):
+            for (suffix, values) in (('_risetime', trcecl.rise_ts),
+                                     ('_t10', trcecl.t10s),
+                                     ('_t50', trcecl.t50s),
+                                     ('_t90', trcecl.t90s),
+                                     ('_amplitude', trcecl.amplitudes),
+                                     ('_tau', trcecl.taus)):
+                csv_path = os.path.join(args.out, safe_name + suffix + '.csv')
+                np.savetxt(csv_path, values.values(), fmt='%.3f', delimiter=",")
+                written.append(csv_path)
+
+            # Record which columns had their 340/380 order flipped, for auditing
+            csv_path = os.path.join(args.out, safe_name + '_orientation.csv')
+            with open(csv_path, 'w') as f:
+                f.write('column,flipped\n')
+                for record in records:
+                    f.write(record['colname'] + ',' + str(int(record['flipped'])) + '\n')
+            written.append(csv_path)
+
+        summaries.append(summarize_sheet(safe_name, trcecl, len(records)))
+
+        if args.profile:
+            prof.count('bytes_written', sum(os.path.getsize(csv_path) for csv_path in written))
+            prof.end_sheet(args.out, safe_name)
+
+    if executor is not None:
+        executor.shutdown()
+
+    #
+    # Save one row per event of the whole workbook
+    #
+    with prof.stage('events'):
+        table = eventtable.concat(event_tables,
+                                  os.path.splitext(os.path.basename(path))[0],
+                                  event_sheets,
+                                  event_columns)
+        events_path = eventtable.write_table(table, os.path.join(args.out, 'events'), fmt=args.events_format)
 
-        csv_path = os.path.join(args.out, trce.sheetname + '_t10.csv')
-        np.savetxt(csv_path, np.array(trcecl.t10s), fmt='%.3f', delimiter=",")
+    if tables is not None:
+        tables.append(table)
 
-        csv_path = os.path.join(args.out, trce.sheetname + '_t50.csv')
-        np.savetxt(csv_path, np.array(trcecl.t50s), fmt='%.3f', delimiter=",")
+    if args.profile:
+        prof.count('bytes_written', os.path.getsize(events_path))
 
-        csv_path = os.path.join(args.out, trce.sheetname + '_t90.csv')
-        np.savetxt(csv_path, np.array(trcecl.t90s), fmt='%.3f', delimiter=",")
+    if results is not None:
+        results.close()
 
-        csv_path = os.path.join(args.out, trce.sheetname + '_amplitude.csv')
-        np.savetxt(csv_path, np.array(trcecl.amplitudes), fmt='%.3f', delimiter=",")
+    # Wait for the remaining figures, raising any error that happened while drawing them
+    with prof.stage('render_wait'):
+        for future in renders:
+            save_path = future.result()
+            if args.profile:
+                prof.count('figures')
+                prof.count('bytes_written', os.path.getsize(save_path))
 
-        csv_path = os.path.join(args.out, trce.sheetname + '_tau.csv')
-        np.savetxt(csv_path, np.array(trcecl.taus), fmt='%.3f', delimiter=",")
+    if render_executor is not None:
+        render_executor.shutdown()
+
+    if args.profile:
+        print(prof.summary())
+
+    return summaries
 
 
 
@@ -377,7 +530,8 @@ if __name__ == "__main__":
     Edward Lau 2017 - lau1@stanford.edu
     Reads calcium trace data and fits kinetic curves.''')
 
-    parser.add_argument('path', help='path to calcium imaging spreadsheet')
+    parser.add_argument('path', help='path to calcium imaging spreadsheet, or a directory or glob pattern of '
+                                     'spreadsheets to analyze in one batch')
     parser.add_argument('-o', '--out', help='path to output files',
                               default='out')
     parser.add_argument('-x', '--x_tol', help='X tolerance for peak detection (integer).',
@@ -388,6 +542,40 @@ if __name__ == "__main__":
                         action='store_true')
     parser.add_argument('-b', '--bg', help='Index of background column.',
                         type=int, default=-1)
+    parser.add_argument('--batch_fit', action='store_true',
+                        help='fit all tracelets of a sheet together in one vectorized solver call.')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help='precision of the data, ratios, smoothing and detection; float32 halves their memory. '
+                             'Time, fits and statistics stay in float64. (default: float64)')
+    parser.add_argument('--precision_report', action='store_true',
+                        help='with --dtype float32 and a single workbook, analyze it again in float64 and write the '
+                             'largest deviation of every metric to precision_report.csv.')
+    parser.add_argument('--cold_start', action='store_true',
+                        help='start every fit from the same initial guess instead of from the neighbouring fits, '
+                             'e.g. to compare solver evaluations (see --profile).')
+    parser.add_argument('--no_interp', action='store_true',
+                        help='snap t10/t50/t90 to whole samples instead of interpolating at the level crossings.')
+    parser.add_argument('-j', '--jobs', help='number of worker processes for analyzing columns, or whole '
+                                         'workbooks in batch mode (integer).',
+                        type=int, default=1)
+    parser.add_argument('--cache', nargs='?', const=cache.DEFAULT_CACHE_DIR, default=None,
+                        help='reuse parsed workbooks from an on-disk cache (default location: ~/.autocal_cache).')
+    parser.add_argument('--store', nargs='?', const=store.DEFAULT_STORE_PATH, default=None,
+                        help='keep column results in a database and skip columns whose data and parameters have not '
+                             'changed (default location: ~/.autocal_results.sqlite).')
+    parser.add_argument('--events_format', choices=['auto', 'parquet', 'feather', 'csv'], default='auto',
+                        help='format of the table of all events: parquet or feather (needs pyarrow) or csv. '
+                             'auto writes parquet if pyarrow is installed and csv otherwise.')
+    parser.add_argument('--no_plots', action='store_true', help='do not draw any figures, only write the CSV files.')
+    parser.add_argument('--plot_sample', help='draw figures for only this many evenly spaced columns per sheet.',
+                        type=int, default=None)
+    parser.add_argument('--dpi', help='resolution of saved figures (integer).', type=int, default=300)
+    parser.add_argument('--render_jobs', help='number of worker processes for drawing figures, defaults to --jobs.',
+                        type=int, default=None)
+    parser.add_argument('--profile', action='store_true',
+                        help='time each stage and write a profile report per sheet plus a summary at the end.')
+    parser.add_argument('--profile_dump', help='also write cProfile statistics of the whole run to this file.',
+                        default=None)
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose error messages.')
 
     parser.set_defaults(func=parsefile)
@@ -400,5 +588,22 @@ if __name__ == "__main__":
     # Parse all the arguments
     args = parser.parse_args()
 
-    # Run the function in the argument
-    args.func(args)
+    # The precision report compares a reduced-precision run of one workbook against float64
+    if args.precision_report and args.dtype == 'float64':
+        parser.error('--precision_report needs a reduced precision, e.g. --dtype float32.')
+
+    if args.precision_report and batch.is_batch(args.path):
+        parser.error('--precision_report takes a single workbook, not a directory or glob pattern.')
+
+    # A directory or glob pattern runs every workbook in it
+    if batch.is_batch(args.path):
+        args.func = batch.run_batch
+
+    elif args.precision_report:
+        args.func = precision.run_report
+
+    # Run the function in the argument, under cProfile if asked for
+    if args.profile_dump is not None:
+        profiling.run_with_cprofile(args.func, args, args.profile_dump)
+    else:
+        args.func(args)
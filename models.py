@@ -7,29 +7,54 @@ lau1@stanford.edu
 
 """
 
+import numpy as np
+
+
 def model_first(x, k, y0, y1):
     """
     One-compartment first-order exponential decay model
-    :param x:   float time
+    :param x:   float or ndarray time
     :param k:   float rate constant
     :param y0:  float initial value
     :param y1:  float plateau value
-    :return:    value at time point
+    :return:    value at time point(s)
     """
 
-    import math
-    return y0 + (y1 - y0) * (1 - math.exp(-1 * x * k))
+    return y0 + (y1 - y0) * (1 - np.exp(-1 * x * k))
 
 def model_zero(x, k, y0, y1):
     """
-    One-compartment first-order exponential decay model
-    :param x:   float time
+    One-compartment zeroth-order linear decay model
+    :param x:   float or ndarray time
     :param k:   float rate constant
     :param y0:  float initial value
-    :param y1:  float plateau value
-    :return:    value at time point
+    :param y1:  float plateau value (unused, kept for a common signature)
+    :return:    value at time point(s)
     """
 
-    import math
     return y0 - (k * x)
 
+def jacobian_first(x, k, y0, y1):
+    """
+    Partial derivatives of the first-order model with respect to k and y1
+    :param x:   ndarray time
+    :param k:   float rate constant
+    :param y0:  float initial value
+    :param y1:  float plateau value
+    :return:    ndarray, shape (N, 2), columns are d/dk and d/dy1
+    """
+
+    e = np.exp(-1 * x * k)
+    return np.column_stack(((y1 - y0) * x * e, 1 - e))
+
+def jacobian_zero(x, k, y0, y1):
+    """
+    Partial derivative of the zeroth-order model with respect to k
+    :param x:   ndarray time
+    :param k:   float rate constant
+    :param y0:  float initial value
+    :param y1:  float plateau value (unused)
+    :return:    ndarray, shape (N, 1)
+    """
+
+    return -1 * np.asarray(x, dtype=float).reshape(-1, 1)
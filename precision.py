@@ -0,0 +1,134 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import copy
+import csv
+import os
+import tempfile
+import numpy as np
+
+
+REPORT_NAME = 'precision_report.csv'
+
+# Event metrics compared between a reduced-precision run and the float64 reference
+METRICS = ('start_time', 'end_time', 'rise_time', 'amplitude', 't10', 't50', 't90', 't100', 'k', 'tau', 'y1', 'R2')
+
+
+def compare(reduced, reference):
+    """
+    Match the events of two runs of the same workbook by sheet, column and event number, and find how far
+    every metric of the first run is from the second
+
+    :param reduced: dict of ndarrays, event table from eventtable.concat
+    :param reference: dict of ndarrays, event table of the float64 run
+    :return: list of dicts, one per metric plus a first row on the events themselves
+    """
+
+    def keys(table):
+        return list(zip(table['sheet'].tolist(), table['column'].tolist(), table['event'].tolist()))
+
+    reference_index = dict((key, i) for (i, key) in enumerate(keys(reference)))
+    pairs = [(i, reference_index[key]) for (i, key) in enumerate(keys(reduced)) if key in reference_index]
+
+    mine = np.array([i for (i, _) in pairs], dtype=int)
+    theirs = np.array([j for (_, j) in pairs], dtype=int)
+
+    rows = [{'metric': 'events',
+             'compared': len(pairs),
+             'reduced_only': reduced['event'].size - len(pairs),
+             'reference_only': reference['event'].size - len(pairs),
+             'fit_success_differs': int(np.sum(reduced['fit_success'][mine] != reference['fit_success'][theirs]))}]
+
+    for name in METRICS:
+        a = reduced[name][mine].astype(float)
+        b = reference[name][theirs].astype(float)
+        both = np.isfinite(a) & np.isfinite(b)
+        deviation = np.abs(a[both] - b[both])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = deviation / np.abs(b[both])
+
+        rows.append({'metric': name,
+                     'compared': int(both.sum()),
+                     'reduced_only': int(np.sum(np.isfinite(a) & ~np.isfinite(b))),
+                     'reference_only': int(np.sum(~np.isfinite(a) & np.isfinite(b))),
+                     'max_abs_deviation': float(deviation.max()) if deviation.size else None,
+                     'mean_abs_deviation': float(deviation.mean()) if deviation.size else None,
+                     'max_rel_deviation': float(np.nanmax(relative[np.isfinite(relative)]))
+                     if np.isfinite(relative).any() else None})
+
+    return rows
+
+
+def write_report(rows, path):
+    """
+    Write the rows of compare as CSV
+
+    :param rows: list of dicts
+    :param path: path to the report
+    :return: path to the report
+    """
+
+    fields = ['metric', 'compared', 'reduced_only', 'reference_only', 'fit_success_differs',
+              'max_abs_deviation', 'mean_abs_deviation', 'max_rel_deviation']
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    return path
+
+
+def run_report(args):
+    """
+    Analyze a workbook as asked for, then again in float64 into a temporary directory without figures, and
+    report the largest deviation of every event metric of the first run from the second
+
+    :param args: parsed arguments, of a single workbook in a reduced precision
+    :return: list of per-sheet summaries of the first run, see main.parsefile
+    """
+
+    import batch
+    import main
+
+    assert args.dtype != 'float64', 'The precision report compares a reduced precision against float64.'
+    assert not batch.is_batch(args.path), 'The precision report takes a single workbook.'
+
+    tables = []
+    summaries = main.parsefile(args, tables=tables)
+
+    with tempfile.TemporaryDirectory() as out:
+        ref_args = copy.copy(args)
+        ref_args.dtype = 'float64'
+        ref_args.out = out
+        ref_args.no_plots = True
+        ref_args.store = None
+        ref_args.profile = False
+        ref_args.events_format = 'csv'
+
+        reference = []
+        main.parsefile(ref_args, tables=reference)
+
+    rows = compare(tables[0], reference[0])
+    report_path = write_report(rows, os.path.join(args.out, REPORT_NAME))
+
+    print('Deviation of ' + args.dtype + ' from float64, written to ' + report_path)
+    print('{:<12}{:>10}{:>18}{:>18}'.format('metric', 'compared', 'max abs', 'max rel'))
+    for row in rows[1:]:
+        print('{:<12}{:>10}{:>18}{:>18}'.format(row['metric'], row['compared'],
+                                                '-' if row['max_abs_deviation'] is None
+                                                else '%.3g' % row['max_abs_deviation'],
+                                                '-' if row['max_rel_deviation'] is None
+                                                else '%.3g' % row['max_rel_deviation']))
+    print('events compared: ' + str(rows[0]['compared']) + ', only in ' + args.dtype + ': ' +
+          str(rows[0]['reduced_only']) + ', only in float64: ' + str(rows[0]['reference_only']) +
+          ', fit success differs: ' + str(rows[0]['fit_success_differs']))
+
+    return summaries
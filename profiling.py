@@ -0,0 +1,247 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import collections
+import contextlib
+import csv
+import json
+import os
+import time
+
+
+def _new_record(name):
+    """
+    Empty timing record
+
+    :param name: str, sheet name or 'total'
+    :return: dict of name, stages (seconds per stage) and counters
+    """
+
+    return {'name': name, 'stages': collections.OrderedDict(), 'counters': collections.OrderedDict()}
+
+
+class Profiler(object):
+    """
+    Object to collect the wall time of each pipeline stage and a few counters, per sheet and for the whole run.
+    A disabled profiler accepts the same calls and does nothing, so the pipeline can be instrumented
+    unconditionally.
+
+    """
+
+    def __init__(self, enabled=True):
+        """
+
+        :param enabled: T/F whether to record anything
+        """
+
+        self.enabled = enabled
+        self.total = _new_record('total')
+        self.sheets = []
+        self.current = None
+        self._carry = []
+        self.started = time.perf_counter()
+
+    def _records(self):
+        return [self.total] if self.current is None else [self.total, self.current]
+
+    def add_time(self, name, seconds):
+        """
+        Add time to a stage of the current sheet and of the run
+
+        :param name: str, stage name
+        :param seconds: float
+        :return: True
+        """
+
+        if not self.enabled:
+            return True
+
+        for record in self._records():
+            record['stages'][name] = record['stages'].get(name, 0.) + seconds
+
+        return True
+
+    def count(self, name, n=1):
+        """
+        Add to a counter of the current sheet and of the run
+
+        :param name: str, counter name
+        :param n: number to add
+        :return: True
+        """
+
+        if not self.enabled:
+            return True
+
+        for record in self._records():
+            record['counters'][name] = record['counters'].get(name, 0) + n
+
+        return True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as one stage
+
+        :param name: str, stage name
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def iterate(self, name, iterable):
+        """
+        Time every step of an iterator as one stage. The time spent producing an item is booked to the
+        sheet begun right after it, as the sheets come out of the workbook reader.
+
+        :param name: str, stage name
+        :param iterable: iterable
+        :return: generator of the items
+        """
+
+        iterator = iter(iterable)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+
+            if self.enabled:
+                seconds = time.perf_counter() - start
+                self.total['stages'][name] = self.total['stages'].get(name, 0.) + seconds
+                self._carry.append((name, seconds))
+
+            yield item
+
+    def begin_sheet(self, name):
+        """
+        Start recording a new sheet
+
+        :param name: str, sheet name
+        :return: True
+        """
+
+        if not self.enabled:
+            return True
+
+        self.current = _new_record(name)
+        self.sheets.append(self.current)
+
+        for (stage, seconds) in self._carry:
+            self.current['stages'][stage] = self.current['stages'].get(stage, 0.) + seconds
+        self._carry = []
+
+        return True
+
+    def merge(self, record):
+        """
+        Add the stages and counters of a record collected elsewhere, e.g. by a worker process
+
+        :param record: dict, a Profiler's total record
+        :return: True
+        """
+
+        if not self.enabled:
+            return True
+
+        for (name, seconds) in record['stages'].items():
+            self.add_time(name, seconds)
+
+        for (name, n) in record['counters'].items():
+            self.count(name, n)
+
+        return True
+
+    def end_sheet(self, out, prefix):
+        """
+        Finish recording the current sheet and write its record as <prefix>_profile.json and
+        <prefix>_profile.csv. Anything recorded afterwards only counts towards the run.
+
+        :param out: path to output files
+        :param prefix: file name prefix, e.g. the sanitized sheet name
+        :return: True
+        """
+
+        if not self.enabled or self.current is None:
+            return True
+
+        with open(os.path.join(out, prefix + '_profile.json'), 'w') as f:
+            json.dump(self.current, f, indent=1)
+
+        with open(os.path.join(out, prefix + '_profile.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['kind', 'name', 'value'])
+            for (name, seconds) in self.current['stages'].items():
+                writer.writerow(['stage', name, '%.6f' % seconds])
+            for (name, n) in self.current['counters'].items():
+                writer.writerow(['counter', name, n])
+
+        self.current = None
+
+        return True
+
+    def summary(self):
+        """
+        Table of the time of every stage per sheet and in total, followed by the run's counters.
+        Stages timed in worker processes add up the time of all workers, so their share of the wall time
+        can exceed 100% with more than one job.
+
+        :return: str
+        """
+
+        stages = list(self.total['stages'].keys())
+        width = max([len(s) for s in stages + list(self.total['counters'].keys())] + [10]) + 2
+
+        lines = ['{:<{w}}'.format('stage', w=width) +
+                 ''.join('{:>12}'.format(r['name'][:11]) for r in self.sheets) + '{:>12}{:>8}'.format('total', '% wall')]
+
+        run_time = (time.perf_counter() - self.started) or 1.
+
+        for stage in stages:
+            lines.append('{:<{w}}'.format(stage, w=width) +
+                         ''.join('{:>12.3f}'.format(r['stages'].get(stage, 0.)) for r in self.sheets) +
+                         '{:>12.3f}{:>8.1f}'.format(self.total['stages'][stage],
+                                                    100. * self.total['stages'][stage] / run_time))
+
+        for (name, n) in self.total['counters'].items():
+            lines.append('{:<{w}}'.format(name, w=width) +
+                         ''.join('{:>12}'.format(r['counters'].get(name, 0)) for r in self.sheets) +
+                         '{:>12}'.format(n))
+
+        return '\n'.join(lines)
+
+
+def run_with_cprofile(fn, fn_args, path):
+    """
+    Run a function under cProfile and dump the statistics to a file, for use with pstats or snakeviz
+
+    :param fn: function to run
+    :param fn_args: its single argument, e.g. the parsed command line
+    :param path: path to the statistics file
+    :return: the function's return value
+    """
+
+    import cProfile
+
+    prof = cProfile.Profile()
+
+    try:
+        return prof.runcall(fn, fn_args)
+    finally:
+        prof.dump_stats(path)
@@ -0,0 +1,182 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+# Figures are only ever written to file, use the non-interactive backend so that rendering works
+# headless and in worker processes
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import matplotlib.mlab as mlab
+import matplotlib.patches as pch
+import os
+import numpy as np
+import models
+
+
+def sample_records(records, n):
+    """
+    Pick evenly spaced records for plotting, keeping their order
+
+    :param records: list of column records
+    :param n: int, number of records to keep, None to keep all
+    :return: list of records
+    """
+
+    if n is None or n >= len(records):
+        return records
+
+    if n <= 0:
+        return []
+
+    picks = np.unique(np.round(np.linspace(0, len(records) - 1, n)).astype(int))
+
+    return [records[i] for i in picks]
+
+
+def column_path(out, sheetname, colname):
+    """
+    Path of the figure of one column
+
+    :param out: path to output files
+    :param sheetname: sanitized sheet name
+    :param colname: sanitized column name
+    :return: path
+    """
+
+    return os.path.join(out, sheetname + colname + '.png')
+
+
+def render_column(record, out, dpi=300):
+    """
+    Plot out the raw, smoothened and differentiated trace of one column with detected peaks and fitted
+    tracelets, and save the figure as png
+
+    :param record: dict, column record from the analysis (see main.make_record)
+    :param out: path to output files
+    :param dpi: int, resolution of the saved figure
+    :return: path to the saved figure
+    """
+
+    median_time = record['median_time']
+    ratio = record['ratio']
+    deriv = record['deriv']
+    rise_starts = record['rise_starts']
+    rise_ends = record['rise_ends']
+
+    fig = plt.figure()
+    fig.suptitle('Sheet: ' + record['sheetname'] + ' Column: ' + record['colname'], fontsize=14)
+
+    splt = fig.add_subplot(511)
+    splt.plot(median_time, ratio)
+    ttl = pch.Patch(color='red', label='1: raw trace')
+    splt.legend(handles=[ttl], fontsize=6)
+    splt.set_xlabel('t')
+    splt.set_ylabel('ratio')
+
+    # Plot out the smoothened trace
+    splt = fig.add_subplot(512)
+    splt.plot(median_time, record['smooth'])
+    ttl = pch.Patch(color='red', label='2: low pass polynomial filter')
+    splt.legend(handles=[ttl], fontsize=6)
+
+    splt = fig.add_subplot(513)
+    # Plot out the differential
+    splt.plot(median_time[1:], deriv)
+    splt.plot([median_time[i] for i in rise_starts],
+              [deriv[i] for i in rise_starts], 'ro')
+    splt.plot([median_time[i] for i in rise_ends],
+              [deriv[i] for i in rise_ends], 'ro')
+    ttl = pch.Patch(color='red', label='3: peak detection in derivative')
+    splt.legend(handles=[ttl], fontsize=6)
+
+    splt = fig.add_subplot(514)
+    splt.plot(median_time, ratio)
+    splt.plot([median_time[i] for i in rise_starts],
+              [ratio[i] for i in rise_starts], 'ro')
+    splt.plot([median_time[i] for i in rise_ends],
+              [ratio[i] for i in rise_ends], 'ro')
+    ttl = pch.Patch(color='red', label='4: apply peaks to raw')
+    splt.legend(handles=[ttl], fontsize=6)
+
+    splt = fig.add_subplot(515)
+    splt.plot(median_time, ratio)
+    splt.plot([median_time[i] for i in rise_starts],
+              [ratio[i] for i in rise_starts], 'ro')
+    splt.plot([median_time[i] for i in rise_ends],
+              [ratio[i] for i in rise_ends], 'ro')
+    ttl = pch.Patch(color='red', label='5: fit kinetic curve')
+    splt.legend(handles=[ttl], fontsize=6)
+
+    for fit in record['fits']:
+        if fit['success']:
+            x = np.asarray(median_time[fit['start']:fit['end']])
+            y = np.asarray(ratio[fit['start']:fit['end']])
+
+            splt.plot(x, y, color='purple')
+            splt.plot(x, models.model_first(x - x[0], fit['k'], y[0], fit['y1']), color='green')
+            splt.text(x[0],
+                      y[0],
+                      'k:' + (str(fit['k']))[:5] + '\n' +
+                      'tau:' + (str(fit['tau']))[:5] + '\n' +
+                      'R2:' + (str(fit['R2']))[:5],
+                      color='red',
+                      fontsize=5)
+
+    # Save the picutre and then close the plot.
+
+    # Create directory if not exists
+    os.makedirs(out, exist_ok=True)
+    save_path = column_path(out, record['sheetname'], record['colname'])
+    fig.savefig(save_path, dpi=dpi)
+    plt.close(fig)
+
+    return save_path
+
+
+def render_histograms(sheetname, trcecl, out, dpi=300):
+    """
+    Plot out the histograms of rise time, t10, t50, t90, amplitude and tau of one sheet
+
+    :param sheetname: sanitized sheet name
+    :param trcecl: TraceCollection of the sheet
+    :param out: path to output files
+    :param dpi: int, resolution of the saved figure
+    :return: path to the saved figure
+    """
+
+    num_bins = 10
+    fig = plt.figure()
+    fig.suptitle(sheetname, fontsize=14)
+
+    panels = [(321, trcecl.rise_ts, 'Rise time'),
+              (322, trcecl.t10s, 'T10'),
+              (323, trcecl.t50s, 'T50'),
+              (324, trcecl.t90s, 'T90'),
+              (325, trcecl.amplitudes, 'Amplitude'),
+              (326, trcecl.taus, 'Tau')]
+
+    for (position, series, label) in panels:
+        # Mean and standard deviation are kept up to date by the series as values are added
+        mean, sd = series.mean, series.std()
+        splt = fig.add_subplot(position)
+        n, bins, patches = plt.hist(series.values(), num_bins, normed=1, facecolor='blue', alpha=0.5)
+        y = mlab.normpdf(bins, mean, sd)
+        splt.plot(bins, y, 'r--')
+        ttl = pch.Patch(color='red', label=label + ' \n mean:' + \
+                                           str(np.round(mean, 2)) + '\n sd:' + \
+                                           str(np.round(sd, 2)))
+        splt.legend(handles=[ttl], fontsize=6)
+
+    os.makedirs(out, exist_ok=True)
+    save_path = os.path.join(out, sheetname + '_histograms.png')
+    plt.savefig(save_path, dpi=dpi)
+    plt.close(fig)
+
+    return save_path
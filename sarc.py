@@ -11,228 +11,375 @@ lau1@stanford.edu
 import matplotlib.pyplot as plt
 import matplotlib.mlab as mlab
 import matplotlib.patches as pch
-import openpyxl as xl
-import os, sys, argparse
+import os, sys, argparse, time
+import cache, profiling
 import numpy as np
-import sg
+import sg, ingest, events, spacing
 
 
-def sarcomere(args):
+def autocorr_spacing(args, sheet, d_cols, prof):
     """
-    Measure sarcomere length
-
-    Usage: python sarc.py 'data/sarcomere/Expn24 sarcomer length 204 copy.xlsx' '204' -o sarcomere_out
-    Usage: python sarc.py 'data/sarcomere/Expn2 Stress pattern 100x-1.xlsx' 'Expn2100x' -o expn2100x_out
-
-
-    path =
-    workbook_name = '204'
-    out = 'sarcomere_out'
-
-
-    :param args:
-    :return:
+    Measure sarcomere spacing of every column of a sheet at once, from the dominant period of the
+    autocorrelation of each intensity profile. Writes one figure per column and the spacing of each column.
+
+    :param args: parsed arguments
+    :param sheet: ingest.Sheet
+    :param d_cols: list of int, indices of the distance columns, each followed by its intensity column
+    :param prof: profiling.Profiler
+    :return: list of distances between successive peaks one period apart, over all columns
     """
 
-    # Making variables from argparse
-    path = args.path
     workbook_name = args.workbook_name
+    sheetname = sheet.name
     out = args.out
 
-    # Read the Excel file
-    xl0 = xl.load_workbook(filename=path)
-
-    # Get all the sheets, for each sheet
-    for sheetname in xl0.get_sheet_names():
-
-        # Read the sheet
-        sheet = xl0.get_sheet_by_name(sheetname)
-
-
-        # Within each sheet, get all the columns via the generator
-        cols = []
+    # Remove empty cells, assuming every dist (X) column has a corresponding read (Y), and skip empty columns
+    numbers = [d_cols.index(d_col) + 1 for d_col in d_cols]
+    dists = [sheet.column(d_col, dropna=True) for d_col in d_cols]
+    reads = [sheet.column(d_col + 1, dropna=True) for d_col in d_cols]
+
+    kept = [j for j in range(len(d_cols)) if dists[j].size > 0]
+    for j in kept:
+        assert len(dists[j]) == len(reads[j]), "Length of X and Y are not the same in this column."
+
+    if len(kept) == 0:
+        return []
+
+    numbers = [numbers[j] for j in kept]
+    dist, lengths = spacing.pad_columns([dists[j] for j in kept])
+    read, _ = spacing.pad_columns([reads[j] for j in kept])
+
+    prof.count('columns', len(kept))
+    prof.count('samples', int(lengths.sum()))
+
+    with prof.stage('autocorr'):
+        est = spacing.estimate(dist, read, lengths, minima=args.min)
+
+    prof.count('events', est['peak_col'].size)
+
+    if args.verbose:
+        print('verbosity 1: sheet: ' + sheetname + ' columns without a dominant period: ' +
+              str(int(np.isnan(est['period']).sum())))
+
+    # Plot out the figures
+    for (j, number) in enumerate(numbers):
+
+        plot_start = time.perf_counter()
+        n = lengths[j]
+        peaks = est['peak_col'] == j
+
+        fig = plt.figure()
+        fig.suptitle('workbook: ' + workbook_name + ' sheet: ' +
+                     sheetname + ' column: ' + str(number), fontsize=14)
+
+        # Plot out raw traces with the refined peaks
+        splt = fig.add_subplot(211)
+        splt.plot(dist[:n, j], read[:n, j])
+        ttl = pch.Patch(color='red', label='1: raw trace')
+        splt.legend(handles=[ttl], fontsize=6)
+        splt.plot(est['peak_dist'][peaks],
+                  np.interp(est['peak_position'][peaks], np.arange(n), read[:n, j]), 'ro')
+        splt.set_xlabel('distance')
+        splt.set_ylabel('intensity')
+
+        # Plot out the autocorrelation with the dominant period
+        splt = fig.add_subplot(212)
+        lag_dist = dist[:n, j] - dist[0, j]
+        splt.plot(lag_dist, est['acf'][:n, j])
+        ttl = pch.Patch(color='red', label='2: autocorrelation, spacing: ' + str(round(est['spacing'][j], 3)))
+        splt.legend(handles=[ttl], fontsize=6)
+        if not np.isnan(est['period'][j]):
+            splt.axvline(est['spacing'][j], color='red', linestyle='--')
+        splt.set_xlabel('lag')
+        splt.set_ylabel('autocorrelation')
+
+        # Create directory if not exists
+        os.makedirs(out, exist_ok=True)
+        save_path = os.path.join(out, workbook_name + '_' + sheetname + '_' + str(number) + '.png')
+        fig.savefig(save_path, dpi=300)
+        plt.close()
+
+        prof.add_time('plot', time.perf_counter() - plot_start)
+        if args.profile:
+            prof.count('figures')
+            prof.count('bytes_written', os.path.getsize(save_path))
+
+    #
+    # Save the dominant spacing of each column as CSV
+    #
+    os.makedirs(out, exist_ok=True)
+    csv_path = os.path.join(out, workbook_name + '_' + sheetname + '_spacing.csv')
+
+    with prof.stage('csv'):
+        periods = np.bincount(est['dist_col'], minlength=len(numbers))
+        with open(csv_path, 'w') as f:
+            f.write('column,period_samples,spacing,periods\n')
+            for (j, number) in enumerate(numbers):
+                f.write(str(number) + ',' + '%.3f' % est['period'][j] + ',' + '%.3f' % est['spacing'][j] + ',' +
+                        str(periods[j]) + '\n')
+
+    if args.profile:
+        prof.count('bytes_written', os.path.getsize(csv_path))
+
+    return est['distances'].tolist()
+
+
+def peak_spacing(args, sheet, d_cols, prof):
+    """
+    Measure sarcomere spacing of every column of a sheet as the distance between successive peaks. All columns
+    are smoothed and searched for peaks at once, padded to the same length. Writes one figure per column.
+
+    :param args: parsed arguments
+    :param sheet: ingest.Sheet
+    :param d_cols: list of int, indices of the distance columns, each followed by its intensity column
+    :param prof: profiling.Profiler
+    :return: list of distances between successive peaks, over all columns
+    """
 
-        for col in sheet.columns:
-            cols.append(col)
+    workbook_name = args.workbook_name
+    sheetname = sheet.name
+    out = args.out
 
+    # Remove empty cells - assuming right now that every dist (X) column has corresponding read (Y)
+    # The column header is already kept apart by the reader
+    dists = [sheet.column(d_col, dropna=True) for d_col in d_cols]
+    reads = [sheet.column(d_col + 1, dropna=True) for d_col in d_cols]
 
-        # Manually take only the first eight columns
+    # If there is no data left, skip this column
+    kept = [j for j in range(len(d_cols)) if dists[j].size > 0]
+    for j in kept:
+        assert len(dists[j]) == len(reads[j]), "Length of X and Y are not the same in this column."
 
-        # Specify which columns contain data on the distance, and which one the intensity
-        d_cols = list(range(0, len(cols), 2))
-        i_cols = [d_col + 1 for d_col in d_cols]
+    if len(kept) == 0:
+        return []
 
+    # All columns of the sheet side by side, padded with NaN at the end
+    numbers = [j + 1 for j in kept]
+    dist, lengths = spacing.pad_columns([dists[j] for j in kept])
+    read, _ = spacing.pad_columns([reads[j] for j in kept])
 
-        # Initiate the storage for all the distance reads within this particular sheet (read)
-        sarcomere_dists = []
+    prof.count('columns', len(kept))
+    prof.count('samples', int(lengths.sum()))
 
-        # Loop through the data columns and for each column make a Trace object
-        for d_col in d_cols:
+    # Smoothen and take the derivative of every column in the same call
+    with prof.stage('smooth'):
+        read_smooth, read_deriv = sg.savitzky_golay(read, 13, 3, diff=True, lengths=lengths)
 
-            dist = [cell.value for cell in cols[d_col]]
-            read = [cell.value for cell in cols[d_col+1]]
+    # Flip the derivatives if minima are sought
+    if args.min:
+        read_deriv *= -1
 
-            # Take out first value (column header)
-            dist = dist[1:]
-            read = read[1:]
+    #
+    # Detect peak in each pulse of every column
+    #
 
-            # Remove empty cells - assuming right now that every dist (X) column has corresponding read (Y)
-            dist = [x for x in dist if x is not None]
-            read = [y for y in read if y is not None]
+    # Indices where each trace begins to rise, and stops rising, with the column of each
+    with prof.stage('detect'):
+        rise_cols, rise_starts, rise_ends = events.detect_rises_columns(read_deriv, lengths - 1,
+                                                                        y_tol=args.y_tol, x_tol=args.x_tol)
 
-            # If there is no data left, skip this column
-            if not dist:
-                continue
+    prof.count('events', len(rise_starts))
 
-            # Print out current sheet and column name if verbose
-            if args.verbose:
-                print('verbosity 1: now analyzing sheet: ' + sheetname + ' column: ' + str(d_cols.index(d_col)+1))
+    # From the first peak (rise_end) to the next one in the same column, the distance between them
+    peak_dist = dist[rise_ends + 1, rise_cols]
+    successive = rise_cols[1:] == rise_cols[:-1]
+    sarcomere_dists = (peak_dist[1:] - peak_dist[:-1])[successive].tolist()
 
+    # Plot out the figures
+    for (j, number) in enumerate(numbers):
 
+        # Print out current sheet and column name if verbose
+        if args.verbose:
+            print('verbosity 1: now plotting sheet: ' + sheetname + ' column: ' + str(number))
+
+        plot_start = time.perf_counter()
+
+        n = lengths[j]
+        rise_end = rise_ends[rise_cols == j]
+        sarcomere_intervals = [(rise_end[i], rise_end[i + 1]) for i in range(len(rise_end) - 1)]
+
+        fig = plt.figure()
+        fig.suptitle('workbook: ' + workbook_name + ' sheet: ' +
+                     sheetname + ' column: ' + str(number), fontsize=14)
+
+        # Plot out raw traces
+        splt = fig.add_subplot(311)
+        splt.plot(dist[:n, j], read[:n, j])
+        ttl = pch.Patch(color='red', label='1: raw trace')
+        splt.legend(handles=[ttl], fontsize=6)
+        splt.plot(dist[rise_end + 1, j], read[rise_end + 1, j], 'ro')
+        splt.set_xlabel('distance')
+        splt.set_ylabel('intensity')
+
+        # Plot out smoothened traces
+        splt = fig.add_subplot(312)
+        splt.plot(dist[:n, j], read_smooth[:n, j])
+        ttl = pch.Patch(color='red', label='2: low pass polynomial filter')
+        splt.legend(handles=[ttl], fontsize=6)
+        splt.set_xlabel('distance')
+        splt.set_ylabel('intensity')
+        splt.plot(dist[rise_end + 1, j], read_smooth[rise_end + 1, j], 'ro')
+
+        for (start, end) in sarcomere_intervals:
+            splt.text(np.mean((dist[end, j], dist[start, j])),
+                      read_smooth[end, j]/2,
+                      str(round(dist[end+1, j] - dist[start+1, j],2)),
+                      color='red',
+                      fontsize=5)
+
+        # Plot out derivatives
+        splt = fig.add_subplot(313)
+        ttl = pch.Patch(color='red', label='3: peak detection in derivative')
+        splt.legend(handles=[ttl], fontsize=6)
+        # Plot out the differential
+        splt.plot(dist[1:n, j], read_deriv[:n - 1, j])
+        splt.plot(dist[rise_end + 1, j], read_deriv[rise_end + 1, j], 'ro')
+
+        # Save the picutre and then close the plot.
+
+        # Create directory if not exists
+        os.makedirs(out, exist_ok=True)
+        save_path = os.path.join(out, workbook_name + '_' + sheetname + '_' + str(number) + '.png')
+        fig.savefig(save_path, dpi=300)
+        plt.close()
+
+        prof.add_time('plot', time.perf_counter() - plot_start)
+        if args.profile:
+            prof.count('figures')
+            prof.count('bytes_written', os.path.getsize(save_path))
+
+    return sarcomere_dists
+
+
+def parse_sheet(task):
+    """
+    Measure sarcomere spacing of one sheet and write its figures, histogram and CSV. Sheets are independent
+    of each other, so this runs in a worker process when --jobs is above one.
 
-            assert len(dist) == len(read), "Length of X and Y are not the same in this column."
+    :param task: tuple of (parsed arguments, ingest.Sheet)
+    :return: tuple of (sheet name, profiling record of this sheet)
+    """
 
-            read_smooth = sg.savitzky_golay(np.array(read), 13, 3)
+    args, sheet = task
 
-            read_deriv = np.diff(read_smooth)
+    workbook_name = args.workbook_name
+    sheetname = sheet.name
+    out = args.out
 
-            # Flip the derivatives if minima are sought
-            if args.min:
-                read_deriv *= -1
+    # Wall time and counters of each stage of this sheet, handed back to be reported with the others
+    prof = profiling.Profiler(enabled=args.profile)
 
-            # Get second derivative
-            #read_deriv2 = np.diff(read_deriv)
+    # Specify which columns contain data on the distance, and which one the intensity
+    d_cols = list(range(0, sheet.data.shape[1], 2))
 
+    # Measure the spacing of all profiles of the sheet at once from their autocorrelation,
+    # or from the peaks of every profile
+    if args.method == 'autocorr':
+        sarcomere_dists = autocorr_spacing(args, sheet, d_cols, prof)
 
-            #
-            # Detect peak in each pulse
-            #
+    else:
+        sarcomere_dists = peak_spacing(args, sheet, d_cols, prof)
 
-            # Peak detection tolerance parameters (these will be specifiable in argparse later).
-            y_tolerance = args.y_tol
-            x_tolerance = args.x_tol
+    #
+    # For each sheet, plot out histogram of all measured distances
+    #
 
-            # List of times when the traces begin to rise, and stops rising
-            rise_starts = []
-            rise_ends = []
-            rise_interval = []
+    # Print out current sheet and column name if verbose
+    if args.verbose:
+        print('verbosity 1: sheet completed. no. of sarcomere distances quantified: ' + str(len(sarcomere_dists)))
 
-            for i in range(len(read_deriv)):
+    # If there was any sarcomere distance from this sheet, print out histogram
+    if len(sarcomere_dists) > 0:
+        plot_start = time.perf_counter()
+        num_bins = len(sarcomere_dists)//3      # Vary number of bins by length of sarcomere_dists
+        n, bins, patches = plt.hist(sarcomere_dists, num_bins, normed=1, facecolor='blue', alpha=0.5)
+        y = mlab.normpdf(bins, np.mean(sarcomere_dists), np.std(sarcomere_dists))
+        plt.plot(bins, y, 'r--')
 
-                # Mark the interval where the differential is above the y-tolerance
-                if read_deriv[i] > y_tolerance:
-                    rise_interval.append(i)
+        label_text = 'workbook: ' + workbook_name + ' sheet: ' + sheetname + '\n' +\
+                     'n: ' + str(len(sarcomere_dists)) + \
+                     ' mean: ' + str(round(np.mean(sarcomere_dists),3)) +\
+                     ' sd: ' + str(round(np.std(sarcomere_dists),3))
 
-                # Once the differential drops below the y_tolerance value,
-                # Check if the interval is long enough (> x_tolerance)
-                # If it is, mark the beginning and the end of the interval
-                else:
-                    if len(rise_interval) > x_tolerance:
-                        rise_starts.append(rise_interval[0])
-                        rise_ends.append(rise_interval[-1])
-                    rise_interval = []
+        plt.title(label_text, fontsize=14)
+        save_path = os.path.join(out, workbook_name + '_' + sheetname + '_histogram.png')
+        plt.savefig(save_path, dpi=300)
 
-            # Rise times are calculated as the time interval between the start and end of each rise cycles
-            assert len(rise_starts) == len(rise_ends), 'Check this trace - incorrect number of cycles detected.'
+        plt.close()
 
+        prof.add_time('histogram', time.perf_counter() - plot_start)
+        if args.profile:
+            prof.count('figures')
+            prof.count('bytes_written', os.path.getsize(save_path))
 
+        #
+        # Save all distances as CSV
+        #
+        csv_path = os.path.join(out, workbook_name + '_' + sheetname + '.csv')
 
+        with prof.stage('csv'):
+            np.savetxt(csv_path, np.array(sarcomere_dists), fmt='%.3f', delimiter=",")
 
-            # From the first peak (rise_end) to the next, define an interval of the sarcomere intensity
-            # and print out distances
-            sarcomere_intervals = [(rise_ends[i], rise_ends[i+1]) for i in range(len(rise_ends)-1)]
-            sarcomere_dist = [dist[rise_ends[i + 1] + 1] - dist[rise_ends[i] + 1] for i in range(len(rise_ends) - 1)]
-            sarcomere_dists += sarcomere_dist
+        if args.profile:
+            prof.count('bytes_written', os.path.getsize(csv_path))
 
-            # Plot out the figures
-            fig = plt.figure()
-            fig.suptitle('workbook: ' + workbook_name + ' sheet: ' +
-                         sheetname + ' column: ' + str(d_cols.index(d_col)+1), fontsize=14)
+    return sheetname, prof.total
 
-            # Plot out raw traces
-            splt = fig.add_subplot(311)
-            splt.plot(dist, read)
-            ttl = pch.Patch(color='red', label='1: raw trace')
-            splt.legend(handles=[ttl], fontsize=6)
-            splt.plot([dist[i+1] for i in rise_ends],
-                      [read[i+1] for i in rise_ends], 'ro')
-            splt.set_xlabel('distance')
-            splt.set_ylabel('intensity')
 
-            # Plot out smoothened traces
-            splt = fig.add_subplot(312)
-            splt.plot(dist, read_smooth)
-            ttl = pch.Patch(color='red', label='2: low pass polynomial filter')
-            splt.legend(handles=[ttl], fontsize=6)
-            splt.set_xlabel('distance')
-            splt.set_ylabel('intensity')
-            splt.plot([dist[i+1] for i in rise_ends],
-                      [read_smooth[i+1] for i in rise_ends], 'ro')
+def sarcomere(args):
+    """
+    Measure sarcomere length
 
+    Usage: python sarc.py 'data/sarcomere/Expn24 sarcomer length 204 copy.xlsx' '204' -o sarcomere_out
+    Usage: python sarc.py 'data/sarcomere/Expn2 Stress pattern 100x-1.xlsx' 'Expn2100x' -o expn2100x_out
+    Usage: python sarc.py 'data/sarcomere/Expn2 Stress pattern 100x-1.xlsx' 'Expn2100x' -o expn2100x_out -m autocorr
+    Usage: python sarc.py 'data/sarcomere/Expn2 Stress pattern 100x-1.xlsx' 'Expn2100x' -o expn2100x_out -j 4
 
-            for (start, end) in sarcomere_intervals:
-                splt.text(np.mean((dist[end], dist[start])),
-                          read_smooth[end]/2,
-                          str(round(dist[end+1] - dist[start+1],2)),
-                          color='red',
-                          fontsize=5)
 
-            # Plot out derivatives
-            splt = fig.add_subplot(313)
-            ttl = pch.Patch(color='red', label='3: peak detection in derivative')
-            splt.legend(handles=[ttl], fontsize=6)
-            # Plot out the differential
-            splt.plot(dist[1:], read_deriv)
-            # splt.plot([dist[i] for i in rise_starts],
-            #          [dist[i] for i in rise_starts], 'ro')
-            splt.plot([dist[i + 1] for i in rise_ends],
-                      [read_deriv[i + 1] for i in rise_ends], 'ro')
+    path =
+    workbook_name = '204'
+    out = 'sarcomere_out'
 
 
-            # Save the picutre and then close the plot.
+    :param args:
+    :return:
+    """
 
-            # Create directory if not exists
-            os.makedirs(out, exist_ok=True)
-            save_path = os.path.join(out, workbook_name + '_' + sheetname + '_' +
-                                     str(d_cols.index(d_col)+1) + '.png')
-            fig.savefig(save_path, dpi=300)
-            plt.close()
+    # Making variables from argparse
+    path = args.path
+    workbook_name = args.workbook_name
+    out = args.out
 
-        #
-        # For each sheet, plot out histogram of all measured distances
-        #
+    # Wall time and counters of each stage, only recorded with --profile
+    prof = profiling.Profiler(enabled=args.profile)
 
-        # Print out current sheet and column name if verbose
-        if args.verbose:
-            print('verbosity 1: sheet completed. no. of sarcomere distances quantified: ' + str(len(sarcomere_dists)))
+    # Sheets are analyzed one after another, or --jobs at a time in worker processes
+    if args.jobs > 1:
+        import concurrent.futures
 
-        # If there was any sarcomere distance from this sheet, print out histogram
-        if len(sarcomere_dists) > 0:
-            num_bins = len(sarcomere_dists)//3      # Vary number of bins by length of sarcomere_dists
-            n, bins, patches = plt.hist(sarcomere_dists, num_bins, normed=1, facecolor='blue', alpha=0.5)
-            y = mlab.normpdf(bins, np.mean(sarcomere_dists), np.std(sarcomere_dists))
-            plt.plot(bins, y, 'r--')
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+        mapper = executor.map
+    else:
+        executor = None
+        mapper = map
 
-            label_text = 'workbook: ' + workbook_name + ' sheet: ' + sheetname + '\n' +\
-                         'n: ' + str(len(sarcomere_dists)) + \
-                         ' mean: ' + str(round(np.mean(sarcomere_dists),3)) +\
-                         ' sd: ' + str(round(np.std(sarcomere_dists),3))
+    # Stream the Excel file in read-only mode, one sheet of numeric columns at a time
+    tasks = ((args, sheet) for sheet in prof.iterate('ingest', ingest.read_workbook(path, cache_dir=args.cache)))
 
-            plt.title(label_text, fontsize=14)
-            save_path = os.path.join(out, workbook_name + '_' + sheetname + '_histogram.png')
-            plt.savefig(save_path, dpi=300)
+    for (sheetname, record) in mapper(parse_sheet, tasks):
 
-            plt.close()
+        prof.begin_sheet(sheetname)
+        prof.merge(record)
 
-            #
-            # Save all distances as CSV
-            #
-            csv_path = os.path.join(out, workbook_name + '_' + sheetname + '.csv')
+        if args.profile:
+            os.makedirs(out, exist_ok=True)
+            prof.end_sheet(out, workbook_name + '_' + sheetname)
 
-            np.savetxt(csv_path, np.array(sarcomere_dists), fmt='%.3f', delimiter=",")
+    if executor is not None:
+        executor.shutdown()
 
-        else:
-            pass
+    if args.profile:
+        print(prof.summary())
 
 #
 # Code for running main with parsed arguments from command line
@@ -252,10 +399,22 @@ if __name__ == "__main__":
                         type=int, default=5)
     parser.add_argument('-y', '--y_tol', help='y tolerance for peak detection (float).',
                         type=float, default=0.1)
+    parser.add_argument('-m', '--method', choices=['peaks', 'autocorr'], default='peaks',
+                        help='peaks: distance between peaks found in the derivative of each profile; '
+                             'autocorr: dominant period of the autocorrelation of all profiles at once, '
+                             'for many or noisy profiles. (default: peaks)')
     parser.add_argument('-min', help='detect minima rather than maxima for distance calculation',
                         action='store_true')
     parser.add_argument('-o', '--out', help='path to output files',
                               default='out')
+    parser.add_argument('-j', '--jobs', help='number of worker processes, each analyzing whole sheets (integer).',
+                        type=int, default=1)
+    parser.add_argument('--cache', nargs='?', const=cache.DEFAULT_CACHE_DIR, default=None,
+                        help='reuse parsed workbooks from an on-disk cache (default location: ~/.autocal_cache).')
+    parser.add_argument('--profile', action='store_true',
+                        help='time each stage and write a profile report per sheet plus a summary at the end.')
+    parser.add_argument('--profile_dump', help='also write cProfile statistics of the whole run to this file.',
+                        default=None)
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose error messages.')
 
     parser.set_defaults(func=sarcomere)
@@ -268,5 +427,8 @@ if __name__ == "__main__":
     # Parse all the arguments
     args = parser.parse_args()
 
-    # Run the function in the argument
-    args.func(args)
+    # Run the function in the argument, under cProfile if asked for
+    if args.profile_dump is not None:
+        profiling.run_with_cprofile(args.func, args, args.profile_dump)
+    else:
+        args.func(args)
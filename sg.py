@@ -7,7 +7,71 @@ lau1@stanford.edu
 
 """
 
-def savitzky_golay(y, window_size, order, deriv=0, rate=1):
+import functools
+import math
+import numpy as np
+import kernels
+
+
+@functools.lru_cache(maxsize=None)
+def coefficients(window_size, order, deriv=0, rate=1):
+    """
+    Savitzky-Golay convolution coefficients, computed once per combination of arguments and then reused
+
+    :param window_size: int, the length of the window. Must be an odd integer number.
+    :param order: int, the order of the polynomial used in the filtering.
+    :param deriv: int, the order of the derivative to compute (default = 0 means only smoothing)
+    :param rate: sampling rate, scales the derivative
+    :return: read-only ndarray, shape (window_size,)
+    """
+
+    assert type(window_size) == int and type(order) == int, 'Window size and order must be integers'
+    assert window_size % 2 == 1 and window_size >= 1, 'Window size must be positive odd number'
+    assert window_size >= order + 2, 'Window size is too small for polynomial order'
+
+    order_range = range(order + 1)
+    half_window = window_size // 2
+
+    b = np.array([[k**i for i in order_range] for k in range(-half_window, half_window+1)], dtype=float)
+    m = np.linalg.pinv(b)[deriv] * rate**deriv * math.factorial(deriv)
+
+    # The same array is handed to every caller, make sure nobody changes it
+    m.setflags(write=False)
+
+    return m
+
+
+def head_padding(y, half_window):
+    """
+    Values placed before the start of a signal so that the filter window fits, mirrored from its first points
+
+    :param y: ndarray, signal along the first axis, at least half_window + 1 long
+    :param half_window: int, half the window size
+    :return: ndarray, half_window values along the first axis
+    """
+
+    if kernels.enabled():
+        return kernels.head_padding(y, half_window)
+
+    return y[0] - np.abs(y[1:half_window+1][::-1] - y[0])
+
+
+def tail_padding(y, half_window):
+    """
+    Values placed after the end of a signal so that the filter window fits, mirrored from its last points
+
+    :param y: ndarray, signal along the first axis, at least half_window + 1 long
+    :param half_window: int, half the window size
+    :return: ndarray, half_window values along the first axis
+    """
+
+    if kernels.enabled():
+        return kernels.tail_padding(y, half_window)
+
+    return y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+
+
+def savitzky_golay(y, window_size, order, deriv=0, rate=1, axis=0, diff=False, lengths=None):
     """
 
     Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
@@ -24,7 +88,8 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
        Chemistry, 1964, 36 (8), pp 1627-1639.
 
 
-    :param y: array_like, shape (N,) the values of the time history of the signal.
+    :param y: array_like, shape (N,) the values of the time history of the signal,
+        or an array of several signals (e.g. all columns of a sheet) filtered along `axis`
     :param window_size: int, the length of the window. Must be an odd integer number.
     :param order: int
         the order of the polynomial used in the filtering.
@@ -32,8 +97,14 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     :param deriv: int
         the order of the derivative to compute (default = 0 means only smoothing)
     :param rate:
+    :param axis: int, the axis along which to filter multi-dimensional input
+    :param diff: logical, whether to also return the first difference of the filtered signal
+    :param lengths: array of int, for signals of different lengths stacked along the other axis and padded at
+        the end: the length of each signal. Each signal is then filtered as if on its own, and the result is NaN
+        past its end.
     :return: ndarray, shape (N)
-        the smoothed signal (or it's n-th derivative).
+        the smoothed signal (or it's n-th derivative). If diff is True, a tuple of the
+        smoothed signal and its first difference along `axis`.
 
 
     >>> import numpy as np
@@ -43,25 +114,52 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
 
     """
 
+    # Precomputed coefficients
+    m = coefficients(window_size, order, deriv, rate)
+    half_window = window_size // 2
 
-    import numpy as np
-    import math
+    # Filter along the first axis, moved back into place at the end
+    y = np.moveaxis(np.asarray(y), axis, 0)
 
-    assert type(window_size) == int and type(order) == int, 'Window size and order must be integers'
-    assert window_size % 2 == 1 and window_size >= 1, 'Window size must be positive odd number'
-    assert window_size >= order + 2, 'Window size is too small for polynomial order'
+    # Reduced-precision signals are filtered in their own precision
+    if y.dtype.kind == 'f':
+        m = m.astype(y.dtype, copy=False)
 
-    order_range = range(order + 1)
-    half_window = window_size // 2
+    # Fill back in the beginning and end signal points with values taken from the signal itself
+    if lengths is None:
+        y = np.concatenate((head_padding(y, half_window), y, tail_padding(y, half_window)))
 
-    # Precompute coefficients
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] * rate**deriv * math.factorial(deriv)
+    else:
+        lengths = np.asarray(lengths, dtype=int)
+        signals = np.arange(y.shape[1])
+        padded = np.full((y.shape[0] + 2 * half_window,) + y.shape[1:], np.nan, dtype=y.dtype)
+        padded[:half_window] = head_padding(y, half_window)
+        padded[half_window:half_window + y.shape[0]] = y
 
-    # Fill back in the beginning and end signal points with values taken from the signal itself
-    first_vals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    last_vals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((first_vals, y, last_vals))
+        # The tail of each signal is mirrored from its own last points, right after its end
+        last = y[lengths - 1, signals]
+        for k in range(half_window):
+            padded[half_window + lengths + k, signals] = last + np.abs(y[lengths - 2 - k, signals] - last)
+
+        y = padded
+
+    if y.ndim == 1:
+        # Return the linear convolution
+        smooth = np.convolve(m[::-1], y, mode='valid')
+
+    else:
+        # Same convolution for every signal at once, one pass per window position
+        n = y.shape[0] - window_size + 1
+        smooth = m[0] * y[:n]
+        for j in range(1, window_size):
+            smooth += m[j] * y[j:j + n]
+
+    if lengths is not None:
+        smooth[np.arange(smooth.shape[0])[:, np.newaxis] >= lengths] = np.nan
+
+    smooth = np.moveaxis(smooth, 0, axis)
+
+    if diff:
+        return smooth, np.diff(smooth, axis=axis)
 
-    # Return the linear convolution
-    return np.convolve(m[::-1], y, mode='valid')
\ No newline at end of file
+    return smooth
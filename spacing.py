@@ -0,0 +1,239 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import sg
+
+
+def pad_columns(columns):
+    """
+    Stack profiles of different lengths as the columns of one array, padded at the end with NaN
+
+    :param columns: list of 1-D ndarrays
+    :return: tuple of (ndarray, shape (longest, number of columns), ndarray of int lengths)
+    """
+
+    lengths = np.array([c.size for c in columns], dtype=int)
+    padded = np.full((lengths.max() if lengths.size else 0, len(columns)), np.nan)
+
+    for (j, c) in enumerate(columns):
+        padded[:c.size, j] = c
+
+    return padded, lengths
+
+
+def autocorrelation(reads, lengths):
+    """
+    Normalized autocorrelation of every column at once, through one FFT of all columns. Each lag is divided by
+    the number of overlapping samples, so that profiles of different lengths are on the same scale.
+
+    :param reads: ndarray, shape (samples, columns), NaN after the end of each column
+    :param lengths: ndarray of int, number of samples of each column
+    :return: ndarray, shape (samples, columns), 1 at lag 0 and NaN from each column's length on
+    """
+
+    n, m = reads.shape
+    lag = np.arange(n)[:, np.newaxis]
+    inside = lag < lengths
+
+    # Remove each column's mean, with zeros after its end so that they add nothing
+    x = np.where(inside, reads, 0.)
+    x = np.where(inside, x - x.sum(axis=0) / np.maximum(lengths, 1), 0.)
+
+    # Zero-padding to at least twice the length keeps the correlation linear rather than circular
+    n_fft = 1 << int(2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(x, n=n_fft, axis=0)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum), n=n_fft, axis=0)[:n]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acf /= np.maximum(lengths - lag, 1)
+        acf /= acf[0]
+
+    acf[~inside] = np.nan
+
+    return acf
+
+
+def parabolic(left, center, right):
+    """
+    Sub-sample offset of the vertex of the parabola through three equally spaced points around a maximum
+
+    :param left: ndarray, value before the maximum
+    :param center: ndarray, value at the maximum
+    :param right: ndarray, value after the maximum
+    :return: ndarray, offset between -0.5 and 0.5, 0 where the points do not curve downward
+    """
+
+    curvature = left - 2 * center + right
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.)
+
+    return np.clip(offset, -0.5, 0.5)
+
+
+def dominant_period(acf, lengths, min_lag=2, max_fraction=0.5, harmonic_ratio=0.8):
+    """
+    Period of every column, from the first autocorrelation peak after the first zero crossing. A later peak
+    (a multiple of the period) is only taken if the first one is below harmonic_ratio of the highest peak.
+
+    :param acf: ndarray, shape (lags, columns) from autocorrelation
+    :param lengths: ndarray of int, number of samples of each column
+    :param min_lag: int, shortest period considered, in samples
+    :param max_fraction: float, longest period considered, as a fraction of each column's length
+    :param harmonic_ratio: float, how high a peak must be relative to the highest peak to be taken
+    :return: ndarray of float periods in samples, NaN where no period was found
+    """
+
+    n, m = acf.shape
+    period = np.full(m, np.nan)
+
+    if n < 3:
+        return period
+
+    lag = np.arange(n)[:, np.newaxis]
+    r = np.where(np.isnan(acf), -np.inf, acf)
+
+    # Local maxima, not counting the first and last lag
+    peak = np.zeros(acf.shape, dtype=bool)
+    peak[1:-1] = (r[1:-1] > r[:-2]) & (r[1:-1] >= r[2:])
+
+    # Only past the first zero crossing, which marks the end of the central peak
+    below = r <= 0
+    crossed = below.any(axis=0)
+    first_zero = np.argmax(below, axis=0)
+
+    peak &= (lag > first_zero) & (lag >= min_lag) & (lag <= lengths * max_fraction) & (r > 0)
+
+    best = np.where(peak, r, -np.inf).max(axis=0)
+    chosen = peak & (r >= harmonic_ratio * best)
+    found = crossed & chosen.any(axis=0)
+
+    cols = np.flatnonzero(found)
+    at = np.argmax(chosen, axis=0)[cols]
+
+    period[cols] = at + parabolic(r[at - 1, cols], r[at, cols], r[at + 1, cols])
+
+    return period
+
+
+def period_peaks(smooth, lengths, period, window=0.25):
+    """
+    Positions of the intensity peaks of every column at once. The phase of each column's dominant period gives
+    where the peaks are expected, the highest point within a window around each expected peak is taken and
+    refined to a sub-sample position.
+
+    :param smooth: ndarray, shape (samples, columns), smoothed profiles, NaN after the end of each column
+    :param lengths: ndarray of int, number of samples of each column
+    :param period: ndarray of float periods in samples from dominant_period
+    :param window: float, half-width of the search window around each expected peak, as a fraction of the period
+    :return: tuple of ndarrays (column of each peak, period count of each peak, sub-sample position of each peak),
+        in column and position order
+    """
+
+    n, m = smooth.shape
+    cols = np.flatnonzero(~np.isnan(period))
+
+    if cols.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+    inside = np.arange(n)[:, np.newaxis] < lengths
+    x = np.where(inside, smooth, 0.)
+    x = np.where(inside, x - x.sum(axis=0) / np.maximum(lengths, 1), 0.)
+
+    # Phase of each column at its own period; peaks of the matching sinusoid are where the phase comes round
+    p = period[cols]
+    phase = np.angle(np.sum(x[:, cols] * np.exp(-2j * np.pi * np.arange(n)[:, np.newaxis] / p), axis=0))
+    first = np.mod(-phase, 2 * np.pi) / (2 * np.pi) * p
+
+    # Expected peaks of all columns in one flat array
+    counts = np.floor((lengths[cols] - 1 - first) / p).astype(int) + 1
+    counts = np.maximum(counts, 0)
+    peak_col = np.repeat(cols, counts)
+    peak_k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    expected = np.repeat(first, counts) + peak_k * np.repeat(p, counts)
+
+    # Search windows of every expected peak, masked to their own width and to the column
+    half = np.repeat(p, counts) * window
+    widest = int(np.ceil(half.max())) if half.size else 0
+    offsets = np.arange(-widest, widest + 1)
+    idx = np.round(expected).astype(int)[:, np.newaxis] + offsets
+    valid = (np.abs(offsets) <= half[:, np.newaxis]) & (idx >= 0) & (idx < lengths[peak_col][:, np.newaxis])
+
+    values = np.where(valid, smooth[np.clip(idx, 0, n - 1), peak_col[:, np.newaxis]], -np.inf)
+    best = np.argmax(values, axis=1)
+    rows = np.arange(best.size)
+    at = idx[rows, best]
+
+    # A maximum on the edge of its window is not a peak, but the rise towards one outside the window
+    interior = (best > 0) & (best < offsets.size - 1)
+    interior &= valid[rows, np.maximum(best - 1, 0)] & valid[rows, np.minimum(best + 1, offsets.size - 1)]
+
+    rows, best = rows[interior], best[interior]
+    position = at[interior] + parabolic(values[rows, best - 1], values[rows, best], values[rows, best + 1])
+
+    return peak_col[interior], peak_k[interior], position
+
+
+def estimate(dist, reads, lengths, window_size=13, order=3, minima=False, **kwargs):
+    """
+    Sarcomere spacing of every profile of a sheet at once, from the dominant period of its autocorrelation,
+    and the distance between successive intensity peaks one period apart
+
+    :param dist: ndarray, shape (samples, columns), distance of each sample, NaN after the end of each column
+    :param reads: ndarray, shape (samples, columns), intensity of each sample, NaN after the end of each column
+    :param lengths: ndarray of int, number of samples of each column
+    :param window_size: int, Savitzky-Golay window used to smooth the profiles before locating peaks
+    :param order: int, Savitzky-Golay polynomial order
+    :param minima: T/F whether to measure between intensity minima rather than maxima
+    :param kwargs: passed to dominant_period
+    :return: dict of ndarrays: 'acf', 'period' (samples) and 'spacing' (distance) per column;
+        'peak_col', 'peak_k', 'peak_position' (samples) and 'peak_dist' (distance) per peak;
+        'dist_col' and 'distances' per pair of successive peaks
+    """
+
+    n, m = reads.shape
+    inside = np.arange(n)[:, np.newaxis] < lengths
+
+    if minima:
+        reads = -reads
+
+    acf = autocorrelation(reads, lengths)
+    period = dominant_period(acf, lengths, **kwargs)
+
+    # Spacing in distance units, from the average step of each column
+    ends = dist[np.maximum(lengths - 1, 0), np.arange(m)]
+    step = (ends - dist[0]) / np.maximum(lengths - 1, 1)
+    spacing = period * step
+
+    # Hold each column's last value past its end, so that smoothing all columns together is not spoiled by NaN
+    last = reads[np.maximum(lengths - 1, 0), np.arange(m)]
+    held = np.where(inside, reads, last)
+    smooth = np.where(inside, sg.savitzky_golay(held, window_size, order), np.nan) if n > window_size else held
+
+    peak_col, peak_k, position = period_peaks(smooth, lengths, period)
+
+    # Sub-sample positions to distances, interpolating between the samples of each column
+    i0 = np.clip(np.floor(position).astype(int), 0, n - 1)
+    i1 = np.minimum(i0 + 1, lengths[peak_col] - 1)
+    frac = position - i0
+    peak_dist = dist[i0, peak_col] + frac * (dist[i1, peak_col] - dist[i0, peak_col])
+
+    # Distances only between peaks one period apart within the same column
+    successive = (peak_col[1:] == peak_col[:-1]) & (peak_k[1:] == peak_k[:-1] + 1)
+
+    return {'acf': acf,
+            'period': period,
+            'spacing': spacing,
+            'peak_col': peak_col,
+            'peak_k': peak_k,
+            'peak_position': position,
+            'peak_dist': peak_dist,
+            'dist_col': peak_col[1:][successive],
+            'distances': (peak_dist[1:] - peak_dist[:-1])[successive]}
@@ -0,0 +1,124 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+
+
+# Bump whenever the analysis changes its results, so that columns analyzed before are redone
+STORE_VERSION = 6
+
+DEFAULT_STORE_PATH = os.path.join(os.path.expanduser('~'), '.autocal_results.sqlite')
+
+
+def sheet_digest(tm, bg):
+    """
+    Hash of the time and background columns, which every data column of a sheet shares
+
+    :param tm: ndarray time column
+    :param bg: ndarray background column
+    :return: str hex digest
+    """
+
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(tm, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(bg, dtype=float).tobytes())
+
+    return digest.hexdigest()
+
+
+def column_key(raw_dt, shared, params):
+    """
+    Key of one column's results: a hash of its raw data, the sheet's time and background, and the
+    analysis parameters
+
+    :param raw_dt: ndarray raw data column
+    :param shared: str, digest of the time and background from sheet_digest
+    :param params: dict of analysis parameters, json-serializable
+    :return: str hex digest
+    """
+
+    digest = hashlib.sha1()
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(shared.encode())
+    digest.update(np.ascontiguousarray(raw_dt, dtype=float).tobytes())
+    digest.update(str(STORE_VERSION).encode())
+
+    return digest.hexdigest()
+
+
+class ResultStore(object):
+    """
+    Object to keep the results of analyzed columns in a local SQLite database, so that a column whose data and
+    analysis parameters have not changed is not analyzed again. Each result is a json document of the column's
+    attributes, keyed by column_key.
+
+    """
+
+    def __init__(self, path):
+        """
+
+        :param path: path to the database file, created if it does not exist
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # Batch mode may have several workers writing at once, wait for their locks rather than fail
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS columns ('
+                                'key TEXT PRIMARY KEY, '
+                                'sheetname TEXT, '
+                                'colname TEXT, '
+                                'created REAL, '
+                                'result TEXT)')
+        self.connection.commit()
+
+    def get(self, key):
+        """
+        Stored result of a column
+
+        :param key: str from column_key
+        :return: dict, or None if the column has not been analyzed with these parameters
+        """
+
+        row = self.connection.execute('SELECT result FROM columns WHERE key = ?', (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def put(self, key, sheetname, colname, result):
+        """
+        Store the result of a column, replacing any older result under the same key
+
+        :param key: str from column_key
+        :param sheetname: sanitized sheet name, for reference only
+        :param colname: sanitized column name, for reference only
+        :param result: dict, json-serializable
+        :return: True
+        """
+
+        self.connection.execute('INSERT OR REPLACE INTO columns (key, sheetname, colname, created, result) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (key, sheetname, colname, time.time(), json.dumps(result)))
+
+        return True
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,598 @@
+"""
+AutoCal
+Online analysis of calcium imaging data as it is acquired
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import sys, argparse
+import time
+import numpy as np
+import caltrace, decay, eventtable, sg, tracelet
+
+
+class RingBuffer(object):
+    """
+    Object to hold the most recent rows of a growing signal in a fixed amount of memory.
+    Rows are addressed by their absolute index since the start of the recording; only the last
+    `capacity` rows can be read back.
+
+    """
+
+    __slots__ = ('data', 'capacity', 'count')
+
+    def __init__(self, capacity, columns=None):
+        """
+
+        :param capacity: int, number of rows kept
+        :param columns: int, number of columns, or None for a 1-D signal
+        """
+
+        self.capacity = capacity
+        self.data = np.zeros((capacity,) if columns is None else (capacity, columns))
+        self.count = 0
+
+    def append(self, rows):
+        """
+        Add rows at the end, overwriting the oldest ones once full
+
+        :param rows: ndarray, shape (k,) or (k, columns)
+        :return: True
+        """
+
+        rows = rows[-self.capacity:]
+        idx = np.arange(self.count, self.count + len(rows)) % self.capacity
+        self.data[idx] = rows
+        self.count += len(rows)
+
+        return True
+
+    def first(self):
+        """
+        Absolute index of the oldest row still held
+
+        :return: int
+        """
+
+        return max(self.count - self.capacity, 0)
+
+    def take(self, start, stop):
+        """
+        Copy of the rows from absolute index start up to (not including) stop
+
+        :param start: int
+        :param stop: int
+        :return: ndarray
+        """
+
+        assert self.first() <= start <= stop <= self.count, 'Rows no longer or not yet in the ring buffer'
+
+        return self.data[np.arange(start, stop) % self.capacity]
+
+
+class StreamAnalyzer(object):
+    """
+    Object to analyze interleaved 340/380 readings of many cells as they arrive.
+    Readings are paired into ratios by CalciumTrace, smoothened with the Savitzky-Golay coefficients of sg.py
+    as soon as the window is filled, and rises are detected from the derivative with the same run rule as
+    events.detect_rises, carried over from one chunk to the next. When the next rise of a cell starts, the
+    tracelet between the two rises is complete: its decay times and kinetic fit are calculated and the event
+    of the first rise is handed to the emit function.
+
+    The 340/380 order of every cell is decided once from the first `warmup` ratios with orient_ratios.
+    Memory use does not grow with the length of the recording: only the last `capacity` frames are kept, and
+    an event whose tracelet outgrows them is emitted without decay attributes.
+
+    """
+
+    def __init__(self, colnames, emit, x_tol=10, y_tol=0.0005, correct_background=False, window=15, order=3,
+                 warmup=200, capacity=65536, interpolate=True, model=2):
+        """
+
+        :param colnames: list of str, one name per data column
+        :param emit: function called with a dict of fields (see eventtable.EVENT_FIELDS) for every event
+        :param x_tol: int, x tolerance for peak detection
+        :param y_tol: float, y tolerance for peak detection
+        :param correct_background: T/F, as in CalciumTrace.make_ratio
+        :param window: int, Savitzky-Golay window size
+        :param order: int, Savitzky-Golay polynomial order
+        :param warmup: int, number of ratios to decide the 340/380 order from
+        :param capacity: int, number of frames kept in the ring buffers
+        :param interpolate: T/F whether to interpolate decay times at the level crossings
+        :param model: int, kinetic model of Tracelet.optimize
+        """
+
+        assert capacity > warmup and capacity > window, 'Ring buffers must hold more than the warmup and window'
+
+        self.colnames = list(colnames)
+        self.emit = emit
+        self.x_tol = x_tol
+        self.y_tol = y_tol
+        self.correct_background = correct_background
+        self.window = window
+        self.order = order
+        self.half = window // 2
+        self.warmup = warmup
+        self.interpolate = interpolate
+        self.model = model
+
+        n = len(self.colnames)
+        self.coefficients = sg.coefficients(window, order)
+
+        # Raw reading waiting for the other wavelength of its pair
+        self.unpaired = None
+
+        # Ratios collected before the 340/380 order is decided
+        self.warm_time = []
+        self.warm_ratio = []
+        self.flipped = None
+
+        self.time = RingBuffer(capacity)
+        self.ratio = RingBuffer(capacity, n)
+        self.smooth = RingBuffer(capacity, n)
+        self.head = None
+
+        # Detection state of every column: whether the last derivative was above y_tol, and where its run began
+        self.above = np.zeros(n, dtype=bool)
+        self.run_start = np.full(n, -1, dtype=int)
+
+        # Every fit starts from the last successful fit of its column
+        self.last_k = np.full(n, tracelet.DEFAULT_K0)
+
+        # Last detected rise of every column, still waiting for its tracelet to end
+        self.pending = [None] * n
+        self.events = np.zeros(n, dtype=int)
+
+    def feed(self, tm, raw_dt, bg):
+        """
+        Take new readings of every cell
+
+        :param tm: ndarray, shape (k,), time of each reading
+        :param raw_dt: ndarray, shape (k, columns), readings alternating between the two wavelengths
+        :param bg: ndarray, shape (k,), background of each reading
+        :return: True
+        """
+
+        tm = np.asarray(tm, dtype=float)
+        raw_dt = np.asarray(raw_dt, dtype=float).reshape(len(tm), len(self.colnames))
+        bg = np.asarray(bg, dtype=float)
+
+        if self.unpaired is not None:
+            tm = np.concatenate(([self.unpaired[0]], tm))
+            raw_dt = np.vstack((self.unpaired[1][None, :], raw_dt))
+            bg = np.concatenate(([self.unpaired[2]], bg))
+            self.unpaired = None
+
+        if len(tm) % 2 == 1:
+            self.unpaired = (tm[-1], raw_dt[-1], bg[-1])
+            tm, raw_dt, bg = tm[:-1], raw_dt[:-1], bg[:-1]
+
+        if len(tm) == 0:
+            return True
+
+        # Pair up the readings of each column as CalciumTrace does for a whole sheet
+        ratio = np.empty((len(tm) // 2, len(self.colnames)))
+        for c in range(len(self.colnames)):
+            trce = caltrace.CalciumTrace(sheetname='stream', colname=self.colnames[c], tm=tm, raw_dt=raw_dt[:, c],
+                                         bg=bg)
+            trce.make_ratio(correct_background=self.correct_background)
+            ratio[:, c] = trce.ratio
+
+        median_time = trce.median_time
+
+        if self.flipped is None:
+            self.warm_time.append(median_time)
+            self.warm_ratio.append(ratio)
+
+            if sum(len(t) for t in self.warm_time) >= self.warmup:
+                self._orient()
+
+            return True
+
+        self._process(median_time, ratio)
+
+        return True
+
+    def finish(self):
+        """
+        End of the recording: smoothen the last frames with the end padding of sg.savitzky_golay, close the
+        detection and emit the remaining events, which have no tracelet after them
+
+        :return: True
+        """
+
+        if self.flipped is None:
+            if sum(len(t) for t in self.warm_time) <= self.half:
+                return True
+            self._orient()
+
+        n = self.ratio.count
+        if n > self.half and self.head is not None:
+            tail = sg.tail_padding(self.ratio.take(n - self.half - 1, n), self.half)
+            self._smooth_until(n, tail)
+
+        for c in range(len(self.colnames)):
+            if self.pending[c] is not None:
+                self._emit(c, self.pending[c], None)
+                self.pending[c] = None
+
+        return True
+
+    def _orient(self):
+        """
+        Decide the 340/380 order of every column from the warmup ratios, then analyze them
+        """
+
+        warm_time = np.concatenate(self.warm_time)
+        warm_ratio = np.vstack(self.warm_ratio)
+        self.warm_time = []
+        self.warm_ratio = []
+
+        _, _, _, self.flipped = caltrace.orient_ratios(warm_ratio, size=self.window, order=self.order)
+
+        self._process(warm_time, warm_ratio)
+
+    def _process(self, median_time, ratio):
+        """
+        Add oriented frames and carry the analysis as far as the smoothing window allows
+        """
+
+        ratio = ratio.copy()
+        ratio[:, self.flipped] = 1. / ratio[:, self.flipped]
+
+        self._drop_stale(self.ratio.count + len(ratio))
+
+        self.time.append(median_time)
+        self.ratio.append(ratio)
+
+        if self.head is None:
+            if self.ratio.count <= self.half:
+                return
+            self.head = sg.head_padding(self.ratio.take(0, self.half + 1), self.half)
+
+        # A smoothened value needs half a window of ratios after it
+        self._smooth_until(self.ratio.count - self.half, None)
+
+    def _drop_stale(self, count):
+        """
+        Emit, without decay attributes, any pending event that would fall out of the ring buffers
+        once they hold count frames
+        """
+
+        oldest = count - self.ratio.capacity
+
+        for c in range(len(self.colnames)):
+            if self.pending[c] is not None and self.pending[c][0] < oldest:
+                sys.stderr.write('Tracelet of column ' + self.colnames[c] + ' longer than the ring buffer, '
+                                 'emitting its event without decay attributes\n')
+                self._emit(c, self.pending[c], None)
+                self.pending[c] = None
+
+    def _smooth_until(self, stop, tail):
+        """
+        Smoothen frames up to (not including) stop, take the derivative and detect rises in it
+
+        :param stop: int, absolute frame index
+        :param tail: ndarray of the end padding, or None while the recording goes on
+        """
+
+        start = self.smooth.count
+        if stop <= start:
+            return
+
+        h = self.half
+        n = self.ratio.count
+
+        # Ratios under the window of every new position, with the start and end padding where needed
+        segment = self.ratio.take(max(start - h, 0), min(stop + h, n))
+        if start < h:
+            segment = np.vstack((self.head[start:], segment))
+        if stop + h > n:
+            segment = np.vstack((segment, tail[:stop + h - n]))
+
+        # Same accumulation as sg.savitzky_golay uses for several signals at once
+        length = stop - start
+        smooth = self.coefficients[0] * segment[:length]
+        for j in range(1, self.window):
+            smooth += self.coefficients[j] * segment[j:j + length]
+
+        # The derivative at i is smooth[i + 1] - smooth[i], so it reaches back one frame
+        if start > 0:
+            previous = self.smooth.take(start - 1, start)
+            deriv = np.diff(np.vstack((previous, smooth)), axis=0)
+            self.smooth.append(smooth)
+            self._detect(start - 1, deriv)
+        else:
+            self.smooth.append(smooth)
+            self._detect(0, np.diff(smooth, axis=0))
+
+    def _detect(self, offset, deriv):
+        """
+        Continue the run-length detection of events.detect_rises over new derivative values
+
+        :param offset: int, absolute index of the first derivative value
+        :param deriv: ndarray, shape (k, columns)
+        """
+
+        if len(deriv) == 0:
+            return
+
+        above = deriv > self.y_tol
+
+        for c in range(len(self.colnames)):
+            padded = np.concatenate(([self.above[c]], above[:, c]))
+            for i in np.flatnonzero(padded[1:] != padded[:-1]):
+                if above[i, c]:
+                    self.run_start[c] = offset + i
+
+                else:
+                    # A run has ended, it is a rise if it lasted long enough
+                    stop = offset + i
+                    if stop - self.run_start[c] > self.x_tol:
+                        self._rise(c, self.run_start[c], stop - 1)
+                    self.run_start[c] = -1
+
+            self.above[c] = above[-1, c]
+
+    def _rise(self, c, start, end):
+        """
+        A new rise closes the tracelet of the previous one, whose event is then complete
+        """
+
+        if self.pending[c] is not None:
+            self._emit(c, self.pending[c], start)
+
+        self.pending[c] = (start, end)
+
+    def _emit(self, c, rise, tracelet_end):
+        """
+        Calculate and emit the attributes of one event
+
+        :param c: int, column
+        :param rise: (start, end) absolute indices of the rise
+        :param tracelet_end: absolute index after the end of its tracelet, or None if there is none
+        """
+
+        start, end = rise
+        t_start, t_end = self.time.take(start, start + 1)[0], self.time.take(end, end + 1)[0]
+
+        event = {'column': self.colnames[c],
+                 'event': int(self.events[c]),
+                 'start_time': t_start,
+                 'end_time': t_end,
+                 'rise_time': t_end - t_start,
+                 'amplitude': self.ratio.take(end, end + 1)[0, c] - self.ratio.take(start, start + 1)[0, c],
+                 't10': np.nan, 't50': np.nan, 't90': np.nan, 't100': np.nan,
+                 'k': np.nan, 'tau': np.nan, 'y1': np.nan, 'R2': np.nan,
+                 'fit_success': False,
+                 'fit_evaluations': 0}
+
+        if tracelet_end is not None:
+            x = self.time.take(end, tracelet_end)
+            y = self.ratio.take(end, tracelet_end)[:, c]
+            y_sm = self.smooth.take(end, tracelet_end)[:, c]
+
+            decay_t = decay.decay_times(x, y_sm, [0], [len(x)], interpolate=self.interpolate)
+            if decay_t['valid'][0]:
+                for name in ('t10', 't50', 't90', 't100'):
+                    event[name] = decay_t[name][0]
+
+            trcelt = tracelet.Tracelet(tm=x, dt=y, sm=y_sm)
+            trcelt.optimize(model=self.model, k0=self.last_k[c])
+            if trcelt.opt_success and np.isfinite(trcelt.opt_k) and trcelt.opt_k > 0:
+                self.last_k[c] = trcelt.opt_k
+            event.update(fit_success=trcelt.opt_success, fit_evaluations=trcelt.opt_nfev)
+
+            # As in the event table, a failed fit leaves k, tau, y1 and R2 NaN rather than its placeholders
+            if trcelt.opt_success:
+                event.update(k=trcelt.opt_k, tau=trcelt.opt_tau, y1=trcelt.opt_y1, R2=trcelt.R2)
+
+        self.events[c] += 1
+        self.emit(event)
+
+
+def read_chunks(f, binary_columns=None, follow=False, poll=0.5, idle_timeout=None, chunk_size=1 << 16):
+    """
+    Read a growing file or pipe chunk by chunk. CSV input yields lists of complete lines, binary input
+    (little-endian float64 rows of binary_columns values) yields arrays of complete rows; anything cut off
+    is kept until the rest arrives.
+
+    :param f: file object, opened in binary mode
+    :param binary_columns: int, number of values per binary row, or None for CSV
+    :param follow: T/F whether to wait for more data at the end of the file, as tail -f does
+    :param poll: float, seconds to wait between attempts while following
+    :param idle_timeout: float, stop following after this many seconds without data, or None to follow forever
+    :param chunk_size: int, number of bytes to read at a time
+    :return: generator of lists of str or of ndarrays
+    """
+
+    row_bytes = None if binary_columns is None else 8 * binary_columns
+    rest = b''
+    idle = 0.
+
+    while True:
+        # Take whatever is there rather than block until a full chunk arrives
+        block = f.read1(chunk_size)
+
+        if not block:
+            if not follow or (idle_timeout is not None and idle >= idle_timeout):
+                break
+            time.sleep(poll)
+            idle += poll
+            continue
+
+        idle = 0.
+        data = rest + block
+
+        if row_bytes is None:
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            if cut > 0:
+                yield data[:cut].decode().splitlines()
+
+        else:
+            cut = len(data) - len(data) % row_bytes
+            rest = data[cut:]
+            if cut > 0:
+                yield np.frombuffer(data[:cut], dtype='<f8').reshape(-1, binary_columns)
+
+    # A last CSV line without a line break
+    if row_bytes is None and rest.strip():
+        yield rest.decode().splitlines()
+
+
+def parse_lines(lines):
+    """
+    Numeric rows of CSV lines, with NaN for empty or non-numeric fields
+
+    :param lines: list of str
+    :return: ndarray, shape (len(lines), fields)
+    """
+
+    rows = []
+    for line in lines:
+        row = []
+        for field in line.split(','):
+            try:
+                row.append(float(field))
+            except ValueError:
+                row.append(np.nan)
+        rows.append(row)
+
+    width = max(len(row) for row in rows)
+
+    return np.array([row + [np.nan] * (width - len(row)) for row in rows])
+
+
+def stream(args):
+    """
+    Follow a recording and write one line per event as soon as it is complete
+
+    Usage: python stream.py live.csv --follow -o live_events.csv
+    Usage: acquire | python stream.py - --binary 20
+
+    The input has the column layout of the workbooks read by main.py: time in the second column,
+    the cells from the sixth column on, and the background in the column given by --bg.
+
+    :param args: parsed arguments
+    :return: True
+    """
+
+    f = sys.stdin.buffer if args.path == '-' else open(args.path, 'rb')
+    out = sys.stdout if args.out is None else open(args.out, 'w')
+
+    fields = ['column'] + [name for (name, _) in eventtable.EVENT_FIELDS]
+    out.write(','.join(fields) + '\n')
+    out.flush()
+
+    def emit(event):
+        out.write(','.join(str(event[name]) for name in fields) + '\n')
+        out.flush()
+
+    analyzer = None
+    header = None
+
+    try:
+        for chunk in read_chunks(f, binary_columns=args.binary, follow=args.follow, poll=args.poll,
+                                 idle_timeout=args.idle_timeout):
+
+            if args.binary is None:
+                # A first line that is not numbers holds the column names
+                if analyzer is None and header is None:
+                    first = chunk[0].split(',')
+                    if np.isnan(parse_lines(chunk[:1])[0, 1:]).all():
+                        header = first
+                        chunk = chunk[1:]
+                    else:
+                        header = []
+
+                chunk = [line for line in chunk if line.strip()]
+                if not chunk:
+                    continue
+                rows = parse_lines(chunk)
+
+            else:
+                rows = chunk
+
+            if analyzer is None:
+                width = rows.shape[1]
+                b_col = args.bg % width
+                d_cols = [c for c in range(5, width) if c != b_col]
+                names = [str(header[c]).strip() if header and c < len(header) else 'Column' + str(c)
+                         for c in d_cols]
+                analyzer = StreamAnalyzer(colnames=names,
+                                          emit=emit,
+                                          x_tol=args.x_tol,
+                                          y_tol=args.y_tol,
+                                          correct_background=args.cor_bg,
+                                          warmup=args.warmup,
+                                          capacity=args.capacity,
+                                          interpolate=not args.no_interp)
+
+            analyzer.feed(rows[:, 1], rows[:, d_cols], rows[:, b_col])
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        if analyzer is not None:
+            analyzer.finish()
+
+        if f is not sys.stdin.buffer:
+            f.close()
+        if out is not sys.stdout:
+            out.close()
+
+    return True
+
+
+#
+# Code for running stream with parsed arguments from command line
+#
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='''\
+    AutoCal v.0.2.0
+    Edward Lau 2017 - lau1@stanford.edu
+    Analyzes calcium trace data as it is recorded and writes one line per event.''')
+
+    parser.add_argument('path', help='path to a growing CSV or binary recording, or - for standard input')
+    parser.add_argument('-o', '--out', help='path to the event file, standard output if not given', default=None)
+    parser.add_argument('--binary', help='read little-endian float64 rows of this many values instead of CSV.',
+                        type=int, default=None)
+    parser.add_argument('-f', '--follow', action='store_true', help='keep waiting for new data at the end of the file.')
+    parser.add_argument('--poll', help='seconds between checks for new data while following (float).',
+                        type=float, default=0.5)
+    parser.add_argument('--idle_timeout', help='stop following after this many seconds without new data (float).',
+                        type=float, default=None)
+    parser.add_argument('-x', '--x_tol', help='X tolerance for peak detection (integer).',
+                        type=int, default=10)
+    parser.add_argument('-y', '--y_tol', help='Y tolerance for peak detection (float).',
+                        type=float, default=0.0005)
+    parser.add_argument('-c', '--cor_bg', help='Correct background.',
+                        action='store_true')
+    parser.add_argument('-b', '--bg', help='Index of background column.',
+                        type=int, default=-1)
+    parser.add_argument('--no_interp', action='store_true',
+                        help='snap t10/t50/t90 to whole samples instead of interpolating at the level crossings.')
+    parser.add_argument('--warmup', help='number of ratios to decide the 340/380 order from (integer).',
+                        type=int, default=200)
+    parser.add_argument('--capacity', help='number of frames kept in memory per cell (integer).',
+                        type=int, default=65536)
+
+    parser.set_defaults(func=stream)
+
+    # Print help message if no arguments are given
+    if len(sys.argv[1:]) == 0:
+        parser.print_help()
+        parser.exit()
+
+    # Parse all the arguments
+    args = parser.parse_args()
+
+    # Run the function in the argument
+    args.func(args)
@@ -0,0 +1,55 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import os, sys
+import argparse
+import pytest
+
+# The pipeline modules live one directory up, the synthetic data generator in benchmarks/
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+sys.path.insert(0, root)
+
+
+@pytest.fixture
+def main_args():
+    """
+    Arguments of main.py as parsed from the command line, for a run without figures
+
+    :return: function of (path, out, **overrides) returning an argparse.Namespace
+    """
+
+    def make(path, out, **overrides):
+        args = argparse.Namespace(path=path, out=out, x_tol=10, y_tol=0.0005, cor_bg=False, bg=-1, batch_fit=False,
+                                  dtype='float64', precision_report=False, cold_start=False, no_interp=False, jobs=1,
+                                  cache=None, store=None, events_format='csv', no_plots=True, plot_sample=None,
+                                  dpi=300, render_jobs=None, profile=False, profile_dump=None, verbose=False)
+        for (name, value) in overrides.items():
+            setattr(args, name, value)
+        return args
+
+    return make
+
+
+@pytest.fixture(params=['numpy', 'numba'])
+def backend(request, monkeypatch):
+    """
+    Run a test once on the NumPy path and once on the compiled kernels, where Numba is installed
+
+    :return: 'numpy' or 'numba'
+    """
+
+    import kernels
+
+    if request.param == 'numba' and not kernels.available():
+        pytest.skip('Numba is not installed')
+
+    monkeypatch.setattr(kernels, '_backend', request.param)
+
+    return request.param
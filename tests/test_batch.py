@@ -0,0 +1,44 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import csv
+import os
+import batch
+import synth
+
+
+def test_labels_of_same_named_workbooks():
+    paths = [os.path.join('data', 'a', 'x.xlsx'), os.path.join('data', 'b', 'x.xlsx')]
+    labels = batch.workbook_labels(paths)
+
+    assert labels == {paths[0]: 'a/x', paths[1]: 'b/x'}
+    assert batch.workbook_out('out', labels[paths[0]]) != batch.workbook_out('out', labels[paths[1]])
+
+
+def test_labels_of_one_directory():
+    paths = [os.path.join('data', 'x.xlsx'), os.path.join('data', 'y.xlsx')]
+
+    assert batch.workbook_labels(paths) == {paths[0]: 'x', paths[1]: 'y'}
+
+
+def test_same_named_workbooks_do_not_overwrite(tmp_path, main_args):
+    for (sub, seed) in (('a', 0), ('b', 1)):
+        os.makedirs(str(tmp_path / 'data' / sub))
+        synth.write_calcium_workbook(str(tmp_path / 'data' / sub / 'x.xlsx'), seed=seed, cells=2, frames=600)
+
+    out = str(tmp_path / 'out')
+    summary_path = batch.run_batch(main_args(str(tmp_path / 'data' / '*' / 'x.xlsx'), out))
+
+    for sub in ('a', 'b'):
+        assert os.path.isfile(os.path.join(out, sub, 'x', 'events.csv'))
+
+    with open(summary_path) as f:
+        workbooks = [row['workbook'] for row in csv.DictReader(f) if row['sheet'] == 'ALL']
+
+    assert workbooks == ['a/x', 'b/x', 'ALL']
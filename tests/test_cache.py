@@ -0,0 +1,109 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import os
+import numpy as np
+import openpyxl as xl
+import ingest
+
+
+def write_workbook(path, seed=0):
+    """
+    Write a workbook of two sheets with empty cells, a date in the header and a short last sheet
+
+    :param path: path to the xlsx file
+    :param seed: int, random seed
+    :return: True
+    """
+
+    import datetime
+
+    rng = np.random.RandomState(seed)
+    wb = xl.Workbook(write_only=True)
+
+    for (title, rows) in (('Sheet1', 300), ('Sheet 2', 7)):
+        ws = wb.create_sheet(title=title)
+        ws.append(['Index', 'Time', datetime.datetime(2017, 6, 27), None, 'Cell1'])
+        for i in range(rows):
+            ws.append([i, 0.005 * i, None if i % 5 == 0 else float(rng.rand()), 'n/a', float(rng.rand())])
+
+    wb.save(path)
+
+    return True
+
+
+def read(path, **kwargs):
+    return list(ingest.read_workbook(path, **kwargs))
+
+
+def assert_same_sheets(sheets, expected):
+
+    # The cache keeps header cells that are not numbers or text, such as dates, as text
+    def header(sheet):
+        return [h if h is None or isinstance(h, (str, int, float)) else str(h) for h in sheet.header]
+
+    assert [sheet.name for sheet in sheets] == [sheet.name for sheet in expected]
+
+    for (sheet, other) in zip(sheets, expected):
+        assert header(sheet) == header(other)
+        assert sheet.data.dtype == other.data.dtype
+        np.testing.assert_array_equal(sheet.data, other.data)
+        assert sorted(sheet.exact) == sorted(other.exact)
+        for j in other.exact:
+            np.testing.assert_array_equal(sheet.column(j), other.column(j))
+
+
+def test_cached_sheets_are_the_parsed_sheets(tmp_path, monkeypatch):
+    path = str(tmp_path / 'recording.xlsx')
+    write_workbook(path)
+    cache_dir = str(tmp_path / 'cache')
+
+    precisions = ((float, ()), (np.float32, (1,)))
+    parsed = [read(path, dtype=dtype, exact=exact) for (dtype, exact) in precisions]
+
+    for ((dtype, exact), sheets) in zip(precisions, parsed):
+        assert_same_sheets(read(path, cache_dir=cache_dir, dtype=dtype, exact=exact), sheets)
+
+    # Both precisions are cached apart, and the workbook is not parsed again
+    assert len(os.listdir(cache_dir)) == 2
+
+    def read_sheet(*args, **kwargs):
+        raise AssertionError('workbook parsed again')
+
+    monkeypatch.setattr(ingest, 'read_sheet', read_sheet)
+
+    for ((dtype, exact), sheets) in zip(precisions, parsed):
+        assert_same_sheets(read(path, cache_dir=cache_dir, dtype=dtype, exact=exact), sheets)
+
+
+def test_changed_workbooks_are_parsed_again(tmp_path):
+    path = str(tmp_path / 'recording.xlsx')
+    cache_dir = str(tmp_path / 'cache')
+
+    write_workbook(path, seed=0)
+    first = read(path, cache_dir=cache_dir)
+
+    write_workbook(path, seed=1)
+    second = read(path, cache_dir=cache_dir)
+
+    assert not np.array_equal(first[0].data, second[0].data, equal_nan=True)
+    assert_same_sheets(second, read(path))
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_unfinished_reads_are_not_cached(tmp_path):
+    path = str(tmp_path / 'recording.xlsx')
+    write_workbook(path)
+    cache_dir = str(tmp_path / 'cache')
+
+    sheets = ingest.read_workbook(path, cache_dir=cache_dir)
+    next(sheets)
+    sheets.close()
+
+    assert not os.path.isdir(cache_dir) or not os.listdir(cache_dir)
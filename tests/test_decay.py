@@ -0,0 +1,103 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import decay
+
+
+def tracelet_times(x, y_sm):
+    """
+    The original per-tracelet decay intervals of main.py
+
+    :param x: ndarray, time of the tracelet
+    :param y_sm: ndarray, smoothened ratio of the tracelet
+    :return: (t10, t50, t90, t100), or None where the original skipped the tracelet
+    """
+
+    ratio_at_90pct = (0.9 * (np.max(y_sm) - y_sm[-1])) + y_sm[-1]
+    ratio_at_50pct = (0.5 * (np.max(y_sm) - y_sm[-1])) + y_sm[-1]
+    ratio_at_10pct = (0.1 * (np.max(y_sm) - y_sm[-1])) + y_sm[-1]
+
+    interval_t10 = [x[i] for i in range(len(x)) if y_sm[i] > ratio_at_90pct]
+    interval_t50 = [x[i] for i in range(len(x)) if y_sm[i] > ratio_at_50pct]
+    interval_t90 = [x[i] for i in range(len(x)) if y_sm[i] > ratio_at_10pct]
+
+    try:
+        return (interval_t10[-1] - interval_t10[0], interval_t50[-1] - interval_t50[0],
+                interval_t90[-1] - interval_t90[0], x[-1] - x[0])
+    except IndexError:
+        return None
+
+
+def trace(seed, n=4000):
+    """
+    A trace of decays with noise, some flat stretches, and tracelets of many lengths, down to a single point
+
+    :param seed: int, random seed
+    :param n: int, number of points
+    :return: (x, y_sm, starts, ends)
+    """
+
+    rng = np.random.RandomState(seed)
+    x = 0.005 * np.arange(n)
+    y_sm = 1. + np.exp(-8. * (x % 1.)) + rng.normal(0, 0.02, n)
+    y_sm[1000:1100] = 1.
+
+    bounds = np.unique(np.concatenate((rng.randint(0, n, 60), [1000, 1100, 1101, 1102])))
+    starts, ends = bounds[:-1], bounds[1:]
+
+    return x, y_sm, starts, ends
+
+
+def test_without_interpolation_matches_the_original_intervals():
+
+    for seed in range(5):
+        x, y_sm, starts, ends = trace(seed)
+        times = decay.decay_times(x, y_sm, starts, ends, interpolate=False)
+
+        for (i, (s, e)) in enumerate(zip(starts, ends)):
+            expected = tracelet_times(x[s:e], y_sm[s:e])
+
+            assert times['valid'][i] == (expected is not None)
+            if expected is not None:
+                got = (times['t10'][i], times['t50'][i], times['t90'][i], times['t100'][i])
+                np.testing.assert_allclose(got, expected, rtol=0, atol=1e-12)
+
+
+def test_interpolation_stays_within_a_sample_of_each_end():
+
+    x, y_sm, starts, ends = trace(0)
+    snapped = decay.decay_times(x, y_sm, starts, ends, interpolate=False)
+    times = decay.decay_times(x, y_sm, starts, ends)
+
+    np.testing.assert_array_equal(times['valid'], snapped['valid'])
+    np.testing.assert_array_equal(times['t100'], snapped['t100'])
+
+    valid = times['valid']
+    for name in ('t10', 't50', 't90'):
+        assert (times[name][valid] >= snapped[name][valid] - 1e-12).all()
+        assert (times[name][valid] <= snapped[name][valid] + 2 * 0.005 + 1e-12).all()
+
+
+def test_interpolation_finds_the_crossings_of_a_straight_line():
+
+    # Rises from 0 to 1 over the first 11 points and falls back to 0 over the next 11
+    x = 0.1 * np.arange(21)
+    y_sm = np.concatenate((np.linspace(0, 1, 11), np.linspace(1, 0, 11)[1:]))
+    times = decay.decay_times(x, y_sm, [0], [21])
+
+    np.testing.assert_allclose([times['t10'][0], times['t50'][0], times['t90'][0]], [0.2, 1., 1.8])
+    assert times['t100'][0] == x[-1]
+
+
+def test_no_tracelets():
+
+    times = decay.decay_times(np.arange(10.), np.ones(10), [], [])
+
+    assert all(times[name].size == 0 for name in ('t10', 't50', 't90', 't100', 'valid'))
@@ -0,0 +1,95 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import pytest
+import events
+import kernels
+
+
+def scan_rises(deriv, y_tol, x_tol):
+    """
+    The original point by point scan of main.py for rising intervals
+
+    :param deriv: array_like, first derivative
+    :param y_tol: float, y tolerance
+    :param x_tol: int, x tolerance
+    :return: (rise_starts, rise_ends) lists of int
+    """
+
+    rise_starts = []
+    rise_ends = []
+    interval = []
+
+    for i in range(len(deriv)):
+        if deriv[i] > y_tol:
+            interval.append(i)
+        else:
+            if len(interval) > x_tol:
+                rise_starts.append(interval[0])
+                rise_ends.append(interval[-1])
+            interval = []
+
+    return rise_starts, rise_ends
+
+
+def derivatives(seed, n=3000):
+    """
+    Derivative-like noise with runs of many lengths above the tolerance, some empty cells, and a run still
+    going at the end
+
+    :param seed: int, random seed
+    :param n: int, number of points
+    :return: ndarray
+    """
+
+    rng = np.random.RandomState(seed)
+    deriv = np.sin(np.linspace(0, rng.uniform(20, 200), n)) + rng.normal(0, 0.4, n)
+    deriv[rng.randint(0, n, 20)] = np.nan
+    deriv[-30:] = 1.
+
+    return deriv
+
+
+@pytest.mark.parametrize('x_tol', [0, 1, 5, 40])
+def test_detect_rises_matches_the_scan(backend, x_tol):
+
+    for seed in range(10):
+        for dtype in (np.float64, np.float32):
+            deriv = derivatives(seed).astype(dtype)
+            rise_starts, rise_ends = events.detect_rises(deriv, 0.5, x_tol)
+
+            assert kernels.backend() == backend
+            assert (rise_starts.tolist(), rise_ends.tolist()) == scan_rises(deriv, 0.5, x_tol)
+
+
+def test_detect_rises_of_short_traces(backend):
+
+    for deriv in ([], [1.], [0.], [1., 0.], [1., 1., 0.], [0., 1., 1.]):
+        rise_starts, rise_ends = events.detect_rises(np.array(deriv), 0.5, 0)
+
+        assert (rise_starts.tolist(), rise_ends.tolist()) == scan_rises(deriv, 0.5, 0)
+
+
+@pytest.mark.parametrize('x_tol', [0, 5, 40])
+def test_detect_rises_columns_matches_the_scan_of_each_column(backend, x_tol):
+
+    lengths = np.array([3000, 2000, 17, 1, 0, 2500])
+    columns = np.full((3000, lengths.size), np.nan)
+    for (j, n) in enumerate(lengths):
+        columns[:n, j] = derivatives(j)[:n]
+
+    # What lies past the end of a column must not count, even if it is above the tolerance
+    columns[2000:2100, 1] = 1.
+
+    found_columns, rise_starts, rise_ends = events.detect_rises_columns(columns, lengths, 0.5, x_tol)
+
+    expected = [(j, s, e) for (j, n) in enumerate(lengths) for (s, e) in zip(*scan_rises(columns[:n, j], 0.5, x_tol))]
+
+    assert list(zip(found_columns.tolist(), rise_starts.tolist(), rise_ends.tolist())) == expected
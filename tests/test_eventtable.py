@@ -0,0 +1,35 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import eventtable
+import tracelet
+
+
+def test_failed_fits_are_missing():
+    tm = 0.005 * np.arange(300)
+    ratio = 1. + 0.5 * np.exp(-20. * (tm % 0.5))
+
+    # Three rises, with a decay tracelet after each of the first two
+    rise_starts = np.array([0, 100, 200])
+    rise_ends = np.array([5, 105, 205])
+    trcelts = tracelet.TraceletSet(tm=tm, dt=ratio, sm=ratio, starts=rise_ends[:-1], ends=rise_starts[1:])
+
+    trcelts.opt_success[:] = [True, False]
+    trcelts.opt_k[:] = [20., 1.]
+    trcelts.opt_tau[:] = 1. / trcelts.opt_k
+    trcelts.opt_y1[:] = [1., 0.5]
+    trcelts.R2[:] = [0.99, 0.3]
+
+    table = eventtable.column_events(tm, ratio, rise_starts, rise_ends, trcelts.decay_times(), trcelts)
+
+    assert list(table['fit_success']) == [True, False, False]
+    assert table['k'][0] == 20. and table['tau'][0] == 0.05 and table['y1'][0] == 1. and table['R2'][0] == 0.99
+    for name in ('k', 'tau', 'y1', 'R2'):
+        assert np.all(np.isnan(table[name][1:]))
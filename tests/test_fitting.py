@@ -0,0 +1,105 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import fitting
+import main
+import synth
+
+
+def noisy_tracelets(count=200, seed=0):
+    """
+    Tracelets of pure noise around a flat baseline, without any decay to fit
+
+    :param count: int, number of tracelets
+    :param seed: int, random seed
+    :return: (xs, ys) lists of ndarrays
+    """
+
+    rng = np.random.RandomState(seed)
+    xs = []
+    ys = []
+
+    for n in rng.randint(5, 60, count):
+        xs.append(3. + 0.005 * np.arange(n))
+        ys.append(1. + rng.normal(0, 0.01, n))
+
+    return xs, ys
+
+
+def test_batch_fits_a_decay():
+    x = 0.005 * np.arange(80)
+    y = 1. + 0.5 * np.exp(-20. * x)
+
+    res = fitting.fit_first_batch([x], [y])
+
+    assert res.success[0]
+    assert np.isclose(res.k[0], 20., rtol=1e-6)
+    assert np.isclose(res.y1[0], 1., rtol=1e-6)
+
+
+def test_batch_flat_tracelet_is_not_successful():
+    x = 0.005 * np.arange(30)
+
+    res = fitting.fit_first_batch([x, x], [np.ones(30), np.full(30, 2.)])
+
+    assert not res.success.any()
+
+
+def test_batch_noisy_tracelets_never_succeed_with_a_bad_k():
+    xs, ys = noisy_tracelets()
+
+    with np.errstate(over='ignore'):
+        res = fitting.fit_first_batch(xs, ys)
+
+    # Noise gives no positive, determined k for many of the tracelets, and none of those may count as fitted
+    assert not res.success.all()
+    assert np.all(np.isfinite(res.k[res.success]) & (res.k[res.success] > 0))
+    assert np.all(np.isfinite(res.tau[res.success]) & (res.tau[res.success] > 0))
+
+
+def test_batch_degenerate_fits_of_a_noisy_workbook(tmp_path, main_args):
+    # Heavily damped steps on two of these tracelets used to count as converged, at k=2.4e-7 with R2=-0.24 and
+    # at k=5e-6 with a plateau of -3081, which took the mean tau of the sheet to 45311
+    path = str(tmp_path / 'noisy.xlsx')
+    synth.write_calcium_workbook(path, seed=3, cells=10, frames=3000, noise=0.08, flipped=0.5)
+
+    tables = []
+    main.parsefile(main_args(path, str(tmp_path / 'out'), batch_fit=True), tables=tables)
+    table = tables[0]
+
+    fitted = table['fit_success']
+    for (column, event) in (('Cell1', 1), ('Cell7', 10)):
+        assert not fitted[(table['column'] == column) & (table['event'] == event)].any()
+
+    assert fitted.any()
+    assert np.all(table['R2'][fitted] >= 0)
+    assert np.all(table['k'][fitted] > 0)
+    assert np.mean(table['tau'][fitted]) < 10.
+
+
+def test_varpro_fits_a_decay():
+    x = 3. + 0.005 * np.arange(80)
+    y = 1. + 0.5 * np.exp(-20. * (x - x[0]))
+
+    res = fitting.fit_first_varpro(x, y)
+
+    assert res.success and res.method == 'varpro'
+    assert np.isclose(res.x[0], 20., rtol=1e-6)
+    assert np.isclose(res.x[1], 1., rtol=1e-6)
+
+
+def test_varpro_never_succeeds_with_a_non_positive_k():
+    xs, ys = noisy_tracelets()
+
+    results = [fitting.fit_first_varpro(x, y) for (x, y) in zip(xs, ys)]
+
+    # Noise sends many of the tracelets to the unbounded fallback, which must not count a k <= 0 as fitted
+    assert any(res.method == 'least_squares' for res in results)
+    assert all(res.x[0] > 0 for res in results if res.success)
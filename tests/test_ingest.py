@@ -0,0 +1,63 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import os
+import numpy as np
+import openpyxl as xl
+import ingest
+
+
+def write_workbook(path, times):
+    """
+    Write a one-sheet workbook of an index, a time and a data column
+
+    :param path: path to the xlsx file
+    :param times: ndarray of times
+    :return: True
+    """
+
+    wb = xl.Workbook(write_only=True)
+    ws = wb.create_sheet(title='Sheet1')
+    ws.append(['Index', 'Time', 'Cell1'])
+
+    for (i, t) in enumerate(times):
+        ws.append([i, float(t), 1. + 0.001 * i])
+
+    wb.save(path)
+
+    return True
+
+
+def test_float32_keeps_the_time_column_exact(tmp_path):
+    # Late in a two-hour recording at 200 Hz, float32 cannot resolve the 5 ms steps
+    times = 7000. + 0.005 * np.arange(200)
+    path = str(tmp_path / 'long.xlsx')
+    write_workbook(path, times)
+
+    for cache_dir in (None, str(tmp_path / 'cache'), str(tmp_path / 'cache')):
+        sheet = list(ingest.read_workbook(path, cache_dir=cache_dir, dtype=np.float32, exact=(1,)))[0]
+
+        assert sheet.data.dtype == np.float32
+        assert sheet.column(2).dtype == np.float32
+        assert sheet.column(1).dtype == np.float64
+        assert np.array_equal(sheet.column(1), times)
+
+    assert os.listdir(str(tmp_path / 'cache'))
+
+
+def test_float64_reads_every_column_once(tmp_path):
+    times = 0.005 * np.arange(20)
+    path = str(tmp_path / 'short.xlsx')
+    write_workbook(path, times)
+
+    sheet = next(ingest.read_workbook(path, exact=(1,)))
+
+    assert sheet.exact == {}
+    assert np.array_equal(sheet.column(1), times)
+    assert np.array_equal(sheet.column(0), np.arange(20))
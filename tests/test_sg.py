@@ -0,0 +1,109 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import math
+import numpy as np
+import pytest
+import sg
+
+
+def cookbook_filter(y, window_size, order, deriv=0, rate=1):
+    """
+    The original one-signal filter of sg.py, coefficients and padding recomputed on every call
+
+    :param y: ndarray, shape (N,)
+    :param window_size: int, odd
+    :param order: int
+    :param deriv: int
+    :param rate: sampling rate
+    :return: ndarray, shape (N,)
+    """
+
+    half_window = window_size // 2
+
+    b = np.array([[k**i for i in range(order + 1)] for k in range(-half_window, half_window+1)], dtype=float)
+    m = np.linalg.pinv(b)[deriv] * rate**deriv * math.factorial(deriv)
+
+    first_vals = y[0] - np.abs(y[1:half_window+1][::-1] - y[0])
+    last_vals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
+
+    return np.convolve(m[::-1], np.concatenate((first_vals, y, last_vals)), mode='valid')
+
+
+def signals(seed, n=500, columns=6):
+    """
+    Noisy calcium-like signals, one per column
+
+    :param seed: int, random seed
+    :param n: int, number of points
+    :param columns: int, number of signals
+    :return: ndarray, shape (n, columns)
+    """
+
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 10, n)[:, np.newaxis]
+
+    return np.sin(t * rng.uniform(1, 5, columns)) + rng.normal(0, 0.1, (n, columns))
+
+
+@pytest.mark.parametrize('window_size, order, deriv', [(3, 1, 0), (13, 3, 0), (15, 3, 1), (51, 3, 0)])
+def test_one_signal_matches_the_cookbook_filter(backend, window_size, order, deriv):
+
+    y = signals(0)[:, 0]
+
+    smooth, diff = sg.savitzky_golay(y, window_size, order, deriv, diff=True)
+    expected = cookbook_filter(y, window_size, order, deriv)
+
+    np.testing.assert_allclose(smooth, expected, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(diff, np.diff(expected), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('axis', [0, 1])
+def test_columns_match_the_cookbook_filter_of_each(backend, axis):
+
+    y = signals(1)
+    smooth = sg.savitzky_golay(y if axis == 0 else y.T, 13, 3, axis=axis)
+
+    for j in range(y.shape[1]):
+        got = smooth[:, j] if axis == 0 else smooth[j]
+        np.testing.assert_allclose(got, cookbook_filter(y[:, j], 13, 3), rtol=0, atol=1e-12)
+
+
+def test_columns_of_different_lengths_are_filtered_on_their_own(backend):
+
+    y = signals(2)
+    lengths = np.array([500, 400, 14, 250, 499, 100])
+    for (j, n) in enumerate(lengths):
+        y[n:, j] = np.nan
+
+    smooth, diff = sg.savitzky_golay(y, 13, 3, diff=True, lengths=lengths)
+
+    for (j, n) in enumerate(lengths):
+        expected = cookbook_filter(y[:n, j], 13, 3)
+        np.testing.assert_allclose(smooth[:n, j], expected, rtol=0, atol=1e-12)
+        np.testing.assert_allclose(diff[:n - 1, j], np.diff(expected), rtol=0, atol=1e-12)
+        assert np.isnan(smooth[n:, j]).all()
+
+
+def test_single_precision_is_kept(backend):
+
+    y = signals(3).astype(np.float32)
+    smooth, diff = sg.savitzky_golay(y, 13, 3, diff=True)
+
+    assert smooth.dtype == np.float32 and diff.dtype == np.float32
+    np.testing.assert_allclose(smooth[:, 0], cookbook_filter(y[:, 0].astype(float), 13, 3), rtol=0, atol=1e-5)
+
+
+def test_coefficients_are_shared_and_read_only():
+
+    m = sg.coefficients(13, 3)
+
+    assert sg.coefficients(13, 3) is m
+    with pytest.raises(ValueError):
+        m[0] = 0.
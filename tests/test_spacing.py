@@ -0,0 +1,73 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import spacing
+import synth
+
+
+def profiles(seed=0, noise=0.05):
+    """
+    Simulated line profiles padded into columns
+
+    :param seed: int, random seed
+    :param noise: float, relative noise of the intensity
+    :return: (dist, reads, lengths, true spacing of each profile)
+    """
+
+    simulated = synth.sarcomere_arrays(profiles=12, length=300, noise=noise, seed=seed)
+    dist, lengths = spacing.pad_columns([d for (d, _, _) in simulated])
+    reads, _ = spacing.pad_columns([i for (_, i, _) in simulated])
+
+    return dist, reads, lengths, np.array([s for (_, _, s) in simulated])
+
+
+def test_autocorrelation_matches_np_correlate_of_each_column():
+    _, reads, lengths, _ = profiles()
+    acf = spacing.autocorrelation(reads, lengths)
+
+    for (j, n) in enumerate(lengths):
+        x = reads[:n, j] - reads[:n, j].mean()
+        expected = np.correlate(x, x, mode='full')[n - 1:] / np.arange(n, 0, -1)
+
+        np.testing.assert_allclose(acf[:n, j], expected / expected[0], rtol=1e-9, atol=1e-12)
+        assert np.isnan(acf[n:, j]).all()
+
+
+def test_parabolic_finds_the_vertex():
+    offsets = np.array([-0.4, -0.1, 0., 0.3])
+    left, center, right = -(-1 - offsets) ** 2, -offsets ** 2, -(1 - offsets) ** 2
+
+    np.testing.assert_allclose(spacing.parabolic(left, center, right), offsets)
+    assert spacing.parabolic(np.array([1.]), np.array([0.]), np.array([1.]))[0] == 0.
+
+
+def test_estimate_recovers_the_spacing():
+    for (noise, rtol) in ((0., 0.001), (0.05, 0.02)):
+        dist, reads, lengths, truth = profiles(seed=1, noise=noise)
+        result = spacing.estimate(dist, reads, lengths)
+
+        np.testing.assert_allclose(result['spacing'], truth, rtol=max(rtol, 0.01))
+
+        # Every period of a profile has its peak, bar one at either end
+        for j in range(lengths.size):
+            distances = result['distances'][result['dist_col'] == j]
+            assert distances.size >= lengths[j] * 0.05 / truth[j] - 3
+            np.testing.assert_allclose(np.median(distances), truth[j], rtol=rtol)
+
+
+def test_estimate_of_minima_and_of_flat_profiles():
+    dist, reads, lengths, truth = profiles(seed=2)
+    reads[:, 0] = 100.
+
+    result = spacing.estimate(dist, reads, lengths, minima=True)
+
+    assert np.isnan(result['period'][0])
+    assert not (result['peak_col'] == 0).any()
+    np.testing.assert_allclose(result['spacing'][1:], truth[1:], rtol=0.02)
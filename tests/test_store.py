@@ -0,0 +1,91 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import sqlite3
+import numpy as np
+import pytest
+import main
+import store
+import synth
+
+
+def events_of(args):
+    """
+    Event table of the first sheet of a run of main.py
+
+    :param args: parsed arguments
+    :return: dict of ndarrays
+    """
+
+    tables = []
+    main.parsefile(args, tables=tables)
+
+    return tables[0]
+
+
+def assert_same_tables(table, expected):
+    assert sorted(table) == sorted(expected)
+    for name in expected:
+        np.testing.assert_array_equal(table[name], expected[name], err_msg=name)
+
+
+def test_results_are_kept(tmp_path):
+
+    results = store.ResultStore(str(tmp_path / 'results.sqlite'))
+    results.put('a', 'Sheet1', 'Cell1', {'taus': [0.25, 0.5], 'flipped': False})
+    results.close()
+
+    results = store.ResultStore(str(tmp_path / 'results.sqlite'))
+    assert results.get('a') == {'taus': [0.25, 0.5], 'flipped': False}
+    assert results.get('b') is None
+
+
+def test_keys_change_with_data_and_parameters():
+
+    rng = np.random.RandomState(0)
+    raw_dt, tm, bg = rng.rand(100), np.arange(100.), rng.rand(100)
+    shared = store.sheet_digest(tm, bg)
+    key = store.column_key(raw_dt, shared, {'x_tol': 10})
+
+    assert store.column_key(raw_dt.copy(), store.sheet_digest(tm.copy(), bg.copy()), {'x_tol': 10}) == key
+    assert store.column_key(raw_dt[::-1], shared, {'x_tol': 10}) != key
+    assert store.column_key(raw_dt, store.sheet_digest(tm + 1., bg), {'x_tol': 10}) != key
+    assert store.column_key(raw_dt, shared, {'x_tol': 11}) != key
+
+
+@pytest.mark.parametrize('batch_fit', [False, True])
+def test_stored_columns_give_the_same_events(tmp_path, main_args, monkeypatch, batch_fit):
+
+    path = str(tmp_path / 'recording.xlsx')
+    synth.write_calcium_workbook(path, seed=2, cells=6, frames=1500, noise=0.03, flipped=0.5)
+    database = str(tmp_path / 'results.sqlite')
+
+    fresh = events_of(main_args(path, str(tmp_path / 'fresh'), batch_fit=batch_fit))
+    assert_same_tables(events_of(main_args(path, str(tmp_path / 'first'), batch_fit=batch_fit, store=database)),
+                       fresh)
+
+    # Forget some columns, which are then analyzed (and batch fitted) next to the stored ones
+    with sqlite3.connect(database) as connection:
+        connection.execute("DELETE FROM columns WHERE colname IN ('Cell2', 'Cell5')")
+
+    assert_same_tables(events_of(main_args(path, str(tmp_path / 'second'), batch_fit=batch_fit, store=database)),
+                       fresh)
+
+    # All columns are stored now, none is analyzed again
+    def analyze_column(task):
+        raise AssertionError('column ' + task[0].colname + ' analyzed again')
+
+    monkeypatch.setattr(main, 'analyze_column', analyze_column)
+
+    assert_same_tables(events_of(main_args(path, str(tmp_path / 'third'), batch_fit=batch_fit, store=database)),
+                       fresh)
+
+    # Other parameters are other results
+    with pytest.raises(AssertionError):
+        events_of(main_args(path, str(tmp_path / 'fourth'), batch_fit=batch_fit, store=database, x_tol=12))
@@ -0,0 +1,129 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import argparse
+import csv
+import os
+import numpy as np
+import pytest
+import main
+import stream
+import synth
+import tracelet
+
+
+FIELDS = ('start_time', 'end_time', 'rise_time', 'amplitude', 't10', 't50', 't90', 't100', 'k', 'tau', 'y1', 'R2')
+
+
+def batch_events(path, main_args, **overrides):
+    """
+    Events of the first sheet of a workbook as analyzed by main.py
+
+    :param path: path to the workbook
+    :param main_args: fixture
+    :return: dict of ndarrays, see eventtable.concat
+    """
+
+    tables = []
+    main.parsefile(main_args(path, os.path.dirname(path), **overrides), tables=tables)
+
+    return tables[0]
+
+
+def assert_same_events(events, table, columns):
+    """
+    Streamed events, as dicts, are the events of the event table in the same order for every column
+    """
+
+    for column in columns:
+        mine = [event for event in events if event['column'] == column]
+        theirs = table['column'] == column
+
+        assert [event['event'] for event in mine] == table['event'][theirs].tolist()
+        assert [event['fit_success'] for event in mine] == table['fit_success'][theirs].tolist()
+        for name in FIELDS:
+            np.testing.assert_allclose(np.array([event[name] for event in mine], dtype=float),
+                                       table[name][theirs].astype(float), rtol=1e-6, atol=1e-12, err_msg=name)
+
+
+@pytest.mark.parametrize('noise, chunk', [(0.01, 777), (0.08, 1), (0.08, 4096)])
+def test_streamed_events_match_the_workbook_events(tmp_path, main_args, noise, chunk):
+
+    path = str(tmp_path / 'recording.xlsx')
+    sim = synth.write_calcium_workbook(path, seed=3, cells=5, frames=2000, noise=noise, flipped=0.4)[0]
+    columns = ['Cell' + str(c + 1) for c in range(5)]
+
+    # The 340/380 order is decided from the whole recording, as main.py does
+    events = []
+    analyzer = stream.StreamAnalyzer(columns, events.append, warmup=2000, capacity=4000)
+    for i in range(0, sim['time'].size, chunk):
+        analyzer.feed(sim['time'][i:i + chunk], sim['data'][i:i + chunk], sim['background'][i:i + chunk])
+    analyzer.finish()
+
+    assert_same_events(events, batch_events(path, main_args), columns)
+
+
+def test_streamed_csv_matches_the_workbook_events(tmp_path, main_args):
+
+    path = str(tmp_path / 'recording.xlsx')
+    sim = synth.write_calcium_workbook(path, seed=4, cells=3, frames=1500)[0]
+    columns = ['Cell' + str(c + 1) for c in range(3)]
+
+    live = str(tmp_path / 'live.csv')
+    with open(live, 'w') as f:
+        f.write(','.join(['Index', 'Time', 'X', 'Y', 'Z'] + columns + ['Background']) + '\n')
+        for i in range(sim['time'].size):
+            f.write(','.join(repr(float(v)) for v in [i, sim['time'][i], 0, 0, 0] + sim['data'][i].tolist() +
+                             [sim['background'][i]]) + '\n')
+
+    out = str(tmp_path / 'live_events.csv')
+    stream.stream(argparse.Namespace(path=live, out=out, binary=None, follow=False, poll=0.5, idle_timeout=None,
+                                     x_tol=10, y_tol=0.0005, cor_bg=False, bg=-1, no_interp=False, warmup=1500,
+                                     capacity=65536))
+
+    with open(out) as f:
+        events = [dict(row, event=int(row['event']), fit_success=row['fit_success'] == 'True')
+                  for row in csv.DictReader(f)]
+
+    assert_same_events(events, batch_events(path, main_args), columns)
+
+
+def test_failed_fits_are_nan(monkeypatch):
+
+    sim = synth.calcium_arrays(cells=1, frames=1500, flipped=0.)
+
+    # Every fit fails and keeps the placeholders it was created with
+    monkeypatch.setattr(tracelet.Tracelet, 'optimize', lambda self, **kwargs: True)
+
+    events = []
+    analyzer = stream.StreamAnalyzer(['Cell1'], events.append)
+    analyzer.feed(sim['time'], sim['data'], sim['background'])
+    analyzer.finish()
+
+    assert len(events) > 1
+    for event in events:
+        assert not event['fit_success']
+        assert all(np.isnan(event[name]) for name in ('k', 'tau', 'y1', 'R2'))
+
+
+def test_tracelets_longer_than_the_ring_buffer_have_no_decay():
+
+    sim = synth.calcium_arrays(cells=1, frames=3000, beat_rate=0.5, flipped=0.)
+
+    events = []
+    analyzer = stream.StreamAnalyzer(['Cell1'], events.append, capacity=300)
+    for i in range(0, sim['time'].size, 100):
+        analyzer.feed(sim['time'][i:i + 100], sim['data'][i:i + 100], sim['background'][i:i + 100])
+    analyzer.finish()
+
+    assert len(events) > 1
+    assert [event['event'] for event in events] == list(range(len(events)))
+    for event in events:
+        assert np.isnan(event['t100']) and not event['fit_success']
+        assert np.isfinite(event['rise_time'])
@@ -0,0 +1,124 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import json
+import numpy as np
+import pytest
+import tracecol
+
+
+BINS = (0., 10., 50)
+
+
+def chunks(seed, offset=0.):
+    """
+    Values in chunks of many sizes, including empty ones and values outside the histogram
+
+    :param seed: int, random seed
+    :param offset: float, added to every value
+    :return: list of ndarrays
+    """
+
+    rng = np.random.RandomState(seed)
+
+    return [offset + rng.normal(5., 4., size) for size in (0, 1, 2, 17, 300, 0, 5, 1000, 1)]
+
+
+def assert_statistics(series, values):
+    """
+    The statistics of a series are those of np.mean, np.std, np.min, np.max and np.histogram of its values
+    """
+
+    edges = np.linspace(*BINS[:2], BINS[2] + 1)
+
+    assert series.count == values.size
+    np.testing.assert_allclose(series.mean, np.mean(values), rtol=1e-12)
+    np.testing.assert_allclose(series.std(), np.std(values), rtol=1e-9)
+    assert series.min == np.min(values) and series.max == np.max(values)
+    np.testing.assert_array_equal(series.hist, np.histogram(values, bins=edges)[0])
+    assert series.under == np.sum(values < edges[0]) and series.over == np.sum(values > edges[-1])
+
+
+@pytest.mark.parametrize('offset', [0., 1e6])
+def test_values_added_in_chunks(offset):
+
+    values = chunks(0, offset)
+    series = tracecol.Series(BINS)
+    for chunk in values:
+        series += chunk
+
+    np.testing.assert_array_equal(series.values(), np.concatenate(values))
+    assert_statistics(series, np.concatenate(values))
+
+
+@pytest.mark.parametrize('offset', [0., 1e6])
+def test_merged_series(offset):
+
+    parts = [chunks(seed, offset) for seed in range(4)]
+    merged = tracecol.Series(BINS)
+    for part in parts:
+        series = tracecol.Series(BINS)
+        for chunk in part:
+            series.add(chunk)
+        merged.merge(series)
+    merged.merge(tracecol.Series(BINS))
+
+    values = np.concatenate([np.concatenate(part) for part in parts])
+
+    np.testing.assert_array_equal(merged.values(), values)
+    assert_statistics(merged, values)
+
+
+def test_statistics_restored_from_json():
+
+    parts = [np.concatenate(chunks(seed)) for seed in range(3)]
+    restored = tracecol.Series(BINS, keep=False)
+    for part in parts:
+        series = tracecol.Series(BINS, keep=False)
+        series.add(part)
+        restored.restore(json.loads(json.dumps(series.state())))
+
+    assert_statistics(restored, np.concatenate(parts))
+
+    with pytest.raises(AssertionError):
+        restored.values()
+
+
+def test_values_cannot_be_kept_from_a_series_without_them():
+
+    series = tracecol.Series(BINS, keep=False)
+    series.add([1., 2.])
+
+    with pytest.raises(AssertionError):
+        tracecol.Series(BINS).merge(series)
+
+
+def test_collection_summary_matches_the_values():
+
+    rng = np.random.RandomState(0)
+    collection = tracecol.TraceCollection()
+    stats = tracecol.TraceCollection(keep=False)
+
+    for _ in range(5):
+        column = tracecol.TraceCollection()
+        column.load(dict((attribute, rng.normal(1., 0.5, rng.randint(0, 40)).tolist())
+                         for (attribute, _) in tracecol.ATTRIBUTES))
+        collection.extend(column)
+        stats.restore(column.state())
+
+    summary = collection.summary()
+
+    for (attribute, name) in tracecol.ATTRIBUTES:
+        values = np.array(collection.to_dict()[attribute])
+        assert summary[name + '_n'] == values.size
+        np.testing.assert_allclose([summary[name + '_mean'], summary[name + '_sd']],
+                                   [np.mean(values), np.std(values)], rtol=1e-12)
+
+    assert stats.summary() == pytest.approx(summary, rel=1e-12)
+    assert tracecol.TraceCollection().summary()['tau_mean'] is None
@@ -0,0 +1,43 @@
+"""
+AutoCal
+Automatic analysis of Calcium imaging data
+
+Edward Lau 2017
+lau1@stanford.edu
+
+"""
+
+import numpy as np
+import tracelet
+
+
+def decays(k, seed, beats=4, frames=100, interval=0.005):
+    """
+    A trace of successive noisy first-order decays, as a TraceletSet of one tracelet per decay
+
+    :param k: float rate constant of every decay
+    :param seed: int random seed of the noise
+    :param beats: int number of decays
+    :param frames: int samples per decay
+    :param interval: float seconds between samples
+    :return: TraceletSet
+    """
+
+    rng = np.random.RandomState(seed)
+    tm = interval * np.arange(beats * frames)
+    ratio = 0.8 + 0.5 * np.exp(-k * (tm % (frames * interval))) + rng.normal(0, 0.005, tm.size)
+    starts = frames * np.arange(beats)
+
+    return tracelet.TraceletSet(tm=tm, dt=ratio, sm=ratio, starts=starts, ends=starts + frames)
+
+
+def test_batch_fits_of_a_trace_do_not_depend_on_the_others():
+    alone = decays(4., seed=0)
+    tracelet.optimize_batch([alone])
+
+    together = [decays(4., seed=0), decays(40., seed=1), decays(30., seed=2)]
+    tracelet.optimize_batch(together)
+
+    assert alone.opt_success.all()
+    for name in ('opt_k', 'opt_y1', 'opt_tau', 'R2', 'opt_success', 'opt_nfev'):
+        assert np.array_equal(getattr(alone, name), getattr(together[0], name))
@@ -7,6 +7,213 @@ lau1@stanford.edu
 
 """
 
+import numpy as np
+
+
+# Attributes of a collection with the name used for them in summaries
+ATTRIBUTES = (('rise_ts', 'rise_time'),
+              ('t10s', 't10'),
+              ('t50s', 't50'),
+              ('t90s', 't90'),
+              ('t100s', 't100'),
+              ('amplitudes', 'amplitude'),
+              ('taus', 'tau'))
+
+# Fixed histogram bins of each attribute as (lowest edge, highest edge, number of bins), the same everywhere
+# so that histograms of different sheets, workbooks and workers can be added up
+DEFAULT_BINS = {'rise_ts': (0., 2., 200),
+                't10s': (0., 10., 200),
+                't50s': (0., 10., 200),
+                't90s': (0., 10., 200),
+                't100s': (0., 10., 200),
+                'amplitudes': (-2., 4., 200),
+                'taus': (0., 10., 200)}
+
+
+class Series(object):
+    """
+    Object to hold the values of one attribute in a growable float array, together with their running count,
+    mean and variance (Welford, with Chan's update for several values at a time), minimum, maximum and a
+    fixed-bin histogram. Series are merged without going back to the values, and need not keep the values
+    at all if only the statistics are wanted.
+
+    """
+
+    __slots__ = ('keep', 'buffer', 'count', 'mean', 'm2', 'min', 'max', 'edges', 'hist', 'under', 'over')
+
+    def __init__(self, bins=(0., 1., 100), keep=True):
+        """
+
+        :param bins: tuple of (lowest edge, highest edge, number of bins) of the histogram
+        :param keep: T/F whether to keep the values themselves
+        """
+
+        self.keep = keep
+        self.buffer = np.zeros(16 if keep else 0)
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.edges = np.linspace(bins[0], bins[1], bins[2] + 1)
+        self.hist = np.zeros(bins[2], dtype=np.int64)
+        self.under = 0
+        self.over = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iadd__(self, values):
+        self.add(values)
+        return self
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __array__(self, dtype=None):
+        return self.values() if dtype is None else self.values().astype(dtype)
+
+    def add(self, values):
+        """
+        Append values and update the statistics
+
+        :param values: array_like of float
+        :return: True
+        """
+
+        values = np.asarray(values, dtype=float).ravel()
+        n = values.size
+
+        if n == 0:
+            return True
+
+        if self.keep:
+            if self.count + n > self.buffer.size:
+                grown = np.zeros(max(2 * self.buffer.size, self.count + n))
+                grown[:self.count] = self.buffer[:self.count]
+                self.buffer = grown
+            self.buffer[self.count:self.count + n] = values
+
+        mean = values.mean()
+        self._combine(n, mean, np.sum((values - mean) ** 2), values.min(), values.max())
+
+        self.hist += np.histogram(values, bins=self.edges)[0]
+        self.under += int(np.sum(values < self.edges[0]))
+        self.over += int(np.sum(values > self.edges[-1]))
+
+        return True
+
+    def _combine(self, n, mean, m2, vmin, vmax):
+        """
+        Fold the count, mean, sum of squared deviations and extremes of other values into the statistics
+        """
+
+        total = self.count + n
+        delta = mean - self.mean
+
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    def merge(self, other):
+        """
+        Add the values (if kept) and statistics of another series with the same bins
+
+        :param other: Series
+        :return: True
+        """
+
+        assert np.array_equal(self.edges, other.edges), 'Histograms with different bins cannot be merged'
+
+        if other.count == 0:
+            return True
+
+        if self.keep:
+            assert other.keep, 'Cannot keep values merged from a series that did not keep them'
+            values = other.values()
+            if self.count + values.size > self.buffer.size:
+                grown = np.zeros(max(2 * self.buffer.size, self.count + values.size))
+                grown[:self.count] = self.buffer[:self.count]
+                self.buffer = grown
+            self.buffer[self.count:self.count + values.size] = values
+
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+
+        self.hist += other.hist
+        self.under += other.under
+        self.over += other.over
+
+        return True
+
+    def values(self):
+        """
+        The values added so far, in order
+
+        :return: ndarray view
+        """
+
+        assert self.keep, 'This series does not keep its values'
+
+        return self.buffer[:self.count]
+
+    def var(self):
+        """
+        Population variance, as np.var
+
+        :return: float, NaN if empty
+        """
+
+        return self.m2 / self.count if self.count > 0 else np.nan
+
+    def std(self):
+        """
+        Population standard deviation, as np.std
+
+        :return: float, NaN if empty
+        """
+
+        return np.sqrt(self.var())
+
+    def state(self):
+        """
+        Statistics without the values, as plain numbers and lists, e.g. to hand them to another process or
+        keep them in a json file
+
+        :return: dict
+        """
+
+        return {'count': self.count,
+                'mean': float(self.mean),
+                'm2': float(self.m2),
+                'min': float(self.min),
+                'max': float(self.max),
+                'bins': [float(self.edges[0]), float(self.edges[-1]), self.hist.size],
+                'hist': self.hist.tolist(),
+                'under': self.under,
+                'over': self.over}
+
+    def restore(self, state):
+        """
+        Merge statistics kept by state() into a series that does not keep values
+
+        :param state: dict
+        :return: True
+        """
+
+        other = Series(bins=tuple(state['bins']), keep=False)
+        other.count = state['count']
+        other.mean = state['mean']
+        other.m2 = state['m2']
+        other.min = state['min']
+        other.max = state['max']
+        other.hist = np.asarray(state['hist'], dtype=np.int64)
+        other.under = state['under']
+        other.over = state['over']
+
+        return self.merge(other)
+
 
 class TraceCollection(object):
     """
@@ -14,11 +221,97 @@ class TraceCollection(object):
 
     """
 
-    def __init__(self):
-        self.rise_ts = []        # Collection of rise times
-        self.t10s = []           # Collection of t10 values
-        self.t50s = []           # Collection of t50 values
-        self.t90s = []           # Collection of t90 values
-        self.t100s = []          # Collection of fall interval (t100) values
-        self.amplitudes = []     # Collection of amplitude values
-        self.taus = []           # Collection of tau values
+    def __init__(self, keep=True, bins=None):
+        """
+
+        :param keep: T/F whether to keep every value, or only the statistics of each attribute
+        :param bins: dict of histogram bins per attribute, see DEFAULT_BINS
+        """
+
+        bins = DEFAULT_BINS if bins is None else dict(DEFAULT_BINS, **bins)
+
+        self.rise_ts = Series(bins['rise_ts'], keep)         # Collection of rise times
+        self.t10s = Series(bins['t10s'], keep)               # Collection of t10 values
+        self.t50s = Series(bins['t50s'], keep)               # Collection of t50 values
+        self.t90s = Series(bins['t90s'], keep)               # Collection of t90 values
+        self.t100s = Series(bins['t100s'], keep)             # Collection of fall interval (t100) values
+        self.amplitudes = Series(bins['amplitudes'], keep)   # Collection of amplitude values
+        self.taus = Series(bins['taus'], keep)               # Collection of tau values
+
+    def extend(self, other):
+        """
+        Append all values of another collection, e.g. one column's results merged into the sheet
+
+        :param other: TraceCollection
+        :return: True
+        """
+
+        for (attribute, _) in ATTRIBUTES:
+            getattr(self, attribute).merge(getattr(other, attribute))
+
+        return True
+
+    def to_dict(self):
+        """
+        All values as plain lists of floats, e.g. to keep them in the results store
+
+        :return: dict of lists
+        """
+
+        return dict((attribute, getattr(self, attribute).values().tolist()) for (attribute, _) in ATTRIBUTES)
+
+    def load(self, values):
+        """
+        Append values kept by to_dict
+
+        :param values: dict of lists
+        :return: True
+        """
+
+        for (attribute, _) in ATTRIBUTES:
+            getattr(self, attribute).add(values[attribute])
+
+        return True
+
+    def state(self):
+        """
+        Statistics of every attribute without the values, see Series.state
+
+        :return: dict
+        """
+
+        return dict((attribute, getattr(self, attribute).state()) for (attribute, _) in ATTRIBUTES)
+
+    def restore(self, state):
+        """
+        Merge statistics kept by state(), into a collection that does not keep values
+
+        :param state: dict
+        :return: True
+        """
+
+        for (attribute, _) in ATTRIBUTES:
+            getattr(self, attribute).restore(state[attribute])
+
+        return True
+
+    def summary(self):
+        """
+        Count, mean, standard deviation, minimum and maximum of every attribute
+
+        :return: flat dict, e.g. 'tau_mean'
+        """
+
+        summary = {}
+
+        for (attribute, name) in ATTRIBUTES:
+            series = getattr(self, attribute)
+            empty = series.count == 0
+
+            summary[name + '_n'] = series.count
+            summary[name + '_mean'] = None if empty else float(series.mean)
+            summary[name + '_sd'] = None if empty else float(series.std())
+            summary[name + '_min'] = None if empty else float(series.min)
+            summary[name + '_max'] = None if empty else float(series.max)
+
+        return summary
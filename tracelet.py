@@ -8,6 +8,10 @@ lau1@stanford.edu
 """
 
 
+# Initial guess of k when there is no neighbouring fit to start from
+DEFAULT_K0 = 2.
+
+
 class Tracelet(object):
     """
     Object to hold each downward slope of a trace for optimization.
@@ -32,152 +36,262 @@ class Tracelet(object):
         self.opt_tau = 1  # Optimized tau (1/k)
         self.R2 = 0  # R2 of optimization
         self.opt_success = False
+        self.opt_nfev = 0  # Residual evaluations spent on the fit, by every solver alike
 
-    def objective_function_o0p1(self, para):
+    def optimize(self, model, k0=DEFAULT_K0):
         """
-        This is the cost function we want to minimize for zeroth-order (o0), one-parameter (p1) fitting
+        Perform optimization to yield best-fitted k (x) as well as y1, tau, SE, and R2, etc.
+        Residuals and their analytic Jacobians are evaluated as array expressions by the least squares
+        routines in fitting.py.
+
+        :param model: Int - the kinetic model to use. 0: zeroth order one parameter; 1: first order one parameter;
+        2: first order two parameter
+        :param k0: float initial guess of k, e.g. the k of a neighbouring tracelet
 
-        :param para: Parameters, here only one parameter (k) with initial guess
-        :return: Sums of squares of differences between predicted and actual
+        :return: True
         """
+        import fitting
+        import numpy as np
 
-        import models
+        assert model in [0, 1, 2], "Check specification of kinetic model."
 
-        k = para
+        # Single parameter zeroth-order fitting (only optimizing for k)
+        if model == 0:
+            res = fitting.fit_zero(self.x, self.y, k0=k0)
+            self.opt_nfev = res.nfev
 
-        y0 = self.y[0]
-        y1 = self.y[-1]
-        y = self.y
+            if res.success:
+                self.opt_success = True
+                self.opt_k = res.x[0]
 
-        # Predict y from t usint zeroth order model
-        y_hat = [models.model_zero(x - self.x[0], k, y0, y1) for x in self.x]
+            else:
+                print("Optimization unsuccessful")  # Throw error later
 
-        # Use sums of square as cost
-        ss = sum([(y[i] - y_hat[i]) ** 2 for i in range(len(y))])
 
-        return ss
+        # Single parameter first-order fitting (only optimizing for k)
+        elif model == 1:
+            res = fitting.fit_first_fixed(self.x, self.y, k0=k0)
+            self.opt_nfev = res.nfev
 
+            if res.success:
+                self.opt_success = True
+                self.opt_k = res.x[0]
+                self.opt_y1 = self.y[-1]
 
-    def objective_function_o1p1(self, para):
-        """
-        This is the cost function we want to minimize for first-order (o1), one-parameter (p1) fitting
+            else:
+                print("Optimization unsuccessful")  # Throw error later
 
-        :param para: Parameters, here only one parameter (k) with initial guess
-        :return: Sums of squares of differences between predicted and actual
-        """
+        # Two-parameter first-order fitting (optimizing for k and y1)
+        elif model == 2:
+            # The plateau is solved in closed form for every k, so only k is searched
+            res = fitting.fit_first_varpro(self.x, self.y, k0=k0)
+            self.opt_nfev = res.nfev
 
-        import models
+            if res.success:
+                self.opt_success = True
+                self.opt_k = res.x[0]
+                self.opt_y1 = res.x[1]
 
-        k = para
+            else:
+                print("Optimization unsuccessful")  # Throw error later
 
-        y0 = self.y[0]
-        y1 = self.y[-1]
-        y = self.y
+        # Calculate Tau (1/k) from the optimized k
+        self.opt_tau = 1. / self.opt_k
 
-        # Predict y from t using first order model
-        y_hat = [models.model_first(x-self.x[0], k, y0, y1) for x in self.x]
+        # Calculate coefficient of determination as one minus residual sum of squares over total sum of squares
+        y = np.asarray(self.y, dtype=float)
+        self.R2 = 1. - (res.ss/np.sum((y - np.mean(y)) ** 2))
 
-        # Use sums of square as cost
-        ss = sum([(y[i] - y_hat[i]) ** 2 for i in range(len(y))])
+        return True
 
-        return ss
 
+class TraceletSet(object):
+    """
+    Object to hold all tracelets of one trace in compact form.
+    Only the start and end offsets of each tracelet are stored (CSR-style); the time, ratio and smoothened ratio
+    stay in the parent trace's arrays and every tracelet handed out is a view into them. Fit results are
+    kept as one array per attribute.
 
-    def objective_function_o1p2(self, para):
-        """
-        This is the cost function we want to minimize for first-order (o1), one-parameter (p2) fitting
+    """
 
-        :param para: nparray para[0] is k, para[1] is the plateau (y1)
+    __slots__ = ('x', 'y', 'y_sm', 'starts', 'ends', 'opt_k', 'opt_y1', 'opt_tau', 'R2', 'opt_success', 'opt_nfev')
 
-        :return: Sums of squares of differences between predicted and actual
+    def __init__(self, tm, dt, sm, starts, ends):
         """
 
-        import models
-
-        k = para[0]
-        y1 = para[1]
+        :param tm: ndarray median time of the parent trace
+        :param dt: ndarray data point (340/380 ratio) of the parent trace
+        :param sm: ndarray smoothened ratio of the parent trace
+        :param starts: array_like of int, first index of each tracelet
+        :param ends: array_like of int, index after the last point of each tracelet
+        """
+        import numpy as np
 
-        y0 = self.y[0]
-        y = self.y
+        self.x = tm
+        self.y = dt
+        self.y_sm = sm
+        self.starts = np.asarray(starts, dtype=int)
+        self.ends = np.asarray(ends, dtype=int)
 
-        # Predict y from t using first order model
-        y_hat = [models.model_first(x-self.x[0], k, y0, y1) for x in self.x]
+        assert self.starts.shape == self.ends.shape, 'Tracelet starts and ends differ in number'
 
-        # Use sums of square as cost
-        ss = sum([(y[i] - y_hat[i]) ** 2 for i in range(len(y))])
+        # Private, same defaults as a single Tracelet
+        n = self.starts.size
+        self.opt_k = np.ones(n)
+        self.opt_y1 = np.full(n, 0.5)
+        self.opt_tau = np.ones(n)
+        self.R2 = np.zeros(n)
+        self.opt_success = np.zeros(n, dtype=bool)
+        self.opt_nfev = np.zeros(n, dtype=int)
 
-        return ss
+    def __len__(self):
+        return self.starts.size
 
+    def __getitem__(self, i):
+        """
+        One tracelet as a Tracelet object whose arrays are views into the parent trace, carrying its fit results
 
-    def optimize(self, model):
+        :param i: int, tracelet index
+        :return: Tracelet
         """
-        Perform optimization to yield best-fitted k (x) as well as y1, tau, SE, and R2, etc.
 
-        :param model: Int - the kinetic model to use. 0: zeroth order one parameter; 1: first order one parameter;
-        2: first order two parameter
+        start, end = self.starts[i], self.ends[i]
+
+        trcelt = Tracelet(tm=self.x[start:end], dt=self.y[start:end], sm=self.y_sm[start:end])
+        trcelt.opt_k = self.opt_k[i]
+        trcelt.opt_y1 = self.opt_y1[i]
+        trcelt.opt_tau = self.opt_tau[i]
+        trcelt.R2 = self.R2[i]
+        trcelt.opt_success = bool(self.opt_success[i])
+        trcelt.opt_nfev = int(self.opt_nfev[i])
+
+        return trcelt
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def store(self, i, trcelt):
+        """
+        Keep the fit results of one tracelet
 
+        :param i: int, tracelet index
+        :param trcelt: fitted Tracelet
         :return: True
         """
-        import scipy.optimize
-        import numpy as np
 
-        assert model in [0, 1, 2], "Check specification of kinetic model."
+        self.opt_k[i] = trcelt.opt_k
+        self.opt_y1[i] = trcelt.opt_y1
+        self.opt_tau[i] = trcelt.opt_tau
+        self.R2[i] = trcelt.R2
+        self.opt_success[i] = trcelt.opt_success
+        self.opt_nfev[i] = trcelt.opt_nfev
 
-        # Single parameter zeroth-order fitting (only optimizing for k)
-        if model == 0:
-            res = scipy.optimize.minimize(self.objective_function_o0p1, 2)
+        return True
 
-            if res.success:
-                self.opt_success = True
-                self.opt_k = res.x
-                print(res.x)
+    def views(self):
+        """
+        Time and ratio of every tracelet as views into the parent trace
 
-            else:
-                print("Optimization unsuccessful")  # Throw error later
+        :return: (list of time views, list of ratio views)
+        """
 
+        return ([self.x[s:e] for (s, e) in zip(self.starts, self.ends)],
+                [self.y[s:e] for (s, e) in zip(self.starts, self.ends)])
 
-        # Single parameter first-order fitting (only optimizing for k)
-        elif model == 1:
-            res = scipy.optimize.minimize(self.objective_function_o1p1, 2)
+    def decay_times(self, interpolate=True):
+        """
+        Decay intervals (t10, t50, t90, t100) of all tracelets, computed on the parent's smoothened ratio
 
-            if res.success:
-                self.opt_success = True
-                self.opt_k = res.x
-                self.opt_y1 = self.y[-1]
-                print(res.x)
+        :param interpolate: T/F whether to interpolate at the level crossings
+        :return: dict of ndarrays, see decay.decay_times
+        """
+        import decay
 
-            else:
-                print("Optimization unsuccessful")  # Throw error later
+        return decay.decay_times(self.x, self.y_sm, self.starts, self.ends, interpolate=interpolate)
 
-        # Two-parameter first-order fitting (only optimizing for k)
-        elif model == 2:
-            maxiter = 500
-            res = scipy.optimize.minimize(self.objective_function_o1p2, np.array([2, self.y[-1]]),
-                                          method='Nelder-Mead',  # Use Nelder-Mead simplex for multivariate
-                                          options={'maxiter': maxiter})
+    def optimize(self, model, k0=DEFAULT_K0, warm=True):
+        """
+        Fit every tracelet on its own, see Tracelet.optimize. Consecutive decays of the same trace have nearly
+        the same kinetics, so each fit starts from the k of the last successful fit before it.
 
-            print(res.message)
+        :param model: Int - the kinetic model to use
+        :param k0: float initial guess of k of the first tracelet, and of every tracelet if not warm
+        :param warm: T/F whether to start each fit from the previous successful fit
+        :return: True
+        """
+        import numpy as np
 
-            if res.success or res.nit == maxiter:
-                self.opt_success = True
-                self.opt_k = res.x[0]
-                self.opt_y1 = res.x[1]
-                print(res.x)
+        for i, trcelt in enumerate(self):
+            trcelt.optimize(model=model, k0=k0)
+            self.store(i, trcelt)
 
-            else:
-                print("Optimization unsuccessful")  # Throw error later
+            if warm and trcelt.opt_success and np.isfinite(trcelt.opt_k) and trcelt.opt_k > 0:
+                k0 = trcelt.opt_k
 
-        # Calculate Tau (1/k) from the optimized k
-        if not res.success:
-            print("Optimization unsuccessful")  # Throw error later
+        return True
 
-        self.opt_tau = 1. / self.opt_k
 
-        print(res.fun)
-        print(sum((self.y - np.mean(self.y)) ** 2))
-        print((res.fun/sum((self.y - np.mean(self.y)) ** 2)))
-        # Calculate coefficient of determination as one minus residual sum of squares over total sum of squares
-        self.R2 = 1. - (res.fun/sum((self.y - np.mean(self.y)) ** 2))
-        print(self.R2)
+def optimize_batch(tracelet_sets, k0=DEFAULT_K0, warm=True):
+    """
+    Two-parameter first-order fitting of the tracelets of many traces in one vectorized solver call.
+    Results are written back to each set as if TraceletSet.optimize(model=2) had been called on it.
+    As all tracelets are fitted together, a warm start cannot follow each trace; instead the first tracelet of
+    every trace is fitted first, and its k is the start of all the other tracelets of the same trace. Each trace
+    depends only on its own data, so that its results can be stored and reused apart from the others.
+
+    :param tracelet_sets: list of TraceletSet objects
+    :param k0: float initial guess of k, of the first tracelets only if warm
+    :param warm: T/F whether to start the other tracelets from the first tracelet of their trace
+    :return: True
+    """
+    import fitting
+    import numpy as np
 
+    xs = []
+    ys = []
+    for trcelts in tracelet_sets:
+        x, y = trcelts.views()
+        xs += x
+        ys += y
+
+    if not xs:
         return True
+
+    if warm:
+        # Offsets of the first tracelet of every set that has any
+        sizes = np.array([len(trcelts) for trcelts in tracelet_sets], dtype=int)
+        firsts = (np.cumsum(sizes) - sizes)[sizes > 0]
+        rest = np.setdiff1d(np.arange(len(xs)), firsts)
+
+        first = fitting.fit_first_batch([xs[i] for i in firsts], [ys[i] for i in firsts], k0=k0)
+        seeds = np.where(first.success, first.k, k0)
+
+        # Every other tracelet starts from the first fit of its own trace, or from k0 where that fit failed
+        others = fitting.fit_first_batch([xs[i] for i in rest], [ys[i] for i in rest],
+                                         k0=np.repeat(seeds, sizes[sizes > 0] - 1))
+
+        # Put both parts back in tracelet order
+        res = {}
+        for name in ('success', 'k', 'y1', 'tau', 'R2', 'nfev'):
+            res[name] = np.zeros(len(xs), dtype=first[name].dtype)
+            res[name][firsts] = first[name]
+            res[name][rest] = others[name]
+
+    else:
+        res = fitting.fit_first_batch(xs, ys, k0=k0)
+
+    # Hand each set its own slice of the results
+    offset = 0
+    for trcelts in tracelet_sets:
+        part = slice(offset, offset + len(trcelts))
+        offset += len(trcelts)
+
+        trcelts.opt_success[:] = res['success'][part]
+        trcelts.opt_k[:] = res['k'][part]
+        trcelts.opt_y1[:] = res['y1'][part]
+        trcelts.opt_tau[:] = res['tau'][part]
+        trcelts.R2[:] = res['R2'][part]
+        trcelts.opt_nfev[:] = res['nfev'][part]
+
+    return True